@@ -1,23 +1,74 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from pydantic import BaseModel
+from typing import List, Optional
 import os
-import logfire
+import asyncio
 from contextlib import asynccontextmanager
 import pika
 import uuid
 import threading
 import time
+import queue
+import functools
+import json
+import math
+from project_download import iter_ndjson, iter_zip
+from question_cache import QuestionCache
+import trace_log
+import budget
+import affinity
+import blob_store
+from tenant_scheduler import FairScheduler, QuotaExceeded, estimate_tokens, parse_mapping
+import profiler
+import loop_monitor
 
-logfire.configure(token=os.getenv("LOGFIRE_WRITE_TOKEN"), send_to_logfire="if-token-present", service_name="api-gateway")
+LOGFIRE_TOKEN = os.getenv("LOGFIRE_WRITE_TOKEN")
+if LOGFIRE_TOKEN:
+    # logfire pulls in OpenTelemetry, only pay for the import when traces are sent
+    import logfire
+    logfire.configure(token=LOGFIRE_TOKEN, send_to_logfire="if-token-present", service_name="api-gateway")
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "1000"))
+# TENANT_API_KEYS="key1=tenant-a,key2=tenant-b" maps X-API-Key values to tenants
+TENANT_API_KEYS = parse_mapping(os.getenv("TENANT_API_KEYS"))
+DEFAULT_TENANT = "default"
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# the budget of a request, shared by all services and model calls it passes through, 0 means unlimited
+BUDGET_TOKENS = int(os.getenv("BUDGET_TOKENS", "100000"))
+BUDGET_TOOL_CALLS = int(os.getenv("BUDGET_TOOL_CALLS", "8"))
+BUDGET_SECONDS = float(os.getenv("BUDGET_SECONDS", "110"))
+# streamed documents and projects are generated piece by piece and may take longer
+BUDGET_STREAM_SECONDS = float(os.getenv("BUDGET_STREAM_SECONDS", "600"))
+SERVICE_QUEUES = (
+    "orchestrator", "language-agent", "diagram-agent", "software-agent",
+    "language-generator", "diagram-generator", "software-generator",
+)
+
+class FutureReply:
+    """
+    Hands a reply from the ioloop thread to a future on an asyncio loop.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def put(self, reply):
+        self.loop.call_soon_threadsafe(self._set_result, reply)
+
+    def _set_result(self, reply):
+        if not self.future.done():
+            self.future.set_result(reply)
 
 class RabbitManager:
     def __init__(self):
         self.connection = None
         self.channel = None
         self.callback_queue = None
-        self.response = None
-        self.corr_id = None
+        self.pending = {}
         self._lock = threading.Lock()
         self._connected = threading.Event()
         self._closing = False
@@ -25,18 +76,19 @@ class RabbitManager:
         self._start_connection_thread()
 
     def _start_connection_thread(self):
-        t = threading.Thread(target=self._run, daemon=True)
+        t = threading.Thread(target=self._run, name="rabbitmq-io", daemon=True)
         t.start()
 
     def _run(self):
         while not self._closing:
             try:
                 self._connect()
-                self._connected.set()
                 self.connection.ioloop.start()
             except Exception as e:
                 print(f"RabbitMQ connection error: {e}, retrying in 5s...")
-                self._connected.clear()
+            # the ioloop also returns when the connection could not be opened, don't reconnect in a tight loop
+            self._connected.clear()
+            if not self._closing:
                 time.sleep(5)
 
     def _connect(self):
@@ -63,6 +115,7 @@ class RabbitManager:
 
     def on_channel_open(self, channel):
         self.channel = channel
+        affinity.declare_exchanges(channel, ("orchestrator", "language-generator", "software-generator"))
         self.channel.queue_declare('', exclusive=True, durable=True, callback=self.on_queue_declared)
 
     def on_queue_declared(self, method_frame):
@@ -72,34 +125,106 @@ class RabbitManager:
             on_message_callback=self.on_response,
             auto_ack=True
         )
+        self._connected.set()
 
     def on_response(self, ch, method, properties, body):
-        if self.corr_id == properties.correlation_id:
-            self.response = body
+        with self._lock:
+            replies = self.pending.get(properties.correlation_id)
+        if replies is not None:
+            replies.put((body, properties.headers or {}))
 
-    def call(self, message: str, timeout=120):
+    def publish(self, message, routing_key: str, corr_id: str, timeout=120, headers=None):
         if not self._connected.wait(timeout=timeout):
             raise Exception("RabbitMQ not connected")
+        properties = pika.BasicProperties(
+            reply_to=self.callback_queue,
+            correlation_id=corr_id,
+            delivery_mode=pika.DeliveryMode.Persistent,
+            headers=headers
+        )
+        exchange, key = affinity.target(routing_key, headers)
+        # the channel belongs to the ioloop thread, hand the publish over to it
+        self.connection.ioloop.add_callback_threadsafe(functools.partial(
+            self.channel.basic_publish,
+            exchange=exchange,
+            routing_key=key,
+            properties=properties,
+            body=message
+        ))
+
+    def start_hop(self, routing_key: str, corr_id: str):
+        # every request published by the gateway starts a new trace
+        hop = trace_log.Hop("api-gateway", routing_key, trace_id=corr_id, correlation_id=corr_id)
+        hop.start()
+        return hop
+
+    def call(self, message: str, routing_key='orchestrator', timeout=120, headers=None):
+        corr_id = str(uuid.uuid4())
+        hop = self.start_hop(routing_key, corr_id)
+        replies = queue.Queue()
+        with self._lock:
+            self.pending[corr_id] = replies
+        try:
+            self.publish(message, routing_key, corr_id, timeout, trace_log.outgoing_headers(headers, hop))
+            try:
+                body, _ = replies.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("No response from RPC call")
+            return body
+        finally:
+            hop.finish()
+            with self._lock:
+                del self.pending[corr_id]
+
+    async def acall(self, message: str, routing_key='orchestrator', timeout=120, headers=None):
+        """
+        Same as call, but waits for the reply without blocking the event loop and
+        returns the headers of the reply along with it.
+        """
+        if not self._connected.is_set():
+            if not await asyncio.to_thread(self._connected.wait, timeout):
+                raise Exception("RabbitMQ not connected")
+        corr_id = str(uuid.uuid4())
+        hop = self.start_hop(routing_key, corr_id)
+        reply = FutureReply(asyncio.get_running_loop())
         with self._lock:
-            self.response = None
-            self.corr_id = str(uuid.uuid4())
-            self.channel.basic_publish(
-                exchange='',
-                routing_key='orchestrator',
-                properties=pika.BasicProperties(
-                    reply_to=self.callback_queue,
-                    correlation_id=self.corr_id,
-                    delivery_mode=pika.DeliveryMode.Persistent
-                ),
-                body=message
-            )
-            # Wait for response
-            start = time.time()
-            while self.response is None and (time.time() - start) < timeout:
-                time.sleep(0.01)
-            if self.response is None:
+            self.pending[corr_id] = reply
+        try:
+            self.publish(message, routing_key, corr_id, timeout, trace_log.outgoing_headers(headers, hop))
+            try:
+                body, reply_headers = await asyncio.wait_for(reply.future, timeout)
+            except asyncio.TimeoutError:
                 raise TimeoutError("No response from RPC call")
-            return self.response
+            return body, reply_headers
+        finally:
+            hop.finish()
+            with self._lock:
+                del self.pending[corr_id]
+
+    def stream(self, message: str, routing_key: str, timeout=120, headers=None):
+        """
+        Yields the replies of a streamed request until one has the final header set.
+        The timeout applies to the wait for each reply.
+        """
+        corr_id = str(uuid.uuid4())
+        hop = self.start_hop(routing_key, corr_id)
+        replies = queue.Queue()
+        with self._lock:
+            self.pending[corr_id] = replies
+        try:
+            self.publish(message, routing_key, corr_id, timeout, trace_log.outgoing_headers(headers, hop))
+            while True:
+                try:
+                    body, reply_headers = replies.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError("No response from RPC call")
+                yield body
+                if reply_headers.get("final", True):
+                    return
+        finally:
+            hop.finish()
+            with self._lock:
+                del self.pending[corr_id]
 
     def close(self):
         self._closing = True
@@ -109,11 +234,19 @@ class RabbitManager:
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    app.state.loop_monitor = loop_monitor.LoopMonitor("api-gateway", "http")
+    app.state.loop_monitor.start()
     app.state.rabbit_manager = RabbitManager()
+    loop_monitor.register_gauge("rpc_pending_replies", "Requests waiting for their reply.", lambda: len(app.state.rabbit_manager.pending))
+    app.state.scheduler = FairScheduler.from_env()
+    app.state.question_cache = QuestionCache()
     yield
     app.state.rabbit_manager.close()
+    app.state.loop_monitor.stop()
 
 app = FastAPI(lifespan=lifespan)
+app.include_router(profiler.router)
+app.include_router(loop_monitor.router)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -122,26 +255,280 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-logfire.instrument_fastapi(app, capture_headers=True)
+if LOGFIRE_TOKEN:
+    logfire.instrument_fastapi(app, capture_headers=True)
+
+def check_admin(request: Request, queue_name: str):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if request.headers.get("x-admin-token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+    if queue_name not in SERVICE_QUEUES:
+        raise HTTPException(status_code=404, detail=f"Unknown queue '{queue_name}'")
+
+def dead_letter_entry(properties, body):
+    headers = properties.headers or {}
+    return {
+        "correlation_id": properties.correlation_id,
+        "reply_to": properties.reply_to,
+        "retries": headers.get("x-retry-count"),
+        "redeliveries": headers.get("x-redelivery-count"),
+        "error": headers.get("x-error"),
+        "headers": {key: str(value) for key, value in headers.items()},
+        "body": body.decode(errors="replace"),
+    }
+
+def read_dead_letters(queue_name: str, limit: int, replay: bool):
+    """
+    Reads up to limit messages from the dead-letter queue of a service. Messages are
+    put back unless replay is set, then they are published to the service queue again
+    with fresh retry and redelivery counts.
+    """
+    connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+    try:
+        channel = connection.channel()
+        channel.queue_declare(queue=f"{queue_name}.dlq", durable=True)
+        entries = []
+        for _ in range(limit):
+            method, properties, body = channel.basic_get(queue=f"{queue_name}.dlq")
+            if method is None:
+                break
+            entries.append(dead_letter_entry(properties, body))
+            if replay:
+                headers = {key: value for key, value in (properties.headers or {}).items()
+                           if key not in ("x-retry-count", "x-redelivery-count", "x-error", "x-original-queue")}
+                channel.basic_publish(exchange='',
+                                      routing_key=queue_name,
+                                      body=body,
+                                      properties=pika.BasicProperties(
+                                          reply_to=properties.reply_to,
+                                          correlation_id=properties.correlation_id,
+                                          message_id=properties.message_id,
+                                          delivery_mode=pika.DeliveryMode.Persistent,
+                                          headers=headers,
+                                      ))
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+        # messages that were only inspected are requeued when the channel closes
+        return entries
+    finally:
+        connection.close()
 
 class QuestionModel(BaseModel):
     text: str
 
+class BatchModel(BaseModel):
+    questions: List[str]
+    concurrency: Optional[int] = None
+
+def resolve_tenant(request: Request):
+    """
+    Returns the tenant of a request. With TENANT_API_KEYS set it is taken from the
+    API key only, which has to be a known one, otherwise from the X-Tenant-Id header.
+    """
+    if TENANT_API_KEYS:
+        api_key = request.headers.get("x-api-key")
+        if api_key not in TENANT_API_KEYS:
+            raise HTTPException(status_code=401, detail="Missing or unknown API key")
+        return TENANT_API_KEYS[api_key]
+    return request.headers.get("x-tenant-id") or DEFAULT_TENANT
+
+def routing_headers(request: Request, tenant: str, headers: dict = None):
+    """
+    The tenant and, when the client sends an X-Session-Id, the session of a request,
+    affinity routing keeps the requests of a session on the same replicas.
+    """
+    headers = {**(headers or {}), affinity.TENANT_HEADER: tenant}
+    session = request.headers.get(affinity.SESSION_HEADER)
+    if session:
+        headers[affinity.SESSION_HEADER] = session
+    return headers
+
+def admit(request: Request, tenant: str, tokens: int):
+    try:
+        request.app.state.scheduler.admit(tenant, tokens)
+    except QuotaExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+def budget_headers(headers: dict, seconds: float = BUDGET_SECONDS):
+    """
+    Attaches a fresh budget to the headers of a request, the services it passes
+    through stop and answer with what they have once it is spent.
+    """
+    request_budget = budget.Budget(
+        tokens=BUDGET_TOKENS or None,
+        tool_calls=BUDGET_TOOL_CALLS or None,
+        deadline=time.time() + seconds if seconds else None,
+    )
+    return request_budget.headers(headers)
+
+def cacheable(answer: bytes, reply_headers: dict):
+    # failed runs come back as "Error ..." text and answers cut short by the budget are marked, those should be asked again
+    return not answer.lstrip().startswith(b"Error") and not reply_headers.get(budget.TRUNCATED_HEADER)
+
+async def scheduled_stream(scheduler: FairScheduler, tenant: str, cost: int, chunks):
+    """
+    Waits for a dispatch slot of the tenant and holds it while the chunks are streamed,
+    charging the streamed output to the tenant's quota.
+    """
+    async with scheduler.slot(tenant, cost):
+        async for chunk in iterate_in_threadpool(chunks):
+            scheduler.charge(tenant, estimate_tokens(chunk))
+            yield chunk
+
 @app.head("/")
+@app.api_route("/live", methods=["GET", "HEAD"])
 async def health_check():
     """
     Health check endpoint.
     """
     return {"status": "ok"}
 
+@app.api_route("/ready", methods=["GET", "HEAD"])
+async def readiness_check(request: Request):
+    """
+    Readiness check endpoint, ready once the reply queue is consumed.
+    """
+    checks = {"broker": request.app.state.rabbit_manager._connected.is_set()}
+    ready = all(checks.values())
+    return JSONResponse({"status": "ready" if ready else "not ready", "checks": checks}, status_code=200 if ready else 503)
+
 @app.post('/route')
 async def route(request: Request, question: QuestionModel):
     if not question:
         raise HTTPException(status_code=400, detail="Question is required")
 
+    tenant = resolve_tenant(request)
+    question_cache = request.app.state.question_cache
+    cached = question_cache.get(tenant, question.text)
+    if cached is not None:
+        return cached
+
+    cost = estimate_tokens(question.text)
+    admit(request, tenant, cost)
+    scheduler = request.app.state.scheduler
     try:
-        response = request.app.state.rabbit_manager.call(question.text)
+        async with scheduler.slot(tenant, cost):
+            # large generator answers come back as references to the blob store
+            response, reply_headers = await request.app.state.rabbit_manager.acall(question.text, headers=budget_headers(routing_headers(request, tenant)))
+            response = blob_store.expand(response)
+        scheduler.charge(tenant, estimate_tokens(response))
+        if cacheable(response, reply_headers):
+            question_cache.put(tenant, question.text, response)
         return response
 
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal Server Error")
+
+@app.post('/route/batch')
+async def route_batch(request: Request, batch: BatchModel):
+    """
+    Routes a batch of questions concurrently and streams every result as an NDJSON line
+    tagged with the index of its question, in the order they complete.
+    """
+    if not batch.questions:
+        raise HTTPException(status_code=400, detail="Questions are required")
+    if len(batch.questions) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {BATCH_MAX_SIZE} questions")
+
+    tenant = resolve_tenant(request)
+    admit(request, tenant, sum(estimate_tokens(text) for text in batch.questions))
+    rabbit_manager = request.app.state.rabbit_manager
+    scheduler = request.app.state.scheduler
+    question_cache = request.app.state.question_cache
+    concurrency = max(1, min(batch.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
+
+    async def results():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def ask(index, text):
+            async with semaphore:
+                try:
+                    response = question_cache.get(tenant, text)
+                    if response is None:
+                        async with scheduler.slot(tenant, estimate_tokens(text)):
+                            response, reply_headers = await rabbit_manager.acall(text, headers=budget_headers(routing_headers(request, tenant)))
+                            response = blob_store.expand(response)
+                        scheduler.charge(tenant, estimate_tokens(response))
+                        if cacheable(response, reply_headers):
+                            question_cache.put(tenant, text, response)
+                    return {"index": index, "response": response.decode(errors="replace")}
+                except Exception as e:
+                    return {"index": index, "error": str(e)}
+
+        tasks = [asyncio.ensure_future(ask(index, text)) for index, text in enumerate(batch.questions)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield (json.dumps(await task) + "\n").encode()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+@app.post('/project')
+async def project(request: Request, question: QuestionModel, format: str = "ndjson"):
+    """
+    Generates a multi-file project and streams it back as NDJSON events or as a zip archive.
+    """
+    if format not in ("ndjson", "zip"):
+        raise HTTPException(status_code=400, detail="Format must be ndjson or zip")
+
+    tenant = resolve_tenant(request)
+    cost = estimate_tokens(question.text)
+    admit(request, tenant, cost)
+    events = request.app.state.rabbit_manager.stream(
+        question.text, routing_key='software-generator', headers=budget_headers(routing_headers(request, tenant, {"mode": "project"}), BUDGET_STREAM_SECONDS)
+    )
+    scheduler = request.app.state.scheduler
+    if format == "zip":
+        return StreamingResponse(
+            scheduled_stream(scheduler, tenant, cost, iter_zip(events)),
+            media_type="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="project.zip"'},
+        )
+    return StreamingResponse(scheduled_stream(scheduler, tenant, cost, iter_ndjson(events)), media_type="application/x-ndjson")
+
+def iter_document_text(events):
+    for body in events:
+        event = json.loads(body)
+        if event["type"] == "section":
+            yield (event["text"] + "\n\n").encode()
+        elif event["type"] == "error":
+            raise RuntimeError(event["message"])
+
+@app.post('/document')
+async def document(request: Request, question: QuestionModel, format: str = "ndjson"):
+    """
+    Generates a long document section by section and streams the sections back in order.
+    """
+    if format not in ("ndjson", "text"):
+        raise HTTPException(status_code=400, detail="Format must be ndjson or text")
+
+    tenant = resolve_tenant(request)
+    cost = estimate_tokens(question.text)
+    admit(request, tenant, cost)
+    events = request.app.state.rabbit_manager.stream(
+        question.text, routing_key='language-generator', headers=budget_headers(routing_headers(request, tenant, {"mode": "longform"}), BUDGET_STREAM_SECONDS)
+    )
+    scheduler = request.app.state.scheduler
+    if format == "text":
+        return StreamingResponse(scheduled_stream(scheduler, tenant, cost, iter_document_text(events)), media_type="text/plain")
+    return StreamingResponse(scheduled_stream(scheduler, tenant, cost, iter_ndjson(events)), media_type="application/x-ndjson")
+
+@app.get('/admin/dlq/{queue_name}')
+async def inspect_dead_letters(request: Request, queue_name: str, limit: int = 20):
+    """
+    Lists the messages in the dead-letter queue of a service without removing them.
+    """
+    check_admin(request, queue_name)
+    entries = await asyncio.to_thread(read_dead_letters, queue_name, max(1, min(limit, 1000)), False)
+    return {"queue": f"{queue_name}.dlq", "messages": entries}
+
+@app.post('/admin/dlq/{queue_name}/replay')
+async def replay_dead_letters(request: Request, queue_name: str, limit: int = 20):
+    """
+    Moves messages from the dead-letter queue of a service back to the service queue.
+    """
+    check_admin(request, queue_name)
+    entries = await asyncio.to_thread(read_dead_letters, queue_name, max(1, min(limit, 1000)), True)
+    return {"queue": f"{queue_name}.dlq", "replayed": len(entries), "messages": entries}
@@ -0,0 +1,63 @@
+import json
+import time
+import zipfile
+
+class _ChunkSink:
+    """
+    Write-only, non-seekable file object that hands written bytes back to the
+    caller, which makes zipfile stream entries with data descriptors.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_ndjson(events):
+    for body in events:
+        yield body + b"\n"
+
+def iter_zip(events):
+    """
+    Builds a zip archive from streamed project events and yields it piece by
+    piece while the files are still being generated.
+    """
+    sink = _ChunkSink()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+    entry = None
+    for body in events:
+        event = json.loads(body)
+        if event["type"] == "file_start":
+            info = zipfile.ZipInfo(event["path"], date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            entry = archive.open(info, mode="w", force_zip64=True)
+        elif event["type"] == "chunk" and entry is not None:
+            entry.write(event["data"].encode())
+        elif event["type"] == "file_end" and entry is not None:
+            entry.close()
+            entry = None
+        elif event["type"] == "manifest":
+            archive.writestr("manifest.json", json.dumps(event["files"], indent=2))
+        elif event["type"] == "error":
+            raise RuntimeError(event["message"])
+        data = sink.drain()
+        if data:
+            yield data
+    if entry is not None:
+        entry.close()
+    archive.close()
+    yield sink.drain()
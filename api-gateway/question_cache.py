@@ -0,0 +1,126 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+QUESTION_CACHE_SIZE = int(os.getenv("QUESTION_CACHE_SIZE", "1024"))
+QUESTION_CACHE_THRESHOLD = float(os.getenv("QUESTION_CACHE_THRESHOLD", "0.8"))
+QUESTION_CACHE_MAX_BYTES = int(os.getenv("QUESTION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# words that don't change what is asked, "write a python fizzbuzz" and "Write Python FizzBuzz please" are the same question
+FILLER_WORDS = {"a", "an", "the", "please", "pls", "can", "could", "would", "you", "me", "for", "i", "want", "to", "some"}
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+def normalize(question: str):
+    words = WORD_PATTERN.findall(question.lower())
+    kept = [word for word in words if word not in FILLER_WORDS]
+    return " ".join(kept or words)
+
+def numbers(question: str):
+    # "fizzbuzz up to 100" and "fizzbuzz up to 200" are near-duplicates as text but different questions
+    return tuple(sorted(set(re.findall(r"\d+", question))))
+
+def shingles(text: str, size: int = 3):
+    if len(text) <= size:
+        return {text}
+    return {text[index:index + size] for index in range(len(text) - size + 1)}
+
+class QuestionCache:
+    """
+    Caches answers by question and finds near-duplicate questions with MinHash
+    signatures over character shingles of the normalized question. An LSH index
+    over bands of the signature finds candidates, a candidate is a hit when the
+    estimated Jaccard similarity reaches the threshold. Entries are evicted in
+    LRU order when the cache holds more than max_entries or max_bytes of answers.
+    Only questions of the same tenant with the same numbers in them are compared.
+    """
+    def __init__(self, max_entries: int = QUESTION_CACHE_SIZE, threshold: float = QUESTION_CACHE_THRESHOLD,
+                 max_bytes: int = QUESTION_CACHE_MAX_BYTES, bands: int = 16, rows: int = 4):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.bands = bands
+        self.rows = rows
+        self.entries = OrderedDict()
+        self.buckets = {}
+        self.size = 0
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def signature(self, question: str):
+        """
+        One permutation MinHash: every shingle hash goes to one of the slots and
+        each slot keeps its minimum. Empty slots borrow the value of the next
+        filled slot with the distance attached, so short questions still
+        compare well.
+        """
+        size = self.bands * self.rows
+        slots = [None] * size
+        for shingle in shingles(normalize(question)):
+            value = hash(shingle) & 0xFFFFFFFFFFFFFFFF
+            slot, rest = value % size, value // size
+            if slots[slot] is None or rest < slots[slot]:
+                slots[slot] = rest
+        signature = []
+        for index in range(size):
+            distance = 0
+            while slots[(index + distance) % size] is None:
+                distance += 1
+            signature.append((slots[(index + distance) % size], distance))
+        return tuple(signature)
+
+    def band_keys(self, tenant: str, question: str, signature):
+        scope = (tenant, numbers(question))
+        return [
+            (scope, band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)
+        ]
+
+    def get(self, tenant: str, question: str):
+        """
+        Returns the answer of the most similar cached question of the tenant, or None.
+        """
+        if self.max_entries <= 0:
+            return None
+        signature = self.signature(question)
+        with self.lock:
+            candidates = set()
+            for key in self.band_keys(tenant, question, signature):
+                candidates.update(self.buckets.get(key, ()))
+            best, best_similarity = None, self.threshold
+            for entry_id in candidates:
+                entry_signature = self.entries[entry_id][0]
+                similarity = sum(x == y for x, y in zip(signature, entry_signature)) / len(signature)
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best)
+            return self.entries[best][1]
+
+    def put(self, tenant: str, question: str, answer: bytes):
+        if self.max_entries <= 0 or len(answer) > self.max_bytes:
+            return
+        signature = self.signature(question)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            keys = self.band_keys(tenant, question, signature)
+            self.entries[entry_id] = (signature, answer, keys)
+            self.size += len(answer)
+            for key in keys:
+                self.buckets.setdefault(key, set()).add(entry_id)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entry_id, (_, answer, keys) = self.entries.popitem(last=False)
+        self.size -= len(answer)
+        for key in keys:
+            bucket = self.buckets[key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self.buckets[key]
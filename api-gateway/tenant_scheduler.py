@@ -0,0 +1,185 @@
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+
+# seconds between sweeps of the quotas of idle tenants
+QUOTA_SWEEP_INTERVAL = 60
+
+def parse_mapping(value: str):
+    """
+    Parses "a=1,b=2" style settings into a dict.
+    """
+    mapping = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            key, _, mapped = item.partition("=")
+            mapping[key.strip()] = mapped.strip()
+    return mapping
+
+def estimate_tokens(text):
+    # roughly four characters per token, works for str and bytes
+    return len(text) // 4 + 1
+
+class QuotaExceeded(Exception):
+    def __init__(self, tenant: str, retry_after: float):
+        super().__init__(f"Token quota exceeded for tenant '{tenant}'")
+        self.tenant = tenant
+        self.retry_after = retry_after
+
+class TokenQuota:
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def retry_after(self, tokens: int):
+        self.refill()
+        missing = min(tokens, self.capacity) - self.available
+        return max(0.0, missing * 60 / self.capacity)
+
+    def charge(self, tokens: int):
+        self.refill()
+        self.available -= tokens
+
+    def full(self):
+        self.refill()
+        return self.available >= self.capacity
+
+class Waiter:
+    def __init__(self, tenant: str, start: float, finish: float, future):
+        self.tenant = tenant
+        self.start = start
+        self.finish = finish
+        self.future = future
+
+class FairScheduler:
+    """
+    Weighted fair queuing of requests over tenants. Every request gets a
+    virtual finish time of start + cost / weight and free dispatch slots go to
+    the waiting request with the smallest finish time, skipping tenants that
+    are at their concurrency limit. Tenants also get a token quota per minute,
+    checked with admit before a request is queued.
+    """
+    def __init__(self, max_inflight: int, tenant_concurrency: int, weights=None, tokens_per_minute: int = 0):
+        self.max_inflight = max_inflight
+        self.tenant_concurrency = tenant_concurrency
+        self.weights = weights or {}
+        self.tokens_per_minute = tokens_per_minute
+        self.inflight = 0
+        self.tenant_inflight = defaultdict(int)
+        self.queues = defaultdict(deque)
+        self.last_finish = {}
+        self.quotas = {}
+        self.last_sweep = time.monotonic()
+        self.virtual_time = 0.0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_inflight=int(os.getenv("GATEWAY_MAX_INFLIGHT", "16")),
+            tenant_concurrency=int(os.getenv("TENANT_MAX_CONCURRENCY", "4")),
+            weights={tenant: float(weight) for tenant, weight in parse_mapping(os.getenv("TENANT_WEIGHTS")).items()},
+            tokens_per_minute=int(os.getenv("TENANT_TOKENS_PER_MINUTE", "0")),
+        )
+
+    def weight(self, tenant: str):
+        return max(self.weights.get(tenant, 1.0), 0.001)
+
+    def quota(self, tenant: str):
+        if not self.tokens_per_minute:
+            return None
+        self._sweep_quotas()
+        if tenant not in self.quotas:
+            self.quotas[tenant] = TokenQuota(self.tokens_per_minute)
+        return self.quotas[tenant]
+
+    def _sweep_quotas(self):
+        # a full quota is the same as a new one, tenants that send a new id each time don't pile up
+        now = time.monotonic()
+        if now - self.last_sweep < QUOTA_SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        for tenant in [tenant for tenant, quota in self.quotas.items() if quota.full()]:
+            del self.quotas[tenant]
+
+    def charge(self, tenant: str, tokens: int):
+        quota = self.quota(tenant)
+        if quota is not None:
+            quota.charge(tokens)
+
+    def admit(self, tenant: str, tokens: int):
+        """
+        Charges the tokens to the tenant's quota, raises QuotaExceeded when
+        the quota has no room for them.
+        """
+        quota = self.quota(tenant)
+        if quota is not None:
+            retry_after = quota.retry_after(tokens)
+            if retry_after > 0:
+                raise QuotaExceeded(tenant, retry_after)
+            quota.charge(tokens)
+
+    async def acquire(self, tenant: str, cost: int):
+        start = max(self.virtual_time, self.last_finish.get(tenant, 0.0))
+        finish = start + cost / self.weight(tenant)
+        self.last_finish[tenant] = finish
+        waiter = Waiter(tenant, start, finish, asyncio.get_running_loop().create_future())
+        self.queues[tenant].append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(tenant)
+            else:
+                self.queues[tenant].remove(waiter)
+            raise
+
+    def release(self, tenant: str):
+        self.inflight -= 1
+        self.tenant_inflight[tenant] -= 1
+        if not self.tenant_inflight[tenant]:
+            del self.tenant_inflight[tenant]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.inflight < self.max_inflight:
+            best = None
+            for tenant, waiting in self.queues.items():
+                if waiting and self.tenant_inflight.get(tenant, 0) < self.tenant_concurrency:
+                    if best is None or waiting[0].finish < best.finish:
+                        best = waiting[0]
+            if best is None:
+                break
+            self.queues[best.tenant].popleft()
+            self.inflight += 1
+            self.tenant_inflight[best.tenant] += 1
+            self.virtual_time = max(self.virtual_time, best.start)
+            best.future.set_result(None)
+
+        # forget idle tenants, they restart at the current virtual time anyway
+        for tenant in [tenant for tenant, waiting in self.queues.items() if not waiting]:
+            del self.queues[tenant]
+        if not self.queues and not self.inflight:
+            # nothing is waiting or running, every tenant starts from here
+            self.virtual_time = max([self.virtual_time, *self.last_finish.values()])
+            self.last_finish.clear()
+            return
+        for tenant in [tenant for tenant, finish in self.last_finish.items() if finish <= self.virtual_time]:
+            if tenant not in self.queues and tenant not in self.tenant_inflight:
+                del self.last_finish[tenant]
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, cost: int):
+        await self.acquire(tenant, cost)
+        try:
+            yield
+        finally:
+            self.release(tenant)
@@ -0,0 +1,261 @@
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from collections import defaultdict
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+# an OpenAI compatible model server for soak tests, answers instantly unless faults are injected
+FAKE_MODELS = os.getenv("FAKE_MODELS", "gpt-4o-mini,gpt-4o-2024-05-13,gpt-4.1-mini").split(",")
+FAKE_OUTPUT_WORDS = int(os.getenv("FAKE_OUTPUT_WORDS", "40"))
+FAKE_RPM_LIMIT = int(os.getenv("FAKE_RPM_LIMIT", "10000"))
+FAKE_TPM_LIMIT = int(os.getenv("FAKE_TPM_LIMIT", "10000000"))
+
+# soak requests carry a marker, answers echo it so the client can check it got its own answer
+MARKER_PATTERN = re.compile(r"soak-[0-9a-f]{12}")
+
+def default_faults():
+    return {
+        # seconds added to every call, plus a uniform random jitter
+        "latency": float(os.getenv("FAKE_LATENCY", "0.2")),
+        "latency_jitter": float(os.getenv("FAKE_LATENCY_JITTER", "0.2")),
+        # fractions of the calls that fail with a 429 or a 500
+        "rate_limit": float(os.getenv("FAKE_RATE_LIMIT", "0")),
+        "server_error": float(os.getenv("FAKE_SERVER_ERROR", "0")),
+        # fraction of the calls that hang for stall_seconds before they are answered
+        "stall": float(os.getenv("FAKE_STALL", "0")),
+        "stall_seconds": float(os.getenv("FAKE_STALL_SECONDS", "90")),
+    }
+
+class Stats:
+    def __init__(self):
+        self.started = time.time()
+        self.calls = defaultdict(int)
+        self.generations = defaultdict(int)
+
+    def record(self, endpoint: str, status: int):
+        self.calls[f"{endpoint} {status}"] += 1
+
+app = FastAPI()
+app.state.faults = default_faults()
+app.state.stats = Stats()
+
+def find_marker(text: str):
+    match = MARKER_PATTERN.search(text or "")
+    return match.group(0) if match else None
+
+def answer_text(prompt: str):
+    marker = find_marker(prompt)
+    filler = " ".join(random.choice(("lorem", "ipsum", "dolor", "sit", "amet")) for _ in range(FAKE_OUTPUT_WORDS))
+    return f"Answer to {marker or 'request'}: {filler}"
+
+def rate_limit_headers():
+    return {
+        "x-ratelimit-limit-requests": str(FAKE_RPM_LIMIT),
+        "x-ratelimit-remaining-requests": str(FAKE_RPM_LIMIT - 1),
+        "x-ratelimit-reset-requests": "6ms",
+        "x-ratelimit-limit-tokens": str(FAKE_TPM_LIMIT),
+        "x-ratelimit-remaining-tokens": str(FAKE_TPM_LIMIT - 1000),
+        "x-ratelimit-reset-tokens": "6ms",
+    }
+
+def error_response(status: int, message: str, kind: str, headers=None):
+    return JSONResponse(
+        {"error": {"message": message, "type": kind, "param": None, "code": kind}},
+        status_code=status,
+        headers=headers,
+    )
+
+async def inject_faults(endpoint: str):
+    """
+    Delays the call and returns an error response when a fault hits it, None otherwise.
+    """
+    faults = app.state.faults
+    await asyncio.sleep(faults["latency"] + random.uniform(0, faults["latency_jitter"]))
+    if random.random() < faults["stall"]:
+        await asyncio.sleep(faults["stall_seconds"])
+    if random.random() < faults["rate_limit"]:
+        app.state.stats.record(endpoint, 429)
+        headers = {**rate_limit_headers(), "x-ratelimit-remaining-requests": "0", "retry-after": "1"}
+        return error_response(429, "Rate limit reached (injected)", "rate_limit_exceeded", headers)
+    if random.random() < faults["server_error"]:
+        app.state.stats.record(endpoint, 500)
+        return error_response(500, "The server had an error (injected)", "server_error")
+    return None
+
+def responses_input_text(body):
+    value = body.get("input")
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+def response_object(model: str, text: str, status: str = "completed"):
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": status,
+        "model": model,
+        "output": [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "status": "completed",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }] if text else [],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": 100,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": len(text.split()),
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": 100 + len(text.split()),
+        },
+    }
+
+async def stream_response(model: str, text: str):
+    created = response_object(model, "", status="in_progress")
+    sequence = 0
+    yield f"event: response.created\ndata: {json.dumps({'type': 'response.created', 'sequence_number': sequence, 'response': created})}\n\n"
+    item_id = f"msg_{uuid.uuid4().hex}"
+    for word in text.split(" "):
+        sequence += 1
+        delta = {
+            "type": "response.output_text.delta", "sequence_number": sequence, "item_id": item_id,
+            "output_index": 0, "content_index": 0, "delta": word + " ", "logprobs": [],
+        }
+        yield f"event: response.output_text.delta\ndata: {json.dumps(delta)}\n\n"
+        await asyncio.sleep(0.01)
+    sequence += 1
+    completed = {"type": "response.completed", "sequence_number": sequence, "response": response_object(model, text)}
+    yield f"event: response.completed\ndata: {json.dumps(completed)}\n\n"
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    """
+    Responses API as called by the generators.
+    """
+    body = await request.json()
+    error = await inject_faults("responses")
+    if error is not None:
+        return error
+    text = answer_text(responses_input_text(body))
+    app.state.stats.record("responses", 200)
+    marker = find_marker(responses_input_text(body))
+    if marker:
+        app.state.stats.generations[marker] += 1
+    model = body.get("model", FAKE_MODELS[0])
+    if body.get("stream"):
+        return StreamingResponse(stream_response(model, text), media_type="text/event-stream", headers=rate_limit_headers())
+    return JSONResponse(response_object(model, text), headers=rate_limit_headers())
+
+def pick_tool(tools, prompt: str):
+    # the orchestrator has a tool per agent, route on the obvious words like a model would
+    names = [tool["function"]["name"] for tool in tools]
+    for word, name in (("diagram", "call_diagram_agent"), ("code", "call_software_agent"), ("software", "call_software_agent")):
+        if word in prompt.lower() and name in names:
+            return tools[names.index(name)]
+    for tool in tools:
+        if tool["function"]["name"] == "call_language_agent":
+            return tool
+    return tools[0]
+
+def tool_arguments(tool, prompt: str):
+    properties = tool["function"].get("parameters", {}).get("properties", {})
+    arguments = {}
+    for name, schema in properties.items():
+        arguments[name] = False if schema.get("type") == "boolean" else prompt
+    return json.dumps(arguments)
+
+def message_text(message):
+    content = message.get("content")
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """
+    Chat completions as called by the agents: calls the first fitting tool with the
+    user prompt and answers with the tool result once it is there.
+    """
+    body = await request.json()
+    error = await inject_faults("chat")
+    if error is not None:
+        return error
+    messages = body.get("messages", [])
+    prompt = next((message_text(message) for message in reversed(messages) if message.get("role") == "user"), "")
+    tool_results = [message_text(message) for message in messages if message.get("role") == "tool"]
+    tools = body.get("tools") or []
+
+    message = {"role": "assistant", "content": None}
+    if tools and not tool_results:
+        tool = pick_tool(tools, prompt)
+        message["tool_calls"] = [{
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": tool["function"]["name"], "arguments": tool_arguments(tool, prompt)},
+        }]
+        finish_reason = "tool_calls"
+    else:
+        message["content"] = tool_results[-1] if tool_results else answer_text(prompt)
+        finish_reason = "stop"
+
+    app.state.stats.record("chat", 200)
+    return JSONResponse({
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", FAKE_MODELS[0]),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+    }, headers=rate_limit_headers())
+
+@app.get("/v1/models")
+async def models():
+    return {
+        "object": "list",
+        "data": [{"id": model, "object": "model", "created": 0, "owned_by": "fake"} for model in FAKE_MODELS],
+    }
+
+@app.get("/faults")
+async def get_faults():
+    return app.state.faults
+
+@app.post("/faults")
+async def set_faults(request: Request):
+    """
+    Changes the injected faults, fields that are left out keep their value.
+    """
+    changes = await request.json()
+    unknown = set(changes) - set(app.state.faults)
+    if unknown:
+        return JSONResponse({"error": f"Unknown faults: {', '.join(sorted(unknown))}"}, status_code=400)
+    app.state.faults.update({key: float(value) for key, value in changes.items()})
+    return app.state.faults
+
+@app.delete("/faults")
+async def reset_faults():
+    app.state.faults = default_faults()
+    return app.state.faults
+
+@app.get("/stats")
+async def stats(markers: bool = False):
+    """
+    Call counts per endpoint and status, with markers set also the number of
+    successful generations per soak marker.
+    """
+    result = {"uptime": time.time() - app.state.stats.started, "calls": dict(app.state.stats.calls)}
+    if markers:
+        result["generations"] = dict(app.state.stats.generations)
+    return result
+
+@app.get("/live")
+async def health_check():
+    return {"status": "ok"}
@@ -0,0 +1,351 @@
+"""
+Soak test: sends questions to the api-gateway at a steady rate for hours while
+faults are injected one after another, and reports per fault how long the
+system took to recover, which requests were lost or answered twice, how the
+throughput compares to the baseline and how the memory of the containers grew.
+
+Start the stack against the fake model server first:
+
+    docker compose -f docker-compose.yaml -f chaos/docker-compose.chaos.yaml up -d --build
+    python chaos/soak.py --duration 4h --rate 0.5 --report soak-report.json
+"""
+import argparse
+import asyncio
+import json
+import re
+import shlex
+import time
+import uuid
+from collections import Counter
+import httpx
+
+FAULTS = ("broker_restart", "connection_kill", "slow_consumer", "service_restart", "upstream_429", "upstream_500")
+MARKER_PATTERN = re.compile(r"soak-[0-9a-f]{12}")
+MEMORY_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "kB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}
+
+def parse_duration(value: str):
+    units = {"s": 1, "m": 60, "h": 3600}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def parse_memory(value: str):
+    match = re.match(r"([\d.]+)\s*([A-Za-z]+)", value)
+    if not match:
+        return None
+    return float(match.group(1)) * MEMORY_UNITS.get(match.group(2), 1)
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+class Result:
+    __slots__ = ("marker", "sent", "done", "outcome")
+
+    def __init__(self, marker: str, sent: float):
+        self.marker = marker
+        self.sent = sent
+        self.done = None
+        # pending until answered, then ok, error, timeout, mismatch (someone else's answer) or shed
+        self.outcome = "pending"
+
+    @property
+    def latency(self):
+        return None if self.done is None else self.done - self.sent
+
+class Load:
+    """
+    Sends questions at a fixed rate without waiting for the answers, so a stalled
+    system builds up requests in flight instead of slowing the load down.
+    """
+    def __init__(self, client: httpx.AsyncClient, gateway: str, rate: float, timeout: float, max_inflight: int):
+        self.client = client
+        self.gateway = gateway
+        self.rate = rate
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.results = []
+        self.tasks = set()
+        self.count = 0
+
+    async def run(self, stop: asyncio.Event):
+        interval = 1.0 / self.rate
+        next_send = time.time()
+        while not stop.is_set():
+            self.send()
+            next_send += interval
+            try:
+                await asyncio.wait_for(stop.wait(), max(0.0, next_send - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    def send(self):
+        result = Result(f"soak-{uuid.uuid4().hex[:12]}", time.time())
+        self.results.append(result)
+        self.count += 1
+        if len(self.tasks) >= self.max_inflight:
+            result.done, result.outcome = result.sent, "shed"
+            return
+        task = asyncio.ensure_future(self.ask(result, f"Write a short note about item {self.count} ({result.marker})"))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def ask(self, result: Result, question: str):
+        try:
+            response = await self.client.post(f"{self.gateway}/route", json={"text": question}, timeout=self.timeout)
+            text = response.text
+            markers = set(MARKER_PATTERN.findall(text))
+            if response.status_code != 200:
+                result.outcome = "error"
+            elif result.marker in markers:
+                result.outcome = "ok"
+            elif markers:
+                result.outcome = "mismatch"
+            else:
+                result.outcome = "error"
+        except httpx.TimeoutException:
+            result.outcome = "timeout"
+        except httpx.HTTPError:
+            result.outcome = "error"
+        result.done = time.time()
+
+    async def drain(self, timeout: float):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+    def sent_between(self, start: float, end: float):
+        return [result for result in self.results if start <= result.sent < end]
+
+class Chaos:
+    """
+    Injects the faults: broker restarts and killed connections through docker
+    compose, a slow consumer by pausing its container, and upstream errors
+    through the fault settings of the fake model server.
+    """
+    def __init__(self, compose: str, client: httpx.AsyncClient, fake_openai: str, slow_target: str, restart_target: str):
+        self.compose = shlex.split(compose)
+        self.client = client
+        self.fake_openai = fake_openai
+        self.slow_target = slow_target
+        self.restart_target = restart_target
+
+    async def run(self, *args):
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        )
+        output, _ = await process.communicate()
+        if process.returncode != 0:
+            print(f"  {' '.join(args)} failed: {output.decode(errors='replace').strip()}")
+        return output.decode(errors="replace")
+
+    async def compose_run(self, *args):
+        return await self.run(*self.compose, *args)
+
+    async def inject(self, fault: str, duration: float):
+        """
+        Injects the fault and returns once it is cleared, faults that are a single
+        event are cleared as soon as they happened.
+        """
+        if fault == "broker_restart":
+            await self.compose_run("restart", "rabbitmq")
+        elif fault == "connection_kill":
+            await self.compose_run("exec", "-T", "rabbitmq", "rabbitmqctl", "close_all_connections", "soak test connection kill")
+        elif fault == "slow_consumer":
+            await self.compose_run("pause", self.slow_target)
+            await asyncio.sleep(duration)
+            await self.compose_run("unpause", self.slow_target)
+        elif fault == "service_restart":
+            await self.compose_run("restart", self.restart_target)
+        elif fault in ("upstream_429", "upstream_500"):
+            setting = "rate_limit" if fault == "upstream_429" else "server_error"
+            await self.client.post(f"{self.fake_openai}/faults", json={setting: 0.5})
+            await asyncio.sleep(duration)
+            await self.client.delete(f"{self.fake_openai}/faults")
+        else:
+            raise ValueError(f"Unknown fault '{fault}'")
+
+    async def memory(self):
+        ids = (await self.compose_run("ps", "-q")).split()
+        if not ids:
+            return {}
+        output = await self.run("docker", "stats", "--no-stream", "--format", "{{json .}}", *ids)
+        usage = {}
+        for line in output.splitlines():
+            try:
+                stats = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            usage[stats["Name"]] = parse_memory(stats["MemUsage"].split("/")[0])
+        return usage
+
+async def pending_replies(client: httpx.AsyncClient, urls):
+    """
+    Reads the number of requests waiting for a reply from /metrics, entries that stay
+    behind once the load stopped are leaked.
+    """
+    pending = {}
+    for url in urls:
+        try:
+            response = await client.get(f"{url}/metrics", timeout=5)
+            match = re.search(r"^rpc_pending_replies (\S+)$", response.text, re.MULTILINE)
+            pending[url] = float(match.group(1)) if match else None
+        except httpx.HTTPError:
+            pending[url] = None
+    return pending
+
+async def generations(client: httpx.AsyncClient, fake_openai: str):
+    try:
+        response = await client.get(f"{fake_openai}/stats", params={"markers": "true"}, timeout=30)
+        return response.json()
+    except httpx.HTTPError as e:
+        print(f"Could not read the fake model server stats: {e!r}")
+        return {"calls": {}, "generations": {}}
+
+def summarize(results, start: float, end: float, cleared: float = None, baseline_throughput: float = None, generated=None):
+    """
+    Summarizes the requests sent in a phase. Recovery is the time from clearing the
+    fault until the first request sent after it was answered.
+    """
+    outcomes = Counter(result.outcome for result in results)
+    ok = [result for result in results if result.outcome == "ok"]
+    summary = {
+        "requests": len(results),
+        "outcomes": dict(outcomes),
+        "lost": outcomes["error"] + outcomes["timeout"],
+        "latency_p50": percentile([result.latency for result in ok], 50),
+        "latency_p95": percentile([result.latency for result in ok], 95),
+    }
+    if cleared is None:
+        summary["throughput"] = len(ok) / max(1e-9, end - start)
+    else:
+        first = next((result for result in sorted(ok, key=lambda result: result.sent) if result.sent >= cleared), None)
+        summary["recovery_seconds"] = None if first is None else first.done - cleared
+        if first is not None:
+            after = [result for result in ok if result.sent >= first.sent]
+            summary["throughput_after"] = len(after) / max(1e-9, end - first.sent)
+            if baseline_throughput:
+                summary["throughput_ratio"] = summary["throughput_after"] / baseline_throughput
+    if generated is not None:
+        counts = [generated.get(result.marker, 0) for result in results]
+        # generated more than once: redelivered and processed again, or hedged
+        summary["duplicated"] = sum(1 for count in counts if count > 1)
+        # generated but never answered, the work was done and the reply got lost on the way back
+        summary["lost_after_generation"] = sum(
+            1 for result, count in zip(results, counts) if count and result.outcome in ("error", "timeout")
+        )
+    return summary
+
+def memory_growth(before, after):
+    return {name: after[name] - before[name] for name in after if before.get(name) is not None and after[name] is not None}
+
+async def main():
+    parser = argparse.ArgumentParser(description="Soak test the stack while injecting broker and upstream faults.")
+    parser.add_argument("--duration", default="1h", help="total run time, e.g. 90m or 4h")
+    parser.add_argument("--rate", type=float, default=0.5, help="questions per second")
+    parser.add_argument("--faults", default=",".join(FAULTS), help="faults to cycle through")
+    parser.add_argument("--fault-duration", default="60s", help="how long lasting faults are held")
+    parser.add_argument("--baseline", default="120s", help="time without faults measured first")
+    parser.add_argument("--settle", default="180s", help="time after a fault is cleared before the next one")
+    parser.add_argument("--timeout", type=float, default=180, help="client timeout of a request")
+    parser.add_argument("--max-inflight", type=int, default=500, help="requests in flight before new ones are shed")
+    parser.add_argument("--gateway", default="http://localhost:7999")
+    parser.add_argument("--orchestrator", default="http://localhost:8000")
+    parser.add_argument("--fake-openai", default="http://localhost:8090")
+    parser.add_argument("--compose", default="docker compose -f docker-compose.yaml -f chaos/docker-compose.chaos.yaml")
+    parser.add_argument("--slow-target", default="language-generator", help="service paused by slow_consumer")
+    parser.add_argument("--restart-target", default="language-agent", help="service restarted by service_restart")
+    parser.add_argument("--report", default="soak-report.json")
+    args = parser.parse_args()
+
+    faults = [fault.strip() for fault in args.faults.split(",") if fault.strip()]
+    unknown = set(faults) - set(FAULTS)
+    if unknown:
+        parser.error(f"unknown faults: {', '.join(sorted(unknown))}")
+    duration = parse_duration(args.duration)
+    fault_duration = parse_duration(args.fault_duration)
+    settle = parse_duration(args.settle)
+
+    async with httpx.AsyncClient() as client:
+        load = Load(client, args.gateway, args.rate, args.timeout, args.max_inflight)
+        chaos = Chaos(args.compose, client, args.fake_openai, args.slow_target, args.restart_target)
+        metric_urls = [args.gateway, args.orchestrator]
+        report = {"settings": vars(args), "memory_start": await chaos.memory(), "phases": []}
+
+        def write_report():
+            with open(args.report, "w") as file:
+                json.dump(report, file, indent=2)
+
+        stop = asyncio.Event()
+        load_task = asyncio.ensure_future(load.run(stop))
+        started = time.time()
+        print(f"Measuring the baseline for {args.baseline}...")
+        await asyncio.sleep(parse_duration(args.baseline))
+        report["baseline"] = {"start": started, "end": time.time()}
+
+        index = 0
+        while time.time() - started + fault_duration + settle < duration:
+            fault = faults[index % len(faults)]
+            index += 1
+            phase = {"fault": fault, "start": time.time()}
+            print(f"[{phase['start'] - started:8.0f}s] injecting {fault}")
+            await chaos.inject(fault, fault_duration)
+            phase["cleared"] = time.time()
+            await asyncio.sleep(settle)
+            phase["end"] = time.time()
+            phase["memory"] = await chaos.memory()
+            phase["pending_replies"] = await pending_replies(client, metric_urls)
+            report["phases"].append(phase)
+            phase_results = load.sent_between(phase["start"], phase["end"])
+            outcomes = Counter(result.outcome for result in phase_results)
+            print(f"           {len(phase_results)} requests, {dict(outcomes)}")
+            write_report()
+
+        remaining = duration - (time.time() - started)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        stop.set()
+        await load_task
+        print(f"Waiting up to {args.timeout:.0f}s for the requests in flight...")
+        await load.drain(args.timeout)
+        await asyncio.sleep(5)
+        report["memory_end"] = await chaos.memory()
+        report["pending_replies_end"] = await pending_replies(client, metric_urls)
+        stats = await generations(client, args.fake_openai)
+
+    generated = stats.get("generations", {})
+    report["upstream_calls"] = stats.get("calls", {})
+    baseline = report["baseline"]
+    baseline_summary = summarize(load.sent_between(baseline["start"], baseline["end"]), baseline["start"], baseline["end"], generated=generated)
+    report["baseline"].update(baseline_summary)
+    for phase in report["phases"]:
+        phase.update(summarize(
+            load.sent_between(phase["start"], phase["end"]), phase["start"], phase["end"],
+            cleared=phase["cleared"], baseline_throughput=baseline_summary["throughput"], generated=generated,
+        ))
+    report["total"] = summarize(load.results, started, time.time(), generated=generated)
+    report["memory_growth"] = memory_growth(report["memory_start"], report["memory_end"])
+    write_report()
+
+    print(f"\nBaseline: {baseline_summary['throughput']:.2f} answers/s, p50 {baseline_summary['latency_p50'] or 0:.1f}s")
+    print(f"{'fault':<18}{'requests':>9}{'lost':>6}{'dup':>5}{'mismatch':>9}{'recovery s':>12}{'throughput':>12}")
+    for phase in report["phases"]:
+        recovery = phase.get("recovery_seconds")
+        ratio = phase.get("throughput_ratio")
+        print(
+            f"{phase['fault']:<18}{phase['requests']:>9}{phase['lost']:>6}{phase['duplicated']:>5}"
+            f"{phase['outcomes'].get('mismatch', 0):>9}"
+            f"{'never' if recovery is None else f'{recovery:.1f}':>12}"
+            f"{'-' if ratio is None else f'{ratio:.0%}':>12}"
+        )
+    total = report["total"]
+    print(f"\nTotal: {total['requests']} requests, {total['lost']} lost, {total['duplicated']} duplicated, "
+          f"{total['lost_after_generation']} lost after generation")
+    print(f"Pending replies after the load stopped: {report['pending_replies_end']}")
+    for name, growth in sorted(report["memory_growth"].items(), key=lambda item: -item[1]):
+        print(f"  {name:<32}{growth / 1024 ** 2:+10.1f} MiB")
+    print(f"Report written to {args.report}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+import contextvars
+import os
+import socket
+import uuid
+
+# AFFINITY_ROUTING=true sends the messages of a session to the same replica of a service
+AFFINITY_ROUTING = os.getenv("AFFINITY_ROUTING", "false").lower() in ("1", "true", "yes")
+# message headers that key the routing, the first one a message carries is used
+AFFINITY_KEYS = [key.strip().lower() for key in os.getenv("AFFINITY_KEYS", "x-session-id").split(",") if key.strip()]
+# share of the hash ring a replica takes, relative to the other replicas
+AFFINITY_WEIGHT = int(os.getenv("AFFINITY_WEIGHT", "10"))
+# seconds a message waits in the queue of its replica before it moves to the shared queue
+AFFINITY_MAX_WAIT = float(os.getenv("AFFINITY_MAX_WAIT", "30"))
+# seconds without a consumer after which the queue of a replica that left is deleted, longer than the wait
+AFFINITY_QUEUE_EXPIRES = float(os.getenv("AFFINITY_QUEUE_EXPIRES", "120"))
+
+SESSION_HEADER = "x-session-id"
+TENANT_HEADER = "x-tenant-id"
+
+current_headers = contextvars.ContextVar("affinity_headers", default=None)
+
+def exchange(queue: str):
+    return f"{queue}.affinity"
+
+def shared_exchange(queue: str):
+    return f"{queue}.shared"
+
+def replica_queue(queue: str):
+    return f"{queue}.{socket.gethostname()}"
+
+def declare_exchange(channel, queue: str):
+    """
+    Declares the consistent hash exchange of a queue. Messages it can't route,
+    because no replica is bound yet, go to the shared queue through its alternate exchange.
+    Works on blocking and asynchronous channels, the broker handles the declares in order.
+    """
+    channel.exchange_declare(exchange=shared_exchange(queue), exchange_type="fanout", durable=True)
+    channel.exchange_declare(
+        exchange=exchange(queue), exchange_type="x-consistent-hash", durable=True,
+        arguments={"alternate-exchange": shared_exchange(queue)},
+    )
+
+def declare_exchanges(channel, queues):
+    if AFFINITY_ROUTING:
+        for queue in queues:
+            declare_exchange(channel, queue)
+
+def consume(channel, queue: str, on_message_callback):
+    """
+    Consumes the shared queue of a service and, with affinity routing, the queue of
+    this replica, which is bound to the hash ring of the service. A message that
+    waited AFFINITY_MAX_WAIT there, e.g. because the replica is busy or gone, is
+    dead-lettered into the shared queue where any replica takes it.
+    """
+    channel.basic_consume(queue=queue, on_message_callback=on_message_callback)
+    if not AFFINITY_ROUTING:
+        return
+    declare_exchange(channel, queue)
+    channel.queue_bind(queue=queue, exchange=shared_exchange(queue))
+    channel.queue_declare(queue=replica_queue(queue), durable=True, arguments={
+        "x-message-ttl": int(AFFINITY_MAX_WAIT * 1000),
+        "x-expires": int(AFFINITY_QUEUE_EXPIRES * 1000),
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": queue,
+    })
+    # the binding key of a consistent hash exchange is the weight of the queue
+    channel.queue_bind(queue=replica_queue(queue), exchange=exchange(queue), routing_key=str(AFFINITY_WEIGHT))
+    channel.basic_consume(queue=replica_queue(queue), on_message_callback=on_message_callback)
+    print(f"Consuming '{replica_queue(queue)}' for sessions hashed to this replica.")
+
+def leave(channel, queue: str):
+    """
+    Takes this replica off the hash ring, new sessions of its share go to the
+    others and what is left in its queue moves to the shared queue. Has to run on the connection thread.
+    """
+    if not AFFINITY_ROUTING or not channel.is_open:
+        return
+    try:
+        channel.queue_unbind(queue=replica_queue(queue), exchange=exchange(queue), routing_key=str(AFFINITY_WEIGHT))
+    except Exception as e:
+        print(f"Error leaving the hash ring of '{queue}': {e!r}")
+
+def start(properties):
+    """
+    Keeps the routing headers of the message for the messages the running task sends on.
+    """
+    headers = properties.headers or {}
+    current_headers.set({key: headers[key] for key in (SESSION_HEADER, TENANT_HEADER, *AFFINITY_KEYS) if key in headers})
+
+def outgoing_headers(headers=None):
+    return {**(current_headers.get() or {}), **(headers or {})}
+
+def target(queue: str, headers=None):
+    """
+    The exchange and routing key to publish a message for the queue with.
+    Messages without a routing key are spread at random.
+    """
+    if not AFFINITY_ROUTING:
+        return "", queue
+    headers = headers or {}
+    key = next((headers[key] for key in AFFINITY_KEYS if headers.get(key)), None)
+    return exchange(queue), str(key or uuid.uuid4())
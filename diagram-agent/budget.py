@@ -0,0 +1,172 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+
+# every hop hands its children a slightly earlier deadline, so it still has time to answer with what it got
+BUDGET_DEADLINE_MARGIN = float(os.getenv("BUDGET_DEADLINE_MARGIN", "2"))
+
+TOKENS_HEADER = "x-budget-tokens"
+TOOL_CALLS_HEADER = "x-budget-tool-calls"
+DEADLINE_HEADER = "x-budget-deadline"
+USED_TOKENS_HEADER = "x-budget-used-tokens"
+USED_TOOL_CALLS_HEADER = "x-budget-used-tool-calls"
+# set on replies that are cut short by the budget, they must not be cached as a full answer
+TRUNCATED_HEADER = "x-truncated"
+
+current_budget = contextvars.ContextVar("current_budget", default=None)
+
+class BudgetExhausted(Exception):
+    pass
+
+def parse_number(value, kind):
+    try:
+        return None if value is None else kind(value)
+    except (TypeError, ValueError):
+        return None
+
+class Budget:
+    """
+    What a request may still spend in this service and everything it calls:
+    tokens, tool calls and the unix time by which the answer is due. None means
+    unlimited. Spending is counted here and sent back with the reply, so the
+    caller can charge what its children used.
+    """
+    def __init__(self, tokens: int = None, tool_calls: int = None, deadline: float = None):
+        self.tokens = tokens
+        self.tool_calls = tool_calls
+        self.deadline = deadline
+        self.used_tokens = 0
+        self.used_tool_calls = 0
+        # answers of the downstream calls, together the best answer when the budget runs out early
+        self.results = []
+        # the answer is cut short, here or in a downstream call
+        self.truncated = False
+        # tools run on worker threads
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_headers(cls, headers):
+        headers = headers or {}
+        return cls(
+            tokens=parse_number(headers.get(TOKENS_HEADER), int),
+            tool_calls=parse_number(headers.get(TOOL_CALLS_HEADER), int),
+            deadline=parse_number(headers.get(DEADLINE_HEADER), float),
+        )
+
+    def remaining_tokens(self):
+        return None if self.tokens is None else max(0, self.tokens - self.used_tokens)
+
+    def remaining_tool_calls(self):
+        return None if self.tool_calls is None else max(0, self.tool_calls - self.used_tool_calls)
+
+    def remaining_seconds(self):
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def check(self):
+        if self.tokens is not None and self.remaining_tokens() <= 0:
+            raise BudgetExhausted("token budget exhausted")
+        if self.deadline is not None and self.remaining_seconds() <= 0:
+            raise BudgetExhausted("time budget exhausted")
+
+    def charge(self, tokens: int = 0, tool_calls: int = 0):
+        with self.lock:
+            self.used_tokens += tokens
+            self.used_tool_calls += tool_calls
+
+    def start_tool_call(self):
+        """
+        Counts a call to a downstream service, raises BudgetExhausted when none are left.
+        """
+        self.check()
+        with self.lock:
+            if self.tool_calls is not None and self.used_tool_calls >= self.tool_calls:
+                raise BudgetExhausted("tool call budget exhausted, answer with the results you have")
+            self.used_tool_calls += 1
+
+    def headers(self, headers=None):
+        """
+        Adds what is left of the budget to the headers of a downstream call.
+        """
+        headers = dict(headers or {})
+        if self.tokens is not None:
+            headers[TOKENS_HEADER] = self.remaining_tokens()
+        if self.tool_calls is not None:
+            headers[TOOL_CALLS_HEADER] = self.remaining_tool_calls()
+        if self.deadline is not None:
+            headers[DEADLINE_HEADER] = self.deadline - BUDGET_DEADLINE_MARGIN
+        return headers
+
+    def charge_reply(self, headers):
+        """
+        Charges what a downstream service reported as spent in its reply.
+        """
+        headers = headers or {}
+        self.charge(
+            tokens=parse_number(headers.get(USED_TOKENS_HEADER), int) or 0,
+            tool_calls=parse_number(headers.get(USED_TOOL_CALLS_HEADER), int) or 0,
+        )
+        if headers.get(TRUNCATED_HEADER):
+            # an answer built from a truncated one is truncated too
+            self.truncated = True
+
+    def partial(self):
+        """
+        The answers of the downstream calls so far, the reply is marked as truncated when there are any.
+        """
+        results = [result.decode(errors="replace") if isinstance(result, bytes) else str(result) for result in self.results]
+        if results:
+            self.truncated = True
+        return "\n\n".join(results) or None
+
+    def used_headers(self):
+        headers = {USED_TOKENS_HEADER: self.used_tokens, USED_TOOL_CALLS_HEADER: self.used_tool_calls}
+        if self.truncated:
+            headers[TRUNCATED_HEADER] = True
+        return headers
+
+    def usage_limits(self):
+        # pydantic-ai is only imported by the agents
+        from pydantic_ai.usage import UsageLimits
+        return UsageLimits(total_tokens_limit=self.remaining_tokens())
+
+def start(properties):
+    """
+    Makes the budget sent with the message the budget of the running task.
+    """
+    budget = Budget.from_headers(properties.headers)
+    current_budget.set(budget)
+    return budget
+
+def reply_headers():
+    """
+    Headers reporting what the running task spent, sent with its replies.
+    """
+    budget = current_budget.get()
+    return budget.used_headers() if budget is not None else {}
+
+async def before_deadline(awaitable):
+    """
+    Awaits the awaitable, raises BudgetExhausted when the deadline of the current budget passes first.
+    """
+    budget = current_budget.get()
+    seconds = budget.remaining_seconds() if budget is not None else None
+    if seconds is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(0.0, seconds))
+    except asyncio.TimeoutError:
+        if budget.remaining_seconds() > 0:
+            # timed out on its own, not on the deadline
+            raise
+        raise BudgetExhausted("time budget exhausted")
+
+async def iterate_before_deadline(iterator):
+    iterator = iterator.__aiter__()
+    while True:
+        try:
+            item = await before_deadline(iterator.__anext__())
+        except StopAsyncIteration:
+            return
+        yield item
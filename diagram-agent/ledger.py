@@ -0,0 +1,89 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+LEDGER_PATH = os.getenv("LEDGER_PATH", "ledger.sqlite3")
+LEDGER_TTL = float(os.getenv("LEDGER_TTL", "86400"))
+PURGE_INTERVAL = 60
+
+def message_key(properties):
+    return properties.message_id or properties.correlation_id
+
+class Ledger:
+    """
+    Durable record of the replies sent for each message, keyed by message or
+    correlation id. A message that is redelivered after it was answered but
+    before the ack reached the broker gets the stored replies again instead of
+    a second generation. Of a streamed message only that it finished is kept,
+    its replies are not held back. Entries expire after LEDGER_TTL seconds.
+    """
+    def __init__(self, path: str = LEDGER_PATH, ttl: float = LEDGER_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.last_purge = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, replies TEXT NOT NULL, created REAL NOT NULL)"
+        )
+
+    def add_reply(self, key, body, final=None):
+        """
+        Stores the reply of a message. The replies of a stream are not stored,
+        its final reply records that the stream was sent in full.
+        """
+        if key is None:
+            return
+        if isinstance(body, bytes):
+            body = body.decode(errors="replace")
+        if not isinstance(body, str):
+            raise TypeError(f"Replies have to be text, got {type(body).__name__}")
+        if final is False:
+            return
+        # a whole project or long-form answer would not fit in memory or in one row
+        replies = [] if final else [[body, final]]
+        with self.lock:
+            try:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO results (key, replies, created) VALUES (?, ?, ?)",
+                    (key, json.dumps(replies), time.time()),
+                )
+                self._purge()
+            except sqlite3.Error as e:
+                print(f"Error writing ledger: {e}")
+
+    def lookup(self, key):
+        """
+        Returns the stored (body, final) replies of a message, an empty list for a
+        stream that was sent in full, or None when it was never answered.
+        """
+        if key is None:
+            return None
+        with self.lock:
+            try:
+                row = self.db.execute(
+                    "SELECT replies FROM results WHERE key = ? AND created > ?", (key, time.time() - self.ttl)
+                ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Error reading ledger: {e}")
+                return None
+        if row is None:
+            return None
+        replies = json.loads(row[0])
+        if not all(isinstance(body, str) for body, final in replies):
+            # written before replies were checked, run the message again instead of replaying it
+            print(f"Ignoring ledger entry {key} with a reply that is not text")
+            return None
+        return [(body.encode(), final) for body, final in replies]
+
+    def _purge(self):
+        now = time.time()
+        if now - self.last_purge < PURGE_INTERVAL:
+            return
+        self.last_purge = now
+        self.db.execute("DELETE FROM results WHERE created <= ?", (now - self.ttl,))
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+# profiling is disabled unless a token is configured
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+PROFILE_MAX_SECONDS = 120
+
+_session = threading.Lock()
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(seconds: float, interval: float):
+    """
+    Samples the stacks of all threads except the sampling one for the given
+    number of seconds and counts every distinct stack, root frame first.
+    """
+    counts = Counter()
+    own = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+def to_collapsed(counts: Counter):
+    # the collapsed format is read by flamegraph.pl, speedscope and inferno
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+def to_top(counts: Counter, limit: int = 40):
+    """
+    Lists the functions with the most samples, by samples on top of the stack
+    (self) and by samples anywhere in the stack (total).
+    """
+    own = Counter()
+    total = Counter()
+    samples = max(1, sum(counts.values()))
+    for stack, count in counts.items():
+        frames = stack.split(";")[1:]
+        if frames:
+            own[frames[-1]] += count
+        for label in set(frames):
+            total[label] += count
+    lines = [f"{samples} samples", f"{'self':>7} {'total':>7}  function"]
+    for label, count in own.most_common(limit):
+        lines.append(f"{count / samples:7.1%} {total[label] / samples:7.1%}  {label}")
+    return "\n".join(lines) + "\n"
+
+def profile(seconds: float, interval: float):
+    if not _session.acquire(blocking=False):
+        raise RuntimeError("A profiling session is already running")
+    try:
+        return sample_stacks(seconds, interval)
+    finally:
+        _session.release()
+
+router = APIRouter()
+
+@router.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10, interval: float = 0.01, format: str = "collapsed"):
+    """
+    Samples all threads of the service for a number of seconds and returns collapsed
+    stacks for a flamegraph, or with format=top a table of the hottest functions.
+    """
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if request.headers.get("x-debug-token") != DEBUG_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid debug token")
+    if format not in ("collapsed", "top"):
+        raise HTTPException(status_code=400, detail="Format must be collapsed or top")
+
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    interval = max(interval, 0.001)
+    try:
+        counts = await asyncio.to_thread(profile, seconds, interval)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "top":
+        return PlainTextResponse(to_top(counts))
+    return PlainTextResponse(to_collapsed(counts), headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
@@ -0,0 +1,253 @@
+import json
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from fastapi import APIRouter
+
+# MODEL_PROVIDERS='{"local": {"base_url": "http://local-llm:8080/v1", "api": "chat", "cost_per_million_tokens": 0}}'
+# adds OpenAI compatible servers next to OpenAI itself, MODEL_ROUTES picks between them per service
+MODEL_PROVIDERS = json.loads(os.getenv("MODEL_PROVIDERS") or "{}")
+MODEL_ROUTES = json.loads(os.getenv("MODEL_ROUTES") or "[]")
+# what a second of waiting is worth in dollars, weighs latency against cost when choosing a model
+ROUTE_LATENCY_PRICE = float(os.getenv("ROUTE_LATENCY_PRICE", "0.0005"))
+ROUTE_MIN_SAMPLES = int(os.getenv("ROUTE_MIN_SAMPLES", "5"))
+ROUTE_EXPLORE = float(os.getenv("ROUTE_EXPLORE", "0.05"))
+
+DEFAULT_PROVIDER = "openai"
+
+def split(ref: str):
+    """
+    Splits "provider:model" into its parts, a plain model name belongs to OpenAI.
+    """
+    provider, separator, model = ref.partition(":")
+    if not separator:
+        return DEFAULT_PROVIDER, ref
+    return provider, model
+
+class ModelStats:
+    """
+    Moving averages of the latency and tokens of the calls to one model, and how many failed.
+    """
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.calls = 0
+        self.errors = 0
+        self.latency = None
+        self.tokens = None
+
+    def average(self, current, value):
+        return value if current is None else current + self.alpha * (value - current)
+
+    def record(self, seconds: float, tokens, ok: bool):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+            return
+        self.latency = self.average(self.latency, seconds)
+        if tokens is not None:
+            self.tokens = self.average(self.tokens, tokens)
+
+    @property
+    def success_rate(self):
+        return 1.0 if not self.calls else 1.0 - self.errors / self.calls
+
+class ChatResponse:
+    """
+    A chat completion in the shape the generators read from the Responses API.
+    """
+    def __init__(self, completion):
+        choice = completion.choices[0]
+        self.output_text = choice.message.content or ""
+        self.status = "incomplete" if choice.finish_reason == "length" else "completed"
+        self.usage = SimpleNamespace(total_tokens=completion.usage.total_tokens if completion.usage else 0)
+
+async def chat_stream_events(stream):
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield SimpleNamespace(type="response.output_text.delta", delta=chunk.choices[0].delta.content)
+
+class Provider:
+    """
+    An OpenAI compatible API. Local servers such as llama.cpp and vLLM mostly only
+    speak chat completions, set "api": "chat" for them.
+    """
+    def __init__(self, name: str, registry: "Registry", base_url: str = None, api_key: str = None,
+                 api_key_env: str = "OPENAI_API_KEY", api: str = "responses", cost_per_million_tokens=0.0):
+        self.name = name
+        self.registry = registry
+        self.base_url = base_url
+        self.api_key = api_key or os.getenv(api_key_env) or "none"
+        self.api = api
+        self.costs = cost_per_million_tokens
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            # importing the OpenAI client is slow, only pay for it once a provider is used
+            from openai import AsyncOpenAI
+            # retries are left to the ResilientCaller, like for the OpenAI clients of the services
+            self._client = AsyncOpenAI(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                http_client=self.registry.http_client(self.name),
+            )
+        return self._client
+
+    def cost(self, model: str, tokens: float):
+        price = self.costs.get(model, 0.0) if isinstance(self.costs, dict) else self.costs
+        return price * tokens / 1_000_000
+
+    async def create_response(self, client, model: str, instructions: str, message: str, **kwargs):
+        """
+        Calls the model through the API the provider speaks, returns the response headers and the response.
+        """
+        if self.api == "chat":
+            max_tokens = kwargs.pop("max_output_tokens", None)
+            if max_tokens is not None:
+                kwargs["max_tokens"] = max_tokens
+            raw = await client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=[{"role": "system", "content": instructions}, {"role": "user", "content": message}],
+                **kwargs,
+            )
+            completion = raw.parse()
+            return raw.headers, chat_stream_events(completion) if kwargs.get("stream") else ChatResponse(completion)
+        raw = await client.responses.with_raw_response.create(model=model, instructions=instructions, input=message, **kwargs)
+        return raw.headers, raw.parse()
+
+class Registry:
+    """
+    Knows the providers, the routes of the services and the stats of every model.
+    A route lists candidate models for a service, optionally only for requests up
+    to max_tokens. Candidates are tried until they have a few samples, then the
+    one with the lowest expected cost plus priced latency, divided by its success
+    rate, wins. A small share of the calls explores the other candidates.
+    """
+    def __init__(self, providers: dict = MODEL_PROVIDERS, routes: list = MODEL_ROUTES):
+        self.providers = {DEFAULT_PROVIDER: Provider(DEFAULT_PROVIDER, self)}
+        for name, definition in providers.items():
+            self.providers[name] = Provider(name, self, **definition)
+        self.routes = routes
+        self.stats = {}
+        self.agent_models = {}
+        self.lock = threading.Lock()
+
+    def provider(self, ref: str):
+        name, model = split(ref)
+        if name not in self.providers:
+            raise ValueError(f"Unknown model provider '{name}' in '{ref}'")
+        return self.providers[name], model
+
+    def model_stats(self, ref: str):
+        provider, model = split(ref)
+        key = f"{provider}:{model}"
+        with self.lock:
+            if key not in self.stats:
+                self.stats[key] = ModelStats()
+            return self.stats[key]
+
+    def record(self, ref: str, seconds: float, tokens, ok: bool):
+        stats = self.model_stats(ref)
+        with self.lock:
+            stats.record(seconds, tokens, ok)
+
+    def route(self, service: str, tokens: int):
+        for route in self.routes:
+            if route.get("service", "*") not in ("*", service):
+                continue
+            if route.get("max_tokens") is not None and tokens > route["max_tokens"]:
+                continue
+            return route
+        return None
+
+    def score(self, ref: str):
+        provider, model = self.provider(ref)
+        stats = self.model_stats(ref)
+        if stats.latency is None:
+            # every call failed so far, only exploring picks it again
+            return float("inf")
+        cost = provider.cost(model, stats.tokens or 0)
+        return (cost + (stats.latency or 0) * ROUTE_LATENCY_PRICE) / max(0.05, stats.success_rate)
+
+    def choose(self, service: str, tokens: int):
+        """
+        Returns the model reference for a request of the service, None when no route applies.
+        """
+        route = self.route(service, tokens)
+        if route is None:
+            return None
+        candidates = route["models"]
+        for ref in candidates:
+            if self.model_stats(ref).calls < ROUTE_MIN_SAMPLES:
+                return ref
+        if random.random() < ROUTE_EXPLORE:
+            return random.choice(candidates)
+        return min(candidates, key=self.score)
+
+    def http_client(self, provider: str):
+        """
+        An HTTP client for the OpenAI client of a provider that records the latency,
+        tokens and failures of every model call. Streamed calls are timed to their first byte.
+        """
+        from openai import DefaultAsyncHttpxClient
+
+        async def on_request(request):
+            request.extensions["started"] = time.monotonic()
+
+        async def on_response(response):
+            request = response.request
+            if request.method != "POST" or "started" not in request.extensions:
+                return
+            try:
+                model = json.loads(request.content).get("model")
+            except ValueError:
+                return
+            tokens = None
+            ok = response.status_code < 400
+            if ok and response.headers.get("content-type", "").startswith("application/json"):
+                await response.aread()
+                tokens = (response.json().get("usage") or {}).get("total_tokens")
+            self.record(f"{provider}:{model}", time.monotonic() - request.extensions["started"], tokens, ok)
+
+        return DefaultAsyncHttpxClient(event_hooks={"request": [on_request], "response": [on_response]})
+
+    def agent_model(self, ref: str):
+        """
+        The model for a pydantic-ai run. Without routes the name is passed on as
+        before, otherwise a chat model bound to the provider's client.
+        """
+        if not self.routes:
+            return ref
+        if ref not in self.agent_models:
+            # pydantic-ai is only imported by the agents
+            from pydantic_ai.models.openai import OpenAIModel
+            from pydantic_ai.providers.openai import OpenAIProvider
+            provider, model = self.provider(ref)
+            self.agent_models[ref] = OpenAIModel(model, provider=OpenAIProvider(openai_client=provider.client))
+        return self.agent_models[ref]
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        result = {}
+        for ref, model_stats in sorted(stats.items()):
+            provider, model = self.provider(ref)
+            result[ref] = {
+                "calls": model_stats.calls,
+                "errors": model_stats.errors,
+                "latency": model_stats.latency,
+                "tokens": model_stats.tokens,
+                "cost_per_call": provider.cost(model, model_stats.tokens or 0),
+                "score": self.score(ref),
+            }
+        return result
+
+registry = Registry()
+
+router = APIRouter()
+
+@router.get("/providers")
+async def providers():
+    return {"providers": sorted(registry.providers), "routes": registry.routes, "models": registry.snapshot()}
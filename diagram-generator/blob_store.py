@@ -0,0 +1,95 @@
+import hashlib
+import os
+import re
+import time
+
+# a directory shared by the generators and the api-gateway, unset sends every answer inline
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR")
+# answers from this many characters on are stored and passed on as a reference
+BLOB_MIN_CHARS = int(os.getenv("BLOB_MIN_CHARS", "2000"))
+# seconds a blob is kept, answers are expanded long before
+BLOB_TTL = float(os.getenv("BLOB_TTL", "86400"))
+BLOB_CLEANUP_INTERVAL = float(os.getenv("BLOB_CLEANUP_INTERVAL", "600"))
+
+REFERENCE_PATTERN = re.compile(r"\[\[blob:([0-9a-f]{32})\]\]")
+
+_last_cleanup = 0.0
+
+def reference(blob_id: str):
+    return f"[[blob:{blob_id}]]"
+
+def path(blob_id: str):
+    return os.path.join(BLOB_STORE_DIR, blob_id)
+
+def put(content: str):
+    """
+    Stores the content under its hash and returns the id, storing the same content twice keeps one file.
+    """
+    data = content.encode()
+    blob_id = hashlib.sha256(data).hexdigest()[:32]
+    if not os.path.exists(path(blob_id)):
+        os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+        # written to a temporary name first, readers never see half a blob
+        temporary = f"{path(blob_id)}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as blob:
+            blob.write(data)
+        os.replace(temporary, path(blob_id))
+    else:
+        # the content is asked for again, keep it for another TTL
+        os.utime(path(blob_id))
+    cleanup()
+    return blob_id
+
+def get(blob_id: str):
+    try:
+        with open(path(blob_id), "rb") as blob:
+            return blob.read().decode()
+    except FileNotFoundError:
+        return None
+
+def offload(answer):
+    """
+    Replaces a large answer by a reference to the stored answer, so the agents
+    pass it on without reading and writing it out again.
+    """
+    if not BLOB_STORE_DIR or not isinstance(answer, str) or len(answer) < BLOB_MIN_CHARS:
+        return answer
+    try:
+        return reference(put(answer))
+    except OSError as e:
+        print(f"Could not store the answer, sending it inline: {e!r}")
+        return answer
+
+def expand(body: bytes):
+    """
+    Replaces the references in a reply with the stored answers, references to
+    blobs that are gone are left as they are.
+    """
+    if not BLOB_STORE_DIR or b"[[blob:" not in body:
+        return body
+
+    def replace(match):
+        content = get(match.group(1))
+        if content is None:
+            print(f"Blob {match.group(1)} not found")
+            return match.group(0)
+        return content
+
+    return REFERENCE_PATTERN.sub(replace, body.decode(errors="replace")).encode()
+
+def cleanup():
+    """
+    Deletes the blobs older than BLOB_TTL, at most every BLOB_CLEANUP_INTERVAL seconds.
+    """
+    global _last_cleanup
+    now = time.time()
+    if now - _last_cleanup < BLOB_CLEANUP_INTERVAL:
+        return
+    _last_cleanup = now
+    for name in os.listdir(BLOB_STORE_DIR):
+        try:
+            if now - os.path.getmtime(os.path.join(BLOB_STORE_DIR, name)) > BLOB_TTL:
+                os.remove(os.path.join(BLOB_STORE_DIR, name))
+        except OSError:
+            # another replica removed it first
+            pass
@@ -0,0 +1,258 @@
+import re
+import threading
+from collections import OrderedDict
+
+FENCE_PATTERN = re.compile(r"```[ \t]*([\w-]*)[^\n]*\n(.*?)(?:```|\Z)", re.S)
+
+DIAGRAM_TYPES = {
+    name.lower(): name for name in [
+        "flowchart", "graph", "sequenceDiagram", "classDiagram", "stateDiagram", "stateDiagram-v2",
+        "erDiagram", "gantt", "pie", "journey", "gitGraph", "mindmap", "timeline", "quadrantChart",
+        "requirementDiagram", "C4Context", "C4Container", "C4Component", "C4Dynamic", "C4Deployment",
+        "sankey-beta", "xychart-beta", "block-beta", "packet-beta", "architecture-beta",
+    ]
+}
+FLOWCHART_TYPES = {"flowchart", "graph"}
+FLOWCHART_DIRECTIONS = {"TB", "TD", "BT", "RL", "LR"}
+# keywords that open a block closed by a lone "end"
+END_BLOCKS = {
+    "flowchart": {"subgraph"},
+    "graph": {"subgraph"},
+    "sequenceDiagram": {"loop", "alt", "opt", "par", "critical", "break", "rect", "box"},
+}
+BRACE_TYPES = {"classDiagram", "stateDiagram", "stateDiagram-v2", "erDiagram", "requirementDiagram"}
+
+TYPOGRAPHIC_REPLACEMENTS = {
+    "“": '"', "”": '"', "‘": "'", "’": "'",
+    "—>": "-->", "–>": "-->", "→": "-->", "\t": "    ",
+}
+SINGLE_ARROW_PATTERN = re.compile(r"(?<![-=.<>])->(?![->])")
+UNQUOTED_LABEL_PATTERN = re.compile(r"(\b[\w-]+)\[(?![(\[/\\\"])([^\]\[\"]*[()][^\]\[\"]*)\]")
+ASYMMETRIC_SHAPE_PATTERN = re.compile(r"\b[\w-]+>[^\]\n]*\]")
+# cardinalities of an erDiagram relationship, "||--o{", "}|..|{", their braces don't open a block
+ER_RELATIONSHIP_PATTERN = re.compile(r"[|}][o|](?:--|\.\.)[o|][|{]")
+
+class MermaidError:
+    def __init__(self, line: int, message: str):
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return f"line {self.line}: {self.message}"
+
+def extract_diagram(text: str):
+    """
+    Returns the body of the mermaid code block in the model output. Falls back
+    to the first fenced block, or the whole text when there is no fence.
+    """
+    blocks = FENCE_PATTERN.findall(text)
+    for label, body in blocks:
+        if label.lower() == "mermaid":
+            return body.strip("\n")
+    if blocks:
+        return blocks[0][1].strip("\n")
+    return text.strip()
+
+def _body_start(lines):
+    # skip blank lines, comments and a leading --- front matter block
+    index = 0
+    in_front_matter = False
+    while index < len(lines):
+        stripped = lines[index].strip()
+        if stripped == "---":
+            in_front_matter = not in_front_matter
+        elif not in_front_matter and stripped and not stripped.startswith("%%"):
+            return index
+        index += 1
+    return index
+
+def diagram_type(source: str):
+    lines = source.split("\n")
+    start = _body_start(lines)
+    if start >= len(lines):
+        return None
+    keyword = lines[start].split()[0]
+    return DIAGRAM_TYPES.get(keyword.lower())
+
+def repair(source: str):
+    """
+    Fixes mechanical mistakes that do not need a model call. Returns the
+    repaired source and a list describing the applied fixes.
+    """
+    fixes = []
+    for bad, good in TYPOGRAPHIC_REPLACEMENTS.items():
+        if bad in source:
+            source = source.replace(bad, good)
+            fixes.append(f"replaced {bad!r} with {good!r}")
+
+    lines = [line.rstrip() for line in source.replace("\r\n", "\n").split("\n")]
+    start = _body_start(lines)
+    if start < len(lines) and lines[start].strip().lower() == "mermaid":
+        del lines[start]
+        fixes.append("removed stray 'mermaid' label")
+        start = _body_start(lines)
+    if start >= len(lines):
+        return "\n".join(lines), fixes
+
+    header = lines[start].split()
+    kind = DIAGRAM_TYPES.get(header[0].lower())
+    if kind and header[0] != kind:
+        header[0] = kind
+        fixes.append(f"normalized diagram type to {kind}")
+    # "graph TD;" is valid, the statement may end in a semicolon
+    direction = header[1].rstrip(";") if len(header) > 1 else None
+    if kind in FLOWCHART_TYPES and direction and direction.upper() in FLOWCHART_DIRECTIONS and direction != direction.upper():
+        header[1] = direction.upper() + header[1][len(direction):]
+        fixes.append("normalized flowchart direction")
+    lines[start] = " ".join(header)
+
+    if kind in FLOWCHART_TYPES:
+        for index in range(start + 1, len(lines)):
+            line = lines[index]
+            if line.strip().startswith("%%"):
+                continue
+            fixed = SINGLE_ARROW_PATTERN.sub("-->", line)
+            fixed = UNQUOTED_LABEL_PATTERN.sub(lambda m: f'{m.group(1)}["{m.group(2)}"]', fixed)
+            if fixed != line:
+                lines[index] = fixed
+                fixes.append(f"fixed edge or label syntax on line {index + 1}")
+
+    return "\n".join(lines), fixes
+
+def _strip_quoted(line: str):
+    return re.sub(r'"[^"]*"', '""', line)
+
+def _block_braces(kind: str, unquoted: str):
+    # the part of the line whose braces open and close blocks
+    if kind == "erDiagram":
+        return ER_RELATIONSHIP_PATTERN.sub("", unquoted)
+    return unquoted
+
+def validate(source: str):
+    """
+    Checks the structure of a diagram and returns a list of MermaidErrors.
+    """
+    lines = source.split("\n")
+    start = _body_start(lines)
+    if start >= len(lines):
+        return [MermaidError(1, "diagram is empty")]
+
+    header = lines[start].split()
+    kind = DIAGRAM_TYPES.get(header[0].lower())
+    if kind != header[0]:
+        return [MermaidError(start + 1, f"unknown diagram type '{header[0]}'")]
+    errors = []
+    if kind in FLOWCHART_TYPES and len(header) > 1 and header[1].rstrip(";") not in FLOWCHART_DIRECTIONS:
+        errors.append(MermaidError(start + 1, f"unknown flowchart direction '{header[1]}'"))
+    if start + 1 >= len(lines) or not any(line.strip() for line in lines[start + 1:]):
+        errors.append(MermaidError(start + 1, "diagram has no content"))
+
+    openers = END_BLOCKS.get(kind, set())
+    open_blocks = []
+    brace_depth = 0
+    for index in range(start + 1, len(lines)):
+        line_number = index + 1
+        stripped = lines[index].strip()
+        if not stripped or stripped.startswith("%%"):
+            continue
+        if stripped.count('"') % 2:
+            errors.append(MermaidError(line_number, "unbalanced quotes"))
+            continue
+        unquoted = _strip_quoted(stripped)
+        keyword = unquoted.split()[0]
+
+        if keyword in openers:
+            open_blocks.append((keyword, line_number))
+        elif keyword == "end" and openers:
+            if not open_blocks:
+                errors.append(MermaidError(line_number, "'end' without an open block"))
+            else:
+                open_blocks.pop()
+        elif keyword in ("else", "and") and kind == "sequenceDiagram":
+            if not open_blocks or open_blocks[-1][0] not in ("alt", "par", "critical"):
+                errors.append(MermaidError(line_number, f"'{keyword}' outside of an alt, par or critical block"))
+
+        if kind in BRACE_TYPES:
+            unquoted = _block_braces(kind, unquoted)
+            brace_depth += unquoted.count("{") - unquoted.count("}")
+            if brace_depth < 0:
+                errors.append(MermaidError(line_number, "unexpected '}'"))
+                brace_depth = 0
+        elif kind in FLOWCHART_TYPES:
+            unquoted = ASYMMETRIC_SHAPE_PATTERN.sub("", unquoted)
+            for opening, closing in ("[]", "()", "{}"):
+                if unquoted.count(opening) != unquoted.count(closing):
+                    errors.append(MermaidError(line_number, f"unbalanced '{opening}{closing}' in node shape"))
+
+    for keyword, line_number in open_blocks:
+        errors.append(MermaidError(line_number, f"'{keyword}' block is never closed with 'end'"))
+    if brace_depth > 0:
+        errors.append(MermaidError(len(lines), "missing closing '}'"))
+    return errors
+
+def canonicalize(source: str):
+    """
+    Produces a normalized form of a valid diagram: no comments or blank lines,
+    single spaces outside quoted labels and four space indentation per block.
+    """
+    lines = source.split("\n")
+    start = _body_start(lines)
+    kind = diagram_type(source)
+    openers = END_BLOCKS.get(kind, set())
+    result = [line.rstrip() for line in lines[:start]]
+    depth = 0
+    for line in lines[start:]:
+        stripped = line.strip()
+        if not stripped or stripped.startswith("%%"):
+            continue
+        parts = re.split(r'("[^"]*")', stripped)
+        stripped = "".join(part if part.startswith('"') else re.sub(r" {2,}", " ", part) for part in parts)
+        if len(result) == start:
+            result.append(stripped)
+            depth = 1
+            continue
+
+        unquoted = _block_braces(kind, _strip_quoted(stripped))
+        keyword = unquoted.split()[0]
+        divider = kind == "sequenceDiagram" and keyword in ("else", "and")
+        closes_brace = kind in BRACE_TYPES and unquoted.startswith("}")
+        if (openers and keyword == "end") or divider or closes_brace:
+            depth = max(1, depth - 1)
+        result.append("    " * depth + stripped)
+        if keyword in openers or divider:
+            depth += 1
+        elif kind in BRACE_TYPES:
+            delta = unquoted.count("{") - unquoted.count("}") + (1 if closes_brace else 0)
+            depth = max(1, depth + delta)
+    return "\n".join(result)
+
+def to_markdown(source: str):
+    return f"```mermaid\n{source}\n```"
+
+def normalize_request(message: str):
+    return " ".join(message.lower().split())
+
+class DiagramCache:
+    """
+    Small thread safe LRU cache of validated diagrams in canonical form.
+    """
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key: str, diagram: str):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self.entries[key] = diagram
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
@@ -1,9 +1,26 @@
-from openai import AsyncOpenAI
+import os
+from openai import AsyncOpenAI, AuthenticationError, BadRequestError, PermissionDeniedError, RateLimitError
+from rate_limiter import RateLimitScheduler, estimate_tokens, parse_int
+from mermaid_validator import DiagramCache, canonicalize, extract_diagram, normalize_request, repair, to_markdown, validate
+from resilience import ResilientCaller
+from trace_log import llm_call
+from providers import DEFAULT_PROVIDER, registry
+from budget import BudgetExhausted, before_deadline, current_budget
 
 class OpenAiManager:
-    def __init__(self, api_key: str):
-        self.client = AsyncOpenAI(api_key=api_key)
+    def __init__(self, api_key: str, client: AsyncOpenAI = None):
+        # retries are handled by the ResilientCaller so attempts can be timed and hedged,
+        # the generator host passes in one client that all its generators share
+        self.client = client or AsyncOpenAI(api_key=api_key, max_retries=0, http_client=registry.http_client(DEFAULT_PROVIDER))
+        # the routes of MODEL_ROUTES that apply to this generator
+        self.service = "diagram-generator"
         self.available_models = []
+        self.model = os.getenv("OPENAI_MODEL")
+        self.fallback_model = os.getenv("OPENAI_FALLBACK_MODEL")
+        self.callers = {}
+        self.schedulers = {}
+        self.cache = DiagramCache(int(os.getenv("DIAGRAM_CACHE_SIZE", "256")))
+        self.repair_attempts = int(os.getenv("DIAGRAM_REPAIR_ATTEMPTS", "1"))
         self.prompt = """"
         Generate a string containing only the Mermaid diagram syntax 
         in Markdown format (enclosed in triple backticks and labeled mermaid). 
@@ -16,6 +33,11 @@ class OpenAiManager:
             Process --> End
         ```
         """
+        self.repair_prompt = """
+        Fix the structural errors in the given Mermaid diagram. Keep everything that is not
+        mentioned in the errors unchanged. Only output the corrected diagram in a code block
+        labeled mermaid, without any explanation.
+        """
 
     async def get_available_models(self):
         try:
@@ -28,36 +50,120 @@ class OpenAiManager:
             print(f"Error fetching models: {e}")
             self.available_models = []
 
+    def get_caller(self, model: str):
+        if model not in self.callers:
+            self.callers[model] = ResilientCaller(
+                model,
+                fallback_model=self.fallback_model,
+                non_retryable=(AuthenticationError, BadRequestError, PermissionDeniedError, BudgetExhausted),
+            )
+        return self.callers[model]
+
+    def get_scheduler(self, model: str):
+        # OpenAI enforces its limits per model
+        if model not in self.schedulers:
+            self.schedulers[model] = RateLimitScheduler(
+                requests_per_minute=parse_int(os.getenv("OPENAI_RPM_LIMIT")),
+                tokens_per_minute=parse_int(os.getenv("OPENAI_TPM_LIMIT")),
+            )
+        return self.schedulers[model]
+
+    async def create_response(self, model: str, instructions: str, message: str, **kwargs):
+        budget = current_budget.get()
+        if budget is not None:
+            budget.check()
+            left = budget.remaining_tokens()
+            if left is not None:
+                # the output may only spend what the prompt leaves of the budget, 16 is the least OpenAI accepts
+                left -= estimate_tokens(instructions, message, expected_output_tokens=0)
+                if left < 16:
+                    raise BudgetExhausted("token budget exhausted")
+                kwargs["max_output_tokens"] = min(kwargs.get("max_output_tokens", left), left)
+        provider, model_name = registry.provider(model)
+        # OpenAI is called through the client of the manager, the generator host shares it
+        client = self.client if provider.name == DEFAULT_PROVIDER else provider.client
+        scheduler = self.get_scheduler(model)
+        await scheduler.acquire(estimate_tokens(instructions, message))
+        try:
+            with llm_call():
+                headers, response = await before_deadline(
+                    provider.create_response(client, model_name, instructions, message, **kwargs)
+                )
+        except RateLimitError as e:
+            scheduler.update(e.response.headers)
+            scheduler.back_off(e.response.headers)
+            raise
+        scheduler.update(headers)
+        if budget is not None:
+            # streams only report their usage at the end, charge the estimate for them
+            usage = getattr(response, "usage", None)
+            budget.charge(tokens=usage.total_tokens if usage else estimate_tokens(instructions, message))
+            if getattr(response, "status", None) == "incomplete":
+                # the output ran into its token limit, the answer is cut short
+                budget.truncated = True
+        return response
+
     async def get_response(self, message: str, model: str = None):
+        if not model:
+            model = registry.choose(self.service, estimate_tokens(message, expected_output_tokens=0))
+        if not model and self.model:
+            model = self.model
         if not model:
             if not self.available_models:
-                return {"error": "No available models found."}
+                # raised rather than returned, replies and the ledger only carry text
+                raise RuntimeError("No available models found.")
             else:
                 model = self.available_models[1]
 
-        response = await self.client.responses.create(
-            model=model,
-            instructions=self.prompt,
-            input=message,
+        key = normalize_request(message)
+        cached = self.cache.get(key)
+        if cached is not None:
+            print("Returning cached diagram")
+            return to_markdown(cached)
+
+        response = await self.get_caller(model).call(
+            lambda selected_model: self.create_response(selected_model, self.prompt, message)
         )
 
         print(f"Response: {response.output_text}")
 
-        return response.output_text
+        diagram, errors = self.check_diagram(response.output_text)
+        attempts = 0
+        while errors and attempts < self.repair_attempts:
+            attempts += 1
+            print(f"Diagram has structural errors, requesting a repair: {'; '.join(str(e) for e in errors)}")
+            repair_request = "Errors:\n" + "\n".join(str(e) for e in errors) + "\n\nDiagram:\n" + to_markdown(diagram)
+            try:
+                response = await self.get_caller(model).call(
+                    lambda selected_model: self.create_response(selected_model, self.repair_prompt, repair_request)
+                )
+            except BudgetExhausted as e:
+                print(f"Stopped repairing the diagram: {e}")
+                break
+            diagram, errors = self.check_diagram(response.output_text)
+
+        if errors:
+            print(f"Returning diagram with unresolved errors: {'; '.join(str(e) for e in errors)}")
+            return to_markdown(diagram)
+
+        diagram = canonicalize(diagram)
+        self.cache.put(key, diagram)
+        return to_markdown(diagram)
+
+    def check_diagram(self, output: str):
+        diagram, fixes = repair(extract_diagram(output))
+        if fixes:
+            print(f"Repaired diagram locally: {', '.join(fixes)}")
+        return diagram, validate(diagram)
 
     async def get_streaming_response(self, message: str, model: str):
         if not model:
             if not self.available_models:
-                yield {"error": "No available models found."}
+                raise RuntimeError("No available models found.")
             else:
                 model = self.available_models[1]
 
-        stream = await self.client.responses.create(
-            model=model,
-            instructions=self.prompt,
-            input=message,
-            stream=True,
-        )
+        stream = await self.create_response(model, self.prompt, message, stream=True)
 
         async for event in stream:
             if event.type == "response.output_text.delta":
@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mermaid_validator import canonicalize, repair, validate
+
+ER_DIAGRAM = """erDiagram
+    CUSTOMER ||--o{ ORDER : places
+    ORDER ||--|{ LINE-ITEM : contains
+    PRODUCT }|..|{ LINE-ITEM : "is part of"
+    CUSTOMER {
+        string name
+        string email
+    }
+"""
+
+def test_er_relationships_are_not_braces():
+    assert [str(error) for error in validate(ER_DIAGRAM)] == []
+
+def test_er_entity_block_still_has_to_close():
+    errors = validate(ER_DIAGRAM.replace("    }\n", ""))
+    assert [error.message for error in errors] == ["missing closing '}'"]
+
+def test_er_relationships_keep_their_indentation():
+    lines = canonicalize(ER_DIAGRAM).split("\n")
+    assert lines[1] == "    CUSTOMER ||--o{ ORDER : places"
+    assert lines[4] == "    CUSTOMER {"
+    assert lines[5] == "        string name"
+    assert lines[7] == "    }"
+
+def test_flowchart_header_with_semicolon():
+    source = "graph TD;\n    A-->B;\n"
+    assert validate(source) == []
+    assert repair("graph td;\n    A-->B;\n") == (source, ["normalized flowchart direction"])
@@ -0,0 +1,106 @@
+import contextvars
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# per-hop timing records are only written when a directory is set, every container writes its own file
+TRACE_LOG_DIR = os.getenv("TRACE_LOG_DIR")
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_LOG_BACKUPS = int(os.getenv("TRACE_LOG_BACKUPS", "5"))
+
+current_hop = contextvars.ContextVar("current_hop", default=None)
+
+_logger = None
+
+def get_logger():
+    global _logger
+    if _logger is None:
+        os.makedirs(TRACE_LOG_DIR, exist_ok=True)
+        path = os.path.join(TRACE_LOG_DIR, f"{socket.gethostname()}.jsonl")
+        handler = RotatingFileHandler(path, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger("trace_log")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        _logger = logger
+    return _logger
+
+class Hop:
+    """
+    Timing record of one message handled by a service: when it was published,
+    received, when processing started and ended and the model calls in between.
+    All times are unix timestamps.
+    """
+    def __init__(self, service: str, hop: str, trace_id: str, correlation_id: str = None, parent: str = None, publish: float = None):
+        self.record = {
+            "trace_id": trace_id,
+            "id": uuid.uuid4().hex[:16],
+            "parent": parent,
+            "correlation_id": correlation_id,
+            "service": service,
+            "hop": hop,
+            "publish": publish,
+            "receive": time.time(),
+            "start": None,
+            "end": None,
+            "llm": [],
+        }
+
+    @classmethod
+    def from_properties(cls, service: str, hop: str, properties):
+        headers = properties.headers or {}
+        return cls(
+            service, hop,
+            trace_id=headers.get("x-trace-id") or properties.correlation_id,
+            correlation_id=properties.correlation_id,
+            parent=headers.get("x-parent-hop"),
+            publish=headers.get("x-published-at"),
+        )
+
+    def start(self):
+        self.record["start"] = time.time()
+
+    def finish(self):
+        self.record["end"] = time.time()
+        if TRACE_LOG_DIR:
+            get_logger().info(json.dumps(self.record, separators=(",", ":")))
+
+async def traced(hop: Hop, work):
+    """
+    Runs the coroutine as the current hop, so model calls and outgoing messages are attributed to it.
+    """
+    token = current_hop.set(hop)
+    hop.start()
+    try:
+        return await work
+    finally:
+        hop.finish()
+        current_hop.reset(token)
+
+def outgoing_headers(headers=None, hop: Hop = None):
+    """
+    Adds the trace headers to the headers of a message published by the current hop.
+    """
+    hop = hop or current_hop.get()
+    headers = dict(headers or {})
+    if hop is not None:
+        headers["x-trace-id"] = hop.record["trace_id"]
+        headers["x-parent-hop"] = hop.record["id"]
+    headers["x-published-at"] = time.time()
+    return headers
+
+@contextmanager
+def llm_call():
+    hop = current_hop.get()
+    start = time.time()
+    try:
+        yield
+    finally:
+        if hop is not None:
+            hop.record["llm"].append([start, time.time()])
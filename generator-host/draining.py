@@ -0,0 +1,54 @@
+import asyncio
+import os
+import signal
+import time
+
+# seconds the messages in flight get to finish on shutdown, keep it below the stop grace period of the container
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "90"))
+
+async def drain(manager, timeout: float = DRAIN_TIMEOUT):
+    """
+    Cancels the consumers of the RabbitManager so no new messages arrive and waits
+    until the messages in flight are answered and acked, at most timeout seconds.
+    What is left is redelivered to another replica once the connection closes.
+    """
+    if manager is None:
+        return
+    if not manager.draining.is_set():
+        manager.draining.set()
+        print(f"Draining, {manager.in_flight} messages in flight...")
+        if manager.consuming.is_set():
+            # a consumer that is still connecting sees the flag and doesn't start consuming
+            await asyncio.to_thread(manager.run_on_connection, manager.cancel_consumers)
+    deadline = time.monotonic() + timeout
+    while manager.in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if manager.in_flight:
+        print(f"Drain timed out, {manager.in_flight} messages will be redelivered")
+    else:
+        print("Drained")
+
+def install(app):
+    """
+    Drains app.state.rabbit_manager when SIGTERM arrives, before the server shuts
+    down, so readiness reports draining while the work in flight finishes. The
+    signal is handed to the previous handler afterwards. Call from the lifespan,
+    once the server installed its own handlers.
+    """
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+    if previous is None:
+        # installed outside of Python, fall back to the default of terminating
+        previous = signal.SIG_DFL
+
+    async def drain_and_exit(signum):
+        try:
+            await drain(app.state.rabbit_manager)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            signal.raise_signal(signum)
+
+    def handler(signum, frame):
+        loop.call_soon_threadsafe(lambda: asyncio.ensure_future(drain_and_exit(signum)))
+
+    signal.signal(signal.SIGTERM, handler)
@@ -0,0 +1,402 @@
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+import os
+import sys
+import pika
+import threading
+import asyncio
+import importlib.util
+import json
+import functools
+import random
+import time
+from dead_letter import DLQ_MAX_REDELIVERIES, DLQ_MAX_RETRIES, declare_dead_letter_queue, error_reply, requeue, retry_or_dead_letter
+from ledger import Ledger, message_key
+import profiler
+import loop_monitor
+import trace_log
+import budget
+import providers
+import job_scheduler
+import affinity
+import draining
+import blob_store
+
+LOGFIRE_TOKEN = os.getenv("LOGFIRE_WRITE_TOKEN")
+if LOGFIRE_TOKEN:
+    # logfire pulls in OpenTelemetry, only pay for the import when traces are sent
+    import logfire
+
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", "60"))
+RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY", "30"))
+GENERATORS_CONFIG = os.getenv("GENERATORS_CONFIG", "generators.json")
+GENERATORS_DIR = os.getenv("GENERATORS_DIR", "generators")
+
+# the kind of a generator selects the generator code it runs
+KINDS = {
+    "language": "language-generator",
+    "diagram": "diagram-generator",
+    "software": "software-generator",
+}
+
+def reconnect_delay(attempt: int):
+    # exponential backoff with jitter so replicas don't reconnect in lockstep
+    return random.uniform(0.5, 1.0) * min(RECONNECT_MAX_DELAY, 2 ** attempt)
+
+def load_manager_class(kind: str):
+    """
+    Imports the OpenAiManager of a generator kind under its own module name, the
+    generator folders all have an openai_manager.py.
+    """
+    directory = os.path.join(GENERATORS_DIR, KINDS[kind])
+    if directory not in sys.path:
+        sys.path.append(directory)
+    name = f"{kind}_openai_manager"
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(directory, "openai_manager.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return sys.modules[name].OpenAiManager
+
+class Generator:
+    """
+    One generator definition from the config: the queue it consumes, its kind,
+    the number of messages it works on at once and optional overrides for the
+    instructions and the models.
+    """
+    def __init__(self, definition: dict):
+        self.queue = definition["queue"]
+        self.name = definition.get("name", self.queue)
+        self.kind = definition.get("kind", "language")
+        if self.kind not in KINDS:
+            raise ValueError(f"Unknown generator kind '{self.kind}' for '{self.name}'")
+        self.concurrency = int(definition.get("concurrency", 1))
+        # more messages are prefetched than worked on, the shortest estimated job goes first
+        self.jobs = job_scheduler.JobScheduler(self.concurrency)
+        self.jobs.register_gauges(self.queue)
+        self.instructions = definition.get("instructions")
+        self.model = definition.get("model")
+        self.fallback_model = definition.get("fallback_model")
+        self.oai_manager = None
+        self.channel = None
+
+    def create_oai_manager(self, client, schedulers: dict):
+        manager = load_manager_class(self.kind)(api_key=os.getenv("OPENAI_API_KEY"), client=client)
+        # OpenAI enforces its rate limits per model, so the generators pace requests together
+        manager.schedulers = schedulers
+        manager.service = self.name
+        if self.instructions:
+            manager.prompt = self.instructions
+        if self.model:
+            manager.model = self.model
+        if self.fallback_model:
+            manager.fallback_model = self.fallback_model
+        self.oai_manager = manager
+
+def load_generators(path: str = GENERATORS_CONFIG):
+    with open(path) as config:
+        return [Generator(definition) for definition in json.load(config)["generators"]]
+
+class RabbitManager:
+    """
+    Consumes the queues of all generators over one connection, with a channel
+    per generator so each keeps its own prefetch limit. All messages are
+    processed on one shared event loop.
+    """
+    def __init__(self, generators):
+        self.connection = None
+        self.thread = None
+        self.generators = generators
+        self.connected = threading.Event()
+        self.consuming = threading.Event()
+        self._closing = False
+        self._reconnect_attempts = 0
+        # set on shutdown, no new messages are taken while the ones in flight finish
+        self.draining = threading.Event()
+        self.in_flight = 0
+        # requests are processed on their own event loop so the pika thread keeps serving heartbeats
+        self.loop = asyncio.new_event_loop()
+        self.worker = threading.Thread(target=self.loop.run_forever, name="message-loop", daemon=True)
+        self.loop_monitor = loop_monitor.LoopMonitor("generator-host", "messages")
+        self.ledger = Ledger()
+
+    def start_in_background(self):
+        self.worker.start()
+        self.loop_monitor.start(self.loop)
+        self.thread = threading.Thread(target=self._run, name="rabbitmq-consumer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self._closing:
+            try:
+                self.setup_queues()
+            except Exception as e:
+                if self._closing:
+                    break
+                delay = reconnect_delay(self._reconnect_attempts)
+                self._reconnect_attempts += 1
+                print(f"RabbitMQ consumer error: {e!r}, reconnecting in {delay:.1f}s...")
+                time.sleep(delay)
+
+    def setup_queues(self):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq', heartbeat=RABBITMQ_HEARTBEAT))
+        self.connected.set()
+        try:
+            for generator in self.generators:
+                channel = self.connection.channel()
+                channel.queue_declare(queue=generator.queue, durable=True)
+                declare_dead_letter_queue(channel, generator.queue)
+
+                # the limit is shared by the consumers of the channel, affinity routing adds one for the replica queue
+                channel.basic_qos(prefetch_count=generator.jobs.prefetch, global_qos=True)
+                if not self.draining.is_set():
+                    affinity.consume(channel, generator.queue, functools.partial(self.on_request, generator))
+                generator.channel = channel
+                print(f"Waiting RPC request on '{generator.queue}' queue.")
+            self.consuming.set()
+            self._reconnect_attempts = 0
+
+            while not self._closing:
+                self.connection.process_data_events(time_limit=1)
+        finally:
+            self.connected.clear()
+            self.consuming.clear()
+            if self._closing and self.connection.is_open:
+                self.connection.close()
+
+    async def process_message(self, generator: Generator, message):
+        print(f"Got {generator.name} request...")
+        try:
+            response = await generator.oai_manager.get_response(message)
+        except Exception as e:
+            print(f"Generation failed: {e!r}")
+            return f"Error generating response: {e}"
+        print(f"Returning {generator.name} request...")
+        return response
+
+    async def handle_message(self, generator: Generator, properties, message):
+        budget.start(properties)
+        response = await self.process_message(generator, message)
+        # large answers travel up to the api-gateway as a reference
+        self.reply(generator, properties, blob_store.offload(response))
+
+    async def stream_longform(self, generator: Generator, properties, message):
+        budget.start(properties)
+        print("Got long-form request...")
+        try:
+            async for section in generator.oai_manager.get_longform_stream(message):
+                self.reply(generator, properties, json.dumps({"type": "section", **section}), final=False)
+            self.reply(generator, properties, json.dumps({"type": "done"}), final=True)
+        except budget.BudgetExhausted as e:
+            # the sections sent so far are the answer
+            print(f"Long-form generation stopped: {e}")
+            self.reply(generator, properties, json.dumps({"type": "done", "truncated": str(e)}), final=True)
+        except Exception as e:
+            print(f"Long-form generation failed: {e!r}")
+            self.reply(generator, properties, json.dumps({"type": "error", "message": str(e)}), final=True)
+        print("Finished long-form request...")
+
+    async def stream_project(self, generator: Generator, properties, message):
+        budget.start(properties)
+        print("Got project request...")
+        try:
+            async for event in generator.oai_manager.get_project_stream(message):
+                self.reply(generator, properties, json.dumps(event), final=event["type"] == "manifest")
+        except Exception as e:
+            print(f"Project generation failed: {e!r}")
+            self.reply(generator, properties, json.dumps({"type": "error", "message": str(e)}), final=True)
+        print("Finished project request...")
+
+    def cancel_consumers(self):
+        for generator in self.generators:
+            if generator.channel is None:
+                continue
+            affinity.leave(generator.channel, generator.queue)
+            for consumer_tag in list(generator.channel.consumer_tags):
+                generator.channel.basic_cancel(consumer_tag)
+
+    def run_on_connection(self, callback):
+        """
+        Runs the callback on the consumer thread, pika connections are not thread safe.
+        Waits for a reconnect when the connection is down.
+        """
+        while not self._closing:
+            connection = self.connection
+            try:
+                connection.add_callback_threadsafe(callback)
+                return
+            except Exception:
+                self.consuming.wait(timeout=1)
+
+    def reply(self, generator: Generator, properties, body, final=None):
+        self.ledger.add_reply(message_key(properties), body, final)
+        # the budget belongs to the task, read what it spent before handing over to the consumer thread
+        self.run_on_connection(functools.partial(self.publish_reply, generator, properties, body, final, budget.reply_headers()))
+
+    def publish_reply(self, generator: Generator, properties, body, final=None, headers=None):
+        headers = dict(headers or {})
+        if final is not None:
+            # replies of a streamed request carry a final header, the last one has it set
+            headers["final"] = final
+        generator.channel.basic_publish(exchange='',
+                                        routing_key=properties.reply_to,
+                                        body=body,
+                                        properties=pika.BasicProperties(
+                                            correlation_id=properties.correlation_id,
+                                            delivery_mode = pika.DeliveryMode.Persistent,
+                                            headers=headers or None,
+                                        ))
+
+    def on_request(self, generator: Generator, ch, method, properties, body):
+        hop = trace_log.Hop.from_properties("generator-host", generator.queue, properties)
+        replies = self.ledger.lookup(message_key(properties))
+        if replies is not None:
+            # answered before, but the ack never reached the broker
+            print("Replaying stored result...")
+            if not replies:
+                # the replies of a stream are not kept, end it so the caller doesn't wait for it
+                replies = [(error_reply(properties, "the stream was interrupted, send the request again").encode(), True)]
+            for reply_body, final in replies:
+                self.publish_reply(generator, properties, reply_body, final)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        if method.redelivered:
+            # the previous attempt never settled, the connection dropped or the consumer died,
+            # it goes to the back of the queue, counted apart from the failed attempts
+            self.requeue(generator, ch, method.delivery_tag, properties, body)
+            return
+        message = str(body)
+        mode = (properties.headers or {}).get("mode")
+
+        if mode == "longform" and generator.kind == "language":
+            work = self.stream_longform(generator, properties, message)
+        elif mode == "project" and generator.kind == "software":
+            work = self.stream_project(generator, properties, message)
+        else:
+            work = self.handle_message(generator, properties, message)
+        job = job_scheduler.Job(message, mode)
+        self.in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(generator.jobs.run(job, trace_log.traced(hop, work)), self.loop)
+        future.add_done_callback(functools.partial(self.on_done, generator, ch, method.delivery_tag, properties, body))
+
+    def on_done(self, generator: Generator, ch, delivery_tag, properties, body, future):
+        def settle():
+            try:
+                if not ch.is_open:
+                    # the delivery tag belongs to the old channel, the redelivery is answered from the ledger
+                    print("Channel closed before the message was acknowledged")
+                elif future.exception() is not None:
+                    print(f"Processing failed: {future.exception()!r}")
+                    self.retry_or_dead_letter(generator, ch, delivery_tag, properties, body, repr(future.exception()))
+                else:
+                    ch.basic_ack(delivery_tag=delivery_tag)
+            finally:
+                self.in_flight -= 1
+        self.run_on_connection(settle)
+
+    def requeue(self, generator: Generator, ch, delivery_tag, properties, body):
+        if requeue(ch, generator.queue, delivery_tag, properties, body):
+            print(f"Message redelivered {DLQ_MAX_REDELIVERIES + 1} times, moved to the dead-letter queue")
+            self.publish_reply(generator, properties, error_reply(properties, "redelivered too often without finishing"))
+
+    def retry_or_dead_letter(self, generator: Generator, ch, delivery_tag, properties, body, error):
+        if retry_or_dead_letter(ch, generator.queue, delivery_tag, properties, body, error):
+            print(f"Message failed {DLQ_MAX_RETRIES + 1} times, moved to the dead-letter queue")
+            # not written to the ledger, a replay of the dead letter has to run the message again
+            self.publish_reply(generator, properties, error_reply(properties, error))
+
+    def close(self):
+        self._closing = True
+        self.loop_monitor.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+def create_generators():
+    # importing the OpenAI client is slow, keep it off the startup path
+    from openai import AsyncOpenAI
+    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0, http_client=providers.registry.http_client(providers.DEFAULT_PROVIDER))
+    schedulers = {}
+    generators = load_generators()
+    for generator in generators:
+        generator.create_oai_manager(client, schedulers)
+    return generators
+
+def has_model(generators):
+    return all(generator.oai_manager.model or generator.oai_manager.available_models for generator in generators)
+
+async def refresh_models(generators):
+    # the client is shared, so one listing serves every generator
+    await generators[0].oai_manager.get_available_models()
+    for generator in generators[1:]:
+        generator.oai_manager.available_models = generators[0].oai_manager.available_models
+
+async def initialize(app: FastAPI):
+    generators = await asyncio.to_thread(create_generators)
+    app.state.generators = generators
+
+    await refresh_models(generators)
+    while not has_model(generators):
+        await asyncio.sleep(10)
+        await refresh_models(generators)
+    # messages are only taken once every generator has a model to answer them with
+    app.state.rabbit_manager = RabbitManager(generators)
+    app.state.rabbit_manager.start_in_background()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.loop_monitor = loop_monitor.LoopMonitor("generator-host", "http")
+    app.state.loop_monitor.start()
+    app.state.generators = []
+    app.state.rabbit_manager = None
+    init_task = asyncio.create_task(initialize(app))
+    draining.install(app)
+    yield
+    init_task.cancel()
+    if app.state.rabbit_manager:
+        await draining.drain(app.state.rabbit_manager)
+        app.state.rabbit_manager.close()
+    app.state.loop_monitor.stop()
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(profiler.router)
+app.include_router(loop_monitor.router)
+app.include_router(providers.router)
+
+if LOGFIRE_TOKEN:
+    logfire.configure(token=LOGFIRE_TOKEN, send_to_logfire="if-token-present", service_name="generator-host")
+    logfire.instrument_fastapi(app, capture_headers=True)
+
+@app.head("/")
+@app.api_route("/live", methods=["GET", "HEAD"])
+async def health_check():
+    return {"status": "ok"}
+
+@app.api_route("/ready", methods=["GET", "HEAD"])
+async def readiness_check(request: Request):
+    rabbit_manager = request.app.state.rabbit_manager
+    generators = request.app.state.generators
+    checks = {
+        "broker": rabbit_manager is not None and rabbit_manager.connected.is_set(),
+        "consumer": rabbit_manager is not None and rabbit_manager.consuming.is_set(),
+        "model": bool(generators) and has_model(generators),
+    }
+    if rabbit_manager is not None and rabbit_manager.draining.is_set():
+        # shutting down, take no new requests while the ones in flight finish
+        return JSONResponse({"status": "draining", "checks": checks}, status_code=503)
+    ready = all(checks.values())
+    return JSONResponse({"status": "ready" if ready else "not ready", "checks": checks}, status_code=200 if ready else 503)
+
+@app.get("/models")
+async def get_models(request: Request):
+    generators = request.app.state.generators
+    if not generators:
+        return {"available_models": []}
+    return {"available_models": generators[0].oai_manager.available_models}
+
+@app.get("/generators")
+async def get_generators(request: Request):
+    return [
+        {"name": generator.name, "kind": generator.kind, "queue": generator.queue, "concurrency": generator.concurrency}
+        for generator in request.app.state.generators
+    ]
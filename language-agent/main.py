@@ -1,13 +1,32 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 import os
-import logfire
-from pydantic_ai import Agent
 import pika
 import threading
 import asyncio
+import functools
+import random
+from resilience import ResilientCaller
 import uuid
 import time
+from dead_letter import DLQ_MAX_REDELIVERIES, DLQ_MAX_RETRIES, declare_dead_letter_queue, error_reply, requeue, retry_or_dead_letter
+from ledger import Ledger, message_key
+import profiler
+import trace_log
+import budget
+import providers
+import affinity
+import draining
+
+# llm: always let the agent handle the request, passthrough: always forward it
+# to the generator unchanged, auto: forward unless the caller asks for a rewrite.
+AGENT_MODE = os.getenv("AGENT_MODE", "llm")
+
+AGENT_MODEL = os.getenv("AGENT_MODEL", "gpt-4o-2024-05-13")
+AGENT_FALLBACK_MODEL = os.getenv("AGENT_FALLBACK_MODEL")
+# bounds a single model request of an agent run, well below the request budget so a retry still fits
+AGENT_ATTEMPT_TIMEOUT = float(os.getenv("AGENT_ATTEMPT_TIMEOUT", "40"))
 
 class RabbitSender:
     def __init__(self):
@@ -15,6 +34,7 @@ class RabbitSender:
         self.channel = None
         self.callback_queue = None
         self.response = None
+        self.response_headers = None
         self.corr_id = None
         self._lock = threading.Lock()
         self._connected = threading.Event()
@@ -23,18 +43,19 @@ class RabbitSender:
         self._start_connection_thread()
 
     def _start_connection_thread(self):
-        t = threading.Thread(target=self._run, daemon=True)
+        t = threading.Thread(target=self._run, name="rabbitmq-io", daemon=True)
         t.start()
 
     def _run(self):
         while not self._closing:
             try:
                 self._connect()
-                self._connected.set()
                 self.connection.ioloop.start()
             except Exception as e:
                 print(f"RabbitMQ connection error: {e}, retrying in 5s...")
-                self._connected.clear()
+            # the ioloop also returns when the connection could not be opened, don't reconnect in a tight loop
+            self._connected.clear()
+            if not self._closing:
                 time.sleep(5)
 
     def _connect(self):
@@ -61,6 +82,7 @@ class RabbitSender:
 
     def on_channel_open(self, channel):
         self.channel = channel
+        affinity.declare_exchanges(channel, ('language-generator',))
         self.channel.queue_declare('', exclusive=True, durable=True, callback=self.on_queue_declared)
 
     def on_queue_declared(self, method_frame):
@@ -70,25 +92,37 @@ class RabbitSender:
             on_message_callback=self.on_response,
             auto_ack=True
         )
+        self._connected.set()
 
     def on_response(self, ch, method, properties, body):
         if self.corr_id == properties.correlation_id:
+            self.response_headers = properties.headers or {}
             self.response = body
 
     def call(self, message: str, timeout=120):
+        request_budget = budget.current_budget.get()
+        headers = affinity.outgoing_headers()
+        if request_budget is not None:
+            request_budget.start_tool_call()
+            headers = request_budget.headers(headers)
+            remaining = request_budget.remaining_seconds()
+            if remaining is not None:
+                timeout = min(timeout, remaining)
         if not self._connected.wait(timeout=timeout):
             raise Exception("RabbitMQ not connected")
         with self._lock:
             self.response = None
             self.corr_id = str(uuid.uuid4())
             print("Calling language generator...")
+            exchange, key = affinity.target('language-generator', headers)
             self.channel.basic_publish(
-                exchange='',
-                routing_key='language-generator',
+                exchange=exchange,
+                routing_key=key,
                 properties=pika.BasicProperties(
                     reply_to=self.callback_queue,
                     correlation_id=self.corr_id,
-                    delivery_mode=pika.DeliveryMode.Persistent
+                    delivery_mode=pika.DeliveryMode.Persistent,
+                    headers=trace_log.outgoing_headers(headers)
                 ),
                 body=message
             )
@@ -98,6 +132,9 @@ class RabbitSender:
                 time.sleep(0.01)
             if self.response is None:
                 raise TimeoutError("No response from RPC call")
+            if request_budget is not None:
+                request_budget.charge_reply(self.response_headers)
+                request_budget.results.append(self.response)
             return self.response
 
     def close(self):
@@ -117,80 +154,288 @@ def call_text_generator(request: str) -> str:
     except Exception as e:
         return f"Error calling language-generator: {e}"
 
-logfire.configure(token=os.getenv("LOGFIRE_WRITE_TOKEN"), send_to_logfire="if-token-present", service_name="language-agent")
+LOGFIRE_TOKEN = os.getenv("LOGFIRE_WRITE_TOKEN")
+if LOGFIRE_TOKEN:
+    # logfire pulls in OpenTelemetry, only pay for the import when traces are sent
+    import logfire
+    logfire.configure(token=LOGFIRE_TOKEN, send_to_logfire="if-token-present", service_name="language-agent")
+
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", "60"))
+RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY", "30"))
+
+def reconnect_delay(attempt: int):
+    # exponential backoff with jitter so replicas don't reconnect in lockstep
+    return random.uniform(0.5, 1.0) * min(RECONNECT_MAX_DELAY, 2 ** attempt)
 
 class RabbitManager:
-    def __init__(self, agent: Agent):
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+    def __init__(self, agent: "Agent"):
+        self.connection = None
+        self.channel = None
         self.thread = None
         self.agent = agent
+        self.connected = threading.Event()
+        self.consuming = threading.Event()
+        self._closing = False
+        self._reconnect_attempts = 0
+        # set on shutdown, no new messages are taken while the ones in flight finish
+        self.draining = threading.Event()
+        self.in_flight = 0
+        # requests are processed on their own event loop so the pika thread keeps serving heartbeats
+        self.loop = asyncio.new_event_loop()
+        self.worker = threading.Thread(target=self.loop.run_forever, name="message-loop", daemon=True)
+        self.ledger = Ledger()
+        # the agent is created by now, so pydantic-ai is already imported
+        from pydantic_ai.exceptions import UsageLimitExceeded
+        self.budget_errors = (budget.BudgetExhausted, UsageLimitExceeded)
+        # a model per routed model, so every routed model has its own circuit breakers
+        self.models = {}
+
+    def get_model(self, model: str):
+        if model not in self.models:
+            from resilient_model import ResilientModel
+            # no hedging here, an agent request carries the whole conversation and a duplicate costs as much again
+            self.models[model] = ResilientModel(ResilientCaller(
+                model,
+                fallback_model=AGENT_FALLBACK_MODEL,
+                attempt_timeout=AGENT_ATTEMPT_TIMEOUT,
+                hedge=False,
+                non_retryable=self.budget_errors,
+            ))
+        return self.models[model]
 
     def get_channel(self):
         return self.connection.channel()
 
     def start_in_background(self):
-        self.thread = threading.Thread(target=self.setup_queue, daemon=True)
+        self.worker.start()
+        self.thread = threading.Thread(target=self._run, name="rabbitmq-consumer", daemon=True)
         self.thread.start()
 
+    def _run(self):
+        while not self._closing:
+            try:
+                self.setup_queue()
+            except Exception as e:
+                if self._closing:
+                    break
+                delay = reconnect_delay(self._reconnect_attempts)
+                self._reconnect_attempts += 1
+                print(f"RabbitMQ consumer error: {e!r}, reconnecting in {delay:.1f}s...")
+                time.sleep(delay)
+
     async def process_message(self, message):
-        response = await self.agent.run(message)
+        request_budget = budget.current_budget.get()
+        try:
+            request_budget.check()
+            with trace_log.llm_call():
+                # retries and failover happen per model request, the tool calls of the run are made once
+                model = self.get_model(providers.registry.choose("language-agent", len(message) // 4) or AGENT_MODEL)
+                response = await budget.before_deadline(self.agent.run(
+                    message, model=model, usage_limits=request_budget.usage_limits()
+                ))
+        except self.budget_errors as e:
+            # answer with what the tools returned so far
+            print(f"Agent run stopped, budget exhausted: {e}")
+            return request_budget.partial() or f"Error running language-agent: {e}"
+        except Exception as e:
+            print(f"Agent run failed: {e!r}")
+            return f"Error running language-agent: {e}"
+        request_budget.charge(tokens=response.usage().total_tokens or 0)
         return response.output
 
+    def use_passthrough(self, properties):
+        if AGENT_MODE == "passthrough":
+            return True
+        if AGENT_MODE == "auto":
+            headers = properties.headers or {}
+            return not headers.get("rewrite", False)
+        return False
+
     def setup_queue(self):
-        channel = self.get_channel()
-        channel.queue_declare(queue='language-agent', durable=True)
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq', heartbeat=RABBITMQ_HEARTBEAT))
+        self.connected.set()
+        try:
+            channel = self.get_channel()
+            channel.queue_declare(queue='language-agent', durable=True)
+            declare_dead_letter_queue(channel, 'language-agent')
+
+            # the limit is shared by the consumers of the channel, affinity routing adds one for the replica queue
+            channel.basic_qos(prefetch_count=1, global_qos=True)
+            if not self.draining.is_set():
+                affinity.consume(channel, 'language-agent', self.on_request)
+            self.channel = channel
+            self.consuming.set()
+            self._reconnect_attempts = 0
+
+            print("Waiting RPC request on 'language-agent' queue.")
+            channel.start_consuming()
+            # draining, the replies and acks of the messages in flight still go out over this connection
+            while self.draining.is_set() and not self._closing:
+                self.connection.process_data_events(time_limit=1)
+        finally:
+            self.connected.clear()
+            self.consuming.clear()
+            if self._closing and self.connection.is_open:
+                self.connection.close()
 
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(queue='language-agent', on_message_callback=self.on_request)
+    async def handle_message(self, properties, body):
+        budget.start(properties)
+        affinity.start(properties)
+        await asyncio.sleep(5) # sleep for 5 seconds to simulate processing time, used for demonstration purposes
 
-        print("Waiting RPC request on 'language-agent' queue.")
-        channel.start_consuming()
+        if self.use_passthrough(properties):
+            print("Passing request through to the generator...")
+            response = await asyncio.to_thread(call_text_generator, body)
+        else:
+            response = await self.process_message(str(body))
+        self.reply(properties, response)
+
+    def cancel_consumers(self):
+        affinity.leave(self.channel, 'language-agent')
+        for consumer_tag in list(self.channel.consumer_tags):
+            self.channel.basic_cancel(consumer_tag)
+
+    def run_on_connection(self, callback):
+        """
+        Runs the callback on the consumer thread, pika connections are not thread safe.
+        Waits for a reconnect when the connection is down.
+        """
+        while not self._closing:
+            connection = self.connection
+            try:
+                connection.add_callback_threadsafe(callback)
+                return
+            except Exception:
+                self.consuming.wait(timeout=1)
+
+    def reply(self, properties, body, final=None):
+        self.ledger.add_reply(message_key(properties), body, final)
+        # the budget belongs to the task, read what it spent before handing over to the consumer thread
+        self.run_on_connection(functools.partial(self.publish_reply, properties, body, final, budget.reply_headers()))
+
+    def publish_reply(self, properties, body, final=None, headers=None):
+        headers = dict(headers or {})
+        if final is not None:
+            # replies of a streamed request carry a final header, the last one has it set
+            headers["final"] = final
+        self.channel.basic_publish(exchange='',
+                                   routing_key=properties.reply_to,
+                                   body=body,
+                                   properties=pika.BasicProperties(
+                                       correlation_id=properties.correlation_id,
+                                       delivery_mode = pika.DeliveryMode.Persistent,
+                                       headers=headers or None,
+                                   ))
 
     def on_request(self, ch, method, properties, body):
         print("Received request...")
-        time.sleep(5) # sleep for 5 seconds to simulate processing time, used for demonstration purposes
+        hop = trace_log.Hop.from_properties("language-agent", "language-agent", properties)
+        replies = self.ledger.lookup(message_key(properties))
+        if replies is not None:
+            # answered before, but the ack never reached the broker
+            print("Replaying stored result...")
+            if not replies:
+                # the replies of a stream are not kept, end it so the caller doesn't wait for it
+                replies = [(error_reply(properties, "the stream was interrupted, send the request again").encode(), True)]
+            for reply_body, final in replies:
+                self.publish_reply(properties, reply_body, final)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        if method.redelivered:
+            # the previous attempt never settled, the connection dropped or the consumer died,
+            # it goes to the back of the queue, counted apart from the failed attempts
+            self.requeue(ch, method.delivery_tag, properties, body)
+            return
+        work = self.handle_message(properties, body)
+        self.in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(trace_log.traced(hop, work), self.loop)
+        future.add_done_callback(functools.partial(self.on_done, ch, method.delivery_tag, properties, body))
 
-        message = str(body)
+    def on_done(self, ch, delivery_tag, properties, body, future):
+        def settle():
+            try:
+                if not ch.is_open:
+                    # the delivery tag belongs to the old channel, the redelivery is answered from the ledger
+                    print("Channel closed before the message was acknowledged")
+                elif future.exception() is not None:
+                    print(f"Processing failed: {future.exception()!r}")
+                    self.retry_or_dead_letter(ch, delivery_tag, properties, body, repr(future.exception()))
+                else:
+                    ch.basic_ack(delivery_tag=delivery_tag)
+            finally:
+                self.in_flight -= 1
+        self.run_on_connection(settle)
 
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            response = loop.run_until_complete(self.process_message(message))
-        finally:
-            loop.close()
+    def requeue(self, ch, delivery_tag, properties, body):
+        if requeue(ch, 'language-agent', delivery_tag, properties, body):
+            print(f"Message redelivered {DLQ_MAX_REDELIVERIES + 1} times, moved to the dead-letter queue")
+            self.publish_reply(properties, error_reply(properties, "redelivered too often without finishing"))
 
-        ch.basic_publish(exchange='',
-                         routing_key=properties.reply_to,
-                         body=response,
-                         properties=pika.BasicProperties(
-                             correlation_id=properties.correlation_id,
-                             delivery_mode = pika.DeliveryMode.Persistent,
-                         ))
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    def retry_or_dead_letter(self, ch, delivery_tag, properties, body, error):
+        if retry_or_dead_letter(ch, 'language-agent', delivery_tag, properties, body, error):
+            print(f"Message failed {DLQ_MAX_RETRIES + 1} times, moved to the dead-letter queue")
+            # not written to the ledger, a replay of the dead letter has to run the message again
+            self.publish_reply(properties, error_reply(properties, error))
 
     def close(self):
-        self.connection.close()
+        self._closing = True
+        if self.channel and self.connection and self.connection.is_open:
+            try:
+                self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+            except Exception as e:
+                print(f"Error stopping consumer: {e!r}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    agent = Agent(
-        'gpt-4o-2024-05-13',
+def create_agent():
+    # pydantic-ai is slow to import, keep it off the startup path
+    from pydantic_ai import Agent
+    return Agent(
+        AGENT_MODEL,
         deps_type=str,
         tools=[call_text_generator],
         system_prompt=(
-            "You're a text agent. You use your tools to generate text based on user requests. You do not generate text directly, but instead use your tools to call the language generator service."
+            "You're a text agent. You use your tools to generate text based on user requests. You do not generate text directly, but instead use your tools to call the language generator service. Tool results can be references such as [[blob:<id>]] to large outputs, put them into your answer unchanged where the output belongs instead of writing it out, they are replaced by the output before the answer is returned."
         ),
         instrument=True,
     )
 
+async def initialize(app: FastAPI):
+    agent = await asyncio.to_thread(create_agent)
     app.state.rabbit_manager = RabbitManager(agent)
     app.state.rabbit_manager.start_in_background()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.rabbit_manager = None
+    init_task = asyncio.create_task(initialize(app))
+    draining.install(app)
     yield
-    app.state.rabbit_manager.close()
+    init_task.cancel()
+    if app.state.rabbit_manager:
+        await draining.drain(app.state.rabbit_manager)
+        app.state.rabbit_manager.close()
 
 app = FastAPI(lifespan=lifespan)
-logfire.instrument_fastapi(app, capture_headers=True)
+app.include_router(profiler.router)
+app.include_router(providers.router)
+if LOGFIRE_TOKEN:
+    logfire.instrument_fastapi(app, capture_headers=True)
 
 @app.head("/")
+@app.api_route("/live", methods=["GET", "HEAD"])
 async def health_check():
     return {"status": "ok"}
+
+@app.api_route("/ready", methods=["GET", "HEAD"])
+async def readiness_check(request: Request):
+    rabbit_manager = request.app.state.rabbit_manager
+    checks = {
+        "broker": rabbit_sender._connected.is_set() and rabbit_manager is not None and rabbit_manager.connected.is_set(),
+        "consumer": rabbit_manager is not None and rabbit_manager.consuming.is_set(),
+        "agent": rabbit_manager is not None and rabbit_manager.agent is not None,
+    }
+    if rabbit_manager is not None and rabbit_manager.draining.is_set():
+        # shutting down, take no new requests while the ones in flight finish
+        return JSONResponse({"status": "draining", "checks": checks}, status_code=503)
+    ready = all(checks.values())
+    return JSONResponse({"status": "ready" if ready else "not ready", "checks": checks}, status_code=200 if ready else 503)
@@ -0,0 +1,33 @@
+from pydantic_ai.models import infer_model
+from pydantic_ai.models.wrapper import WrapperModel
+from resilience import ResilientCaller
+import providers
+
+_models = {}
+
+def resolve(ref: str):
+    """
+    The pydantic-ai model for a model reference, created once per reference.
+    """
+    if ref not in _models:
+        model = providers.registry.agent_model(ref)
+        if isinstance(model, str):
+            # plain names are OpenAI models, like everywhere else in the services
+            model = infer_model(model if ":" in model else f"openai:{model}")
+        _models[ref] = model
+    return _models[ref]
+
+class ResilientModel(WrapperModel):
+    """
+    Sends every model request of an agent run through a ResilientCaller. A
+    request is retried or failed over on its own, the tool calls the run made
+    before it are not made again.
+    """
+    def __init__(self, caller: ResilientCaller):
+        super().__init__(resolve(caller.primary_model))
+        self.caller = caller
+
+    async def request(self, messages, model_settings, model_request_parameters):
+        return await self.caller.call(
+            lambda model: resolve(model).request(messages, model_settings, model_request_parameters)
+        )
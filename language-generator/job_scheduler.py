@@ -0,0 +1,175 @@
+import asyncio
+import math
+import os
+import re
+import time
+from collections import deque
+from budget import current_budget
+import loop_monitor
+
+# messages held back beyond the ones being worked on, so a short job can overtake longer ones, 0 keeps FIFO
+SJF_BUFFER = int(os.getenv("SJF_BUFFER", "8"))
+# seconds of estimated work a job is forgiven per second it waited, so long jobs still get their turn
+SJF_AGING = float(os.getenv("SJF_AGING", "1.0"))
+# estimates for job shapes that were not seen often enough yet
+SJF_MIN_SAMPLES = int(os.getenv("SJF_MIN_SAMPLES", "3"))
+SJF_PRIOR_OUTPUT_TOKENS = int(os.getenv("SJF_PRIOR_OUTPUT_TOKENS", "500"))
+SJF_PRIOR_TOKENS_PER_SECOND = float(os.getenv("SJF_PRIOR_TOKENS_PER_SECOND", "50"))
+
+# output tokens per unit of a requested size, "a 300 word summary", "a 5 page report"
+SIZE_PATTERN = re.compile(r"(\d[\d,]*)\s*(words?|lines?|pages?|paragraphs?|sections?|files?)\b", re.IGNORECASE)
+SIZE_TOKENS = {"word": 1.35, "line": 12, "page": 650, "paragraph": 150, "section": 400, "file": 600}
+# streamed modes produce far more than a single answer
+MODE_PRIOR_TOKENS = {"longform": 4000, "project": 8000}
+
+def requested_tokens(message: str):
+    """
+    The output size the request asks for in tokens, None when it names none.
+    """
+    tokens = 0
+    for amount, unit in SIZE_PATTERN.findall(message):
+        tokens += int(amount.replace(",", "")) * SIZE_TOKENS[unit.lower().rstrip("s")]
+    return int(tokens) or None
+
+class Job:
+    """
+    A message waiting for or holding a slot, with the features its estimate is based on.
+    """
+    def __init__(self, message: str, mode: str = None):
+        self.mode = mode or "default"
+        self.input_tokens = len(message) // 4 + 1
+        self.requested_tokens = requested_tokens(message)
+        self.tokens = None
+        self.seconds = None
+        self.queued = time.monotonic()
+        self.started = None
+        self.slot = None
+
+    @property
+    def key(self):
+        # jobs of the same mode and about the same size, in powers of two
+        if self.requested_tokens:
+            return (self.mode, "requested", int(math.log2(self.requested_tokens)))
+        return (self.mode, "input", int(math.log2(self.input_tokens)))
+
+    def priority(self, now: float):
+        return self.seconds - SJF_AGING * (now - self.queued)
+
+class Average:
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.count = 0
+        self.tokens = None
+        self.seconds = None
+
+    def add(self, tokens: float, seconds: float):
+        self.count += 1
+        if self.tokens is None:
+            self.tokens, self.seconds = tokens, seconds
+            return
+        self.tokens += self.alpha * (tokens - self.tokens)
+        self.seconds += self.alpha * (seconds - self.seconds)
+
+class JobEstimator:
+    """
+    Predicts the tokens a job spends and how long it runs from the averages of
+    finished jobs of the same shape, falling back to its mode and then to the
+    requested size at a nominal model speed. Tracks how far off it was.
+    """
+    def __init__(self, window: int = 200):
+        self.averages = {}
+        self.errors = deque(maxlen=window)
+
+    def lookup(self, key):
+        average = self.averages.get(key)
+        return average if average is not None and average.count >= SJF_MIN_SAMPLES else None
+
+    def estimate(self, job: Job):
+        average = self.lookup(job.key) or self.lookup((job.mode,))
+        if average is not None:
+            job.tokens, job.seconds = average.tokens, average.seconds
+            return
+        job.tokens = job.input_tokens + (job.requested_tokens or MODE_PRIOR_TOKENS.get(job.mode, SJF_PRIOR_OUTPUT_TOKENS))
+        job.seconds = 1 + job.tokens / SJF_PRIOR_TOKENS_PER_SECOND
+
+    def record(self, job: Job, tokens: int, seconds: float):
+        # signed relative error of the runtime estimate
+        self.errors.append((job.seconds - seconds) / max(seconds, 0.1))
+        for key in (job.key, (job.mode,)):
+            self.averages.setdefault(key, Average()).add(tokens or job.tokens, seconds)
+
+    def mean_error(self):
+        return sum(abs(error) for error in self.errors) / len(self.errors) if self.errors else 0.0
+
+    def bias(self):
+        return sum(self.errors) / len(self.errors) if self.errors else 0.0
+
+class JobScheduler:
+    """
+    Runs at most concurrency jobs at once on the message loop. Further jobs wait
+    in a buffer and the one with the least estimated work, less its aging
+    credit, goes next. Jobs only wait when all slots are taken, so with an
+    empty buffer it behaves like FIFO.
+    """
+    def __init__(self, concurrency: int = 1, estimator: JobEstimator = None):
+        self.concurrency = concurrency
+        self.estimator = estimator or JobEstimator()
+        self.running = 0
+        self.waiting = []
+        self.finished = 0
+
+    @property
+    def prefetch(self):
+        return self.concurrency + SJF_BUFFER
+
+    def register_gauges(self, queue: str):
+        labels = {"queue": queue}
+        loop_monitor.register_gauge("jobs_running", "Jobs being worked on.", lambda: self.running, labels)
+        loop_monitor.register_gauge("jobs_waiting", "Jobs held in the reorder buffer.", lambda: len(self.waiting), labels)
+        loop_monitor.register_gauge(
+            "job_estimate_error_ratio", "Mean absolute error of the recent job runtime estimates, relative to the runtime.",
+            self.estimator.mean_error, labels,
+        )
+        loop_monitor.register_gauge(
+            "job_estimate_bias_ratio", "Mean signed error of the recent job runtime estimates, above zero they were too long.",
+            self.estimator.bias, labels,
+        )
+
+    async def run(self, job: Job, work):
+        """
+        Awaits the work once the job gets a slot and learns from its runtime and the tokens its budget was charged.
+        """
+        self.estimator.estimate(job)
+        if self.running < self.concurrency and not self.waiting:
+            self.running += 1
+        else:
+            job.slot = asyncio.get_running_loop().create_future()
+            self.waiting.append(job)
+            try:
+                # release takes the slot for the job before it wakes it up
+                await job.slot
+            except asyncio.CancelledError:
+                if job in self.waiting:
+                    self.waiting.remove(job)
+                else:
+                    self.release()
+                work.close()
+                raise
+        job.started = time.monotonic()
+        try:
+            return await work
+        finally:
+            # the work started the budget of this task
+            budget = current_budget.get()
+            self.estimator.record(job, budget.used_tokens if budget is not None else None, time.monotonic() - job.started)
+            self.finished += 1
+            self.release()
+
+    def release(self):
+        self.running -= 1
+        now = time.monotonic()
+        while self.waiting and self.running < self.concurrency:
+            job = min(self.waiting, key=lambda waiting: waiting.priority(now))
+            self.waiting.remove(job)
+            self.running += 1
+            job.slot.set_result(None)
@@ -0,0 +1,56 @@
+import json
+import re
+
+WORD_COUNT_PATTERN = re.compile(r"(\d[\d,.]*)\s*(k)?[\s-]*words?\b", re.I)
+
+def requested_words(message: str):
+    """
+    Returns the largest word count asked for in the request, e.g. "a
+    5,000-word report" or "5k words", or None when no length is mentioned.
+    """
+    counts = []
+    for number, thousands in WORD_COUNT_PATTERN.findall(message):
+        try:
+            value = float(number.replace(",", ""))
+        except ValueError:
+            continue
+        counts.append(int(value * 1000) if thousands else int(value))
+    return max(counts) if counts else None
+
+def parse_outline(text: str):
+    """
+    Parses the outline returned by the model into a list of sections with a
+    title, a brief and a target word count. Returns an empty list when the
+    output is not a usable outline.
+    """
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end <= start:
+        return []
+    try:
+        items = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return []
+    sections = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("title"):
+            continue
+        try:
+            words = int(item.get("words") or 0)
+        except (TypeError, ValueError):
+            words = 0
+        sections.append({
+            "title": str(item["title"]),
+            "brief": str(item.get("brief", "")),
+            "words": words,
+        })
+    return sections
+
+def section_request(message: str, sections, index: int):
+    section = sections[index]
+    outline = "\n".join(f"{number + 1}. {item['title']}" for number, item in enumerate(sections))
+    length = f" Aim for about {section['words']} words." if section["words"] else ""
+    return (
+        f"Document request:\n{message}\n\n"
+        f"Outline:\n{outline}\n\n"
+        f"Write section {index + 1}, \"{section['title']}\": {section['brief']}{length}"
+    )
@@ -1,13 +1,41 @@
-from openai import AsyncOpenAI
+import os
+import asyncio
+from openai import AsyncOpenAI, AuthenticationError, BadRequestError, PermissionDeniedError, RateLimitError
+from rate_limiter import RateLimitScheduler, estimate_tokens, parse_int
+from resilience import ResilientCaller
+from trace_log import llm_call
+from providers import DEFAULT_PROVIDER, registry
+from budget import BudgetExhausted, before_deadline, current_budget
+from longform import parse_outline, requested_words, section_request
 
 class OpenAiManager:
-    def __init__(self, api_key: str):
-        self.client = AsyncOpenAI(api_key=api_key)
+    def __init__(self, api_key: str, client: AsyncOpenAI = None):
+        # retries are handled by the ResilientCaller so attempts can be timed and hedged,
+        # the generator host passes in one client that all its generators share
+        self.client = client or AsyncOpenAI(api_key=api_key, max_retries=0, http_client=registry.http_client(DEFAULT_PROVIDER))
+        # the routes of MODEL_ROUTES that apply to this generator
+        self.service = "language-generator"
         self.available_models = []
+        self.model = os.getenv("OPENAI_MODEL")
+        self.fallback_model = os.getenv("OPENAI_FALLBACK_MODEL")
+        self.callers = {}
+        self.schedulers = {}
+        self.longform_min_words = int(os.getenv("LONGFORM_MIN_WORDS", "1500"))
+        self.longform_concurrency = int(os.getenv("LONGFORM_CONCURRENCY", "4"))
         self.prompt = """
         Generate the requested text as a plain string 
         with no extra formatting, code blocks, or JSON. Return only the text itself.
         """
+        self.outline_prompt = """
+        Create an outline for the requested document. Return only a JSON array of sections in order,
+        each an object with a "title", a "brief" describing what the section covers and
+        "words", the target length of the section. The lengths should add up to the requested length.
+        """
+        self.section_prompt = """
+        You write one section of a longer document. You get the document request, the full outline
+        and the section to write. Start with the section title on its own line, then write only
+        that section as plain text with no extra formatting, code blocks, or JSON.
+        """
 
     async def get_available_models(self):
         try:
@@ -20,34 +48,133 @@ class OpenAiManager:
             print(f"Error fetching models: {e}")
             self.available_models = []
 
+    def get_caller(self, model: str):
+        if model not in self.callers:
+            self.callers[model] = ResilientCaller(
+                model,
+                fallback_model=self.fallback_model,
+                non_retryable=(AuthenticationError, BadRequestError, PermissionDeniedError, BudgetExhausted),
+            )
+        return self.callers[model]
+
+    def get_scheduler(self, model: str):
+        # OpenAI enforces its limits per model
+        if model not in self.schedulers:
+            self.schedulers[model] = RateLimitScheduler(
+                requests_per_minute=parse_int(os.getenv("OPENAI_RPM_LIMIT")),
+                tokens_per_minute=parse_int(os.getenv("OPENAI_TPM_LIMIT")),
+            )
+        return self.schedulers[model]
+
+    async def create_response(self, model: str, instructions: str, message: str, **kwargs):
+        budget = current_budget.get()
+        if budget is not None:
+            budget.check()
+            left = budget.remaining_tokens()
+            if left is not None:
+                # the output may only spend what the prompt leaves of the budget, 16 is the least OpenAI accepts
+                left -= estimate_tokens(instructions, message, expected_output_tokens=0)
+                if left < 16:
+                    raise BudgetExhausted("token budget exhausted")
+                kwargs["max_output_tokens"] = min(kwargs.get("max_output_tokens", left), left)
+        provider, model_name = registry.provider(model)
+        # OpenAI is called through the client of the manager, the generator host shares it
+        client = self.client if provider.name == DEFAULT_PROVIDER else provider.client
+        scheduler = self.get_scheduler(model)
+        await scheduler.acquire(estimate_tokens(instructions, message))
+        try:
+            with llm_call():
+                headers, response = await before_deadline(
+                    provider.create_response(client, model_name, instructions, message, **kwargs)
+                )
+        except RateLimitError as e:
+            scheduler.update(e.response.headers)
+            scheduler.back_off(e.response.headers)
+            raise
+        scheduler.update(headers)
+        if budget is not None:
+            # streams only report their usage at the end, charge the estimate for them
+            usage = getattr(response, "usage", None)
+            budget.charge(tokens=usage.total_tokens if usage else estimate_tokens(instructions, message))
+            if getattr(response, "status", None) == "incomplete":
+                # the output ran into its token limit, the answer is cut short
+                budget.truncated = True
+        return response
+
     async def get_response(self, message: str, model: str = None):
+        if not model:
+            model = registry.choose(self.service, estimate_tokens(message, expected_output_tokens=0))
+        if not model and self.model:
+            model = self.model
         if not model:
             if not self.available_models:
-                return {"error": "No available models found."}
+                # raised rather than returned, replies and the ledger only carry text
+                raise RuntimeError("No available models found.")
             else:
                 model = self.available_models[1]
 
-        response = await self.client.responses.create(
-            model=model,
-            instructions=self.prompt,
-            input=message,
+        words = requested_words(message)
+        if words and words >= self.longform_min_words:
+            sections = [section["text"] async for section in self.get_longform_stream(message, model)]
+            return "\n\n".join(sections)
+
+        response = await self.get_caller(model).call(
+            lambda selected_model: self.create_response(selected_model, self.prompt, message)
         )
         return response.output_text
 
     async def get_streaming_response(self, message: str, model: str):
         if not model:
             if not self.available_models:
-                yield {"error": "No available models found."}
+                raise RuntimeError("No available models found.")
             else:
                 model = self.available_models[1]
 
-        stream = await self.client.responses.create(
-            model=model,
-            instructions=self.prompt,
-            input=message,
-            stream=True,
-        )
+        stream = await self.create_response(model, self.prompt, message, stream=True)
 
         async for event in stream:
             if event.type == "response.output_text.delta":
                 yield event.delta
+
+    async def get_longform_stream(self, message: str, model: str = None):
+        """
+        Writes a long document by generating an outline first and then all
+        sections concurrently. Sections are yielded in order as soon as every
+        section before them is finished.
+        """
+        if not model:
+            model = self.model or (self.available_models[1] if self.available_models else None)
+        if not model:
+            raise RuntimeError("No available models found.")
+
+        caller = self.get_caller(model)
+        outline = await before_deadline(caller.call(
+            lambda selected_model: self.create_response(selected_model, self.outline_prompt, message)
+        ))
+        sections = parse_outline(outline.output_text)
+        if not sections:
+            print("Could not parse an outline, generating the document in one pass")
+            response = await caller.call(
+                lambda selected_model: self.create_response(selected_model, self.prompt, message)
+            )
+            yield {"index": 0, "title": None, "text": response.output_text}
+            return
+
+        print(f"Generating {len(sections)} sections with concurrency {self.longform_concurrency}")
+        semaphore = asyncio.Semaphore(self.longform_concurrency)
+
+        async def write_section(index):
+            request = section_request(message, sections, index)
+            async with semaphore:
+                response = await caller.call(
+                    lambda selected_model: self.create_response(selected_model, self.section_prompt, request)
+                )
+            return response.output_text
+
+        tasks = [asyncio.ensure_future(write_section(index)) for index in range(len(sections))]
+        try:
+            for index, task in enumerate(tasks):
+                yield {"index": index, "title": sections[index]["title"], "text": await before_deadline(task)}
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,163 @@
+import asyncio
+import os
+import re
+import threading
+import time
+import weakref
+
+EXPECTED_OUTPUT_TOKENS = int(os.getenv("OPENAI_EXPECTED_OUTPUT_TOKENS", "1000"))
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def parse_duration(value):
+    """
+    Parses OpenAI reset durations such as "20ms", "1s" or "6m0s" into seconds.
+    """
+    if not value:
+        return None
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(*texts, expected_output_tokens: int = EXPECTED_OUTPUT_TOKENS):
+    # roughly four characters per token for english text and code
+    chars = sum(len(text) for text in texts if text)
+    return chars // 4 + 1 + expected_output_tokens
+
+def retry_after(headers):
+    if headers is None:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms is not None:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get("retry-after"))
+
+class TokenBucket:
+    def __init__(self, capacity: int, period: float = 60.0):
+        self.capacity = capacity
+        self.period = period
+        self.available = float(capacity)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.capacity / self.period
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float):
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def take(self, amount: float):
+        self.available -= min(amount, self.capacity)
+
+    def sync(self, limit, remaining):
+        self.refill()
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            # the server count includes every other replica sharing the key
+            self.available = min(self.available, float(remaining))
+
+class RateLimitScheduler:
+    """
+    Paces requests to stay under the request and token limits reported in the
+    x-ratelimit headers. Pending requests wait in FIFO order until both buckets
+    have room, instead of being sent and rejected with a 429.
+    """
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self.waiting = 0
+        self._state_lock = threading.Lock()
+        # asyncio locks are bound to a loop, keep one FIFO queue per running loop
+        self._queues = weakref.WeakKeyDictionary()
+
+    def _queue(self):
+        loop = asyncio.get_running_loop()
+        lock = self._queues.get(loop)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._queues[loop] = lock
+        return lock
+
+    async def acquire(self, tokens: int):
+        self.waiting += 1
+        try:
+            async with self._queue():
+                while True:
+                    delay = self._reserve(tokens)
+                    if delay <= 0:
+                        return
+                    await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+    def _reserve(self, tokens: int):
+        with self._state_lock:
+            delay = self.blocked_until - time.monotonic()
+            if self.requests:
+                delay = max(delay, self.requests.wait_time(1))
+            if self.tokens:
+                delay = max(delay, self.tokens.wait_time(tokens))
+            if delay > 0:
+                return delay
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            return 0.0
+
+    def update(self, headers):
+        if headers is None:
+            return
+        limit_requests = parse_int(headers.get("x-ratelimit-limit-requests"))
+        limit_tokens = parse_int(headers.get("x-ratelimit-limit-tokens"))
+        remaining_requests = parse_int(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = parse_int(headers.get("x-ratelimit-remaining-tokens"))
+        with self._state_lock:
+            if limit_requests:
+                if self.requests is None:
+                    self.requests = TokenBucket(limit_requests)
+                self.requests.sync(limit_requests, remaining_requests)
+            if limit_tokens:
+                if self.tokens is None:
+                    self.tokens = TokenBucket(limit_tokens)
+                self.tokens.sync(limit_tokens, remaining_tokens)
+
+    def back_off(self, headers):
+        """
+        Pauses dispatch after a 429 until the server says we can try again.
+        """
+        delay = retry_after(headers)
+        if delay is None and headers is not None:
+            delay = max(
+                parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+                parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0,
+            )
+        delay = delay or 1.0
+        with self._state_lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        print(f"Rate limited by OpenAI, pausing dispatch for {delay:.2f}s")
@@ -0,0 +1,80 @@
+import json
+import os
+import pika
+import affinity
+
+DLQ_MAX_RETRIES = int(os.getenv("DLQ_MAX_RETRIES", "3"))
+RETRY_HEADER = "x-retry-count"
+# redeliveries follow lost connections too, so they get their own and higher limit
+DLQ_MAX_REDELIVERIES = int(os.getenv("DLQ_MAX_REDELIVERIES", "10"))
+REDELIVERY_HEADER = "x-redelivery-count"
+
+def dead_letter_queue(queue: str):
+    return f"{queue}.dlq"
+
+def declare_dead_letter_queue(channel, queue: str):
+    channel.queue_declare(queue=dead_letter_queue(queue), durable=True)
+
+def error_reply(properties, error: str):
+    # streamed requests expect an error event, plain requests a text reply
+    if (properties.headers or {}).get("mode"):
+        return json.dumps({"type": "error", "message": error})
+    return f"Error processing request: {error}"
+
+def _publish(channel, exchange: str, routing_key: str, properties, body, headers):
+    channel.basic_publish(exchange=exchange,
+                          routing_key=routing_key,
+                          body=body,
+                          properties=pika.BasicProperties(
+                              reply_to=properties.reply_to,
+                              correlation_id=properties.correlation_id,
+                              message_id=properties.message_id,
+                              delivery_mode=pika.DeliveryMode.Persistent,
+                              headers=headers,
+                          ))
+
+def republish(channel, queue: str, properties, body, headers):
+    # through the affinity exchange like the first attempt, to the replica of its session
+    exchange, routing_key = affinity.target(queue, headers)
+    _publish(channel, exchange, routing_key, properties, body, headers)
+
+def dead_letter(channel, queue: str, properties, body, headers, error: str):
+    headers["x-original-queue"] = queue
+    headers["x-error"] = error[:1000]
+    _publish(channel, '', dead_letter_queue(queue), properties, body, headers)
+
+def requeue(channel, queue: str, delivery_tag, properties, body):
+    """
+    Publishes a redelivered message to the back of its queue with the
+    redelivery count raised and acks the delivery. A redelivery follows a lost
+    connection as well as a crash, so it doesn't count as a failed attempt, but
+    a message that keeps taking its consumer down is parked in the dead-letter
+    queue after DLQ_MAX_REDELIVERIES. Returns True when the message was
+    dead-lettered. Has to run on the connection thread.
+    """
+    headers = dict(properties.headers or {})
+    redeliveries = int(headers.get(REDELIVERY_HEADER, 0)) + 1
+    headers[REDELIVERY_HEADER] = redeliveries
+    if redeliveries > DLQ_MAX_REDELIVERIES:
+        dead_letter(channel, queue, properties, body, headers, f"redelivered {redeliveries} times without finishing")
+    else:
+        republish(channel, queue, properties, body, headers)
+    channel.basic_ack(delivery_tag=delivery_tag)
+    return redeliveries > DLQ_MAX_REDELIVERIES
+
+def retry_or_dead_letter(channel, queue: str, delivery_tag, properties, body, error: str):
+    """
+    Publishes a failed message back to its queue with the retry count raised, or
+    parks it in the dead-letter queue once it failed DLQ_MAX_RETRIES times. The
+    original delivery is acked so the queue keeps moving. Returns True when the
+    message was dead-lettered. Has to run on the connection thread.
+    """
+    headers = dict(properties.headers or {})
+    retries = int(headers.get(RETRY_HEADER, 0)) + 1
+    headers[RETRY_HEADER] = retries
+    if retries > DLQ_MAX_RETRIES:
+        dead_letter(channel, queue, properties, body, headers, error)
+    else:
+        republish(channel, queue, properties, body, headers)
+    channel.basic_ack(delivery_tag=delivery_tag)
+    return retries > DLQ_MAX_RETRIES
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+MAX_RETRY = int(os.getenv("MAX_RETRY", "3"))
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """
+    Opens after a number of consecutive failures and lets a single trial call
+    through once the reset timeout has passed.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def release(self):
+        """
+        Ends a trial call without a verdict, e.g. when it was cancelled or the
+        request itself was rejected, so the next call may try again.
+        """
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, pct: float, min_samples: int = 20):
+        if len(self.samples) < min_samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+        return ordered[index]
+
+class ResilientCaller:
+    """
+    Wraps a model call with per-attempt timeouts, retries with jittered
+    exponential backoff, optional hedging and a circuit breaker per model that
+    fails over to the fallback model while the primary one is open.
+    """
+    def __init__(
+        self,
+        primary_model: str,
+        fallback_model: str = None,
+        attempt_timeout: float = float(os.getenv("MODEL_ATTEMPT_TIMEOUT", "60")),
+        max_retry: int = MAX_RETRY,
+        base_backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        hedge: bool = True,
+        hedge_percentile: float = float(os.getenv("MODEL_HEDGE_PERCENTILE", "95")),
+        non_retryable: tuple = (),
+    ):
+        self.primary_model = primary_model
+        self.fallback_model = fallback_model
+        self.attempt_timeout = attempt_timeout
+        self.max_retry = max_retry
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.non_retryable = non_retryable
+        self.breakers = {}
+        self.latency = LatencyTracker()
+
+    def breaker(self, model: str):
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker()
+        return self.breakers[model]
+
+    def select_model(self):
+        if self.breaker(self.primary_model).allow():
+            return self.primary_model
+        if self.fallback_model and self.breaker(self.fallback_model).allow():
+            print(f"Circuit open for {self.primary_model}, failing over to {self.fallback_model}")
+            return self.fallback_model
+        raise CircuitOpenError(f"Circuit open for {self.primary_model}")
+
+    def backoff(self, attempt: int):
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return random.uniform(0, delay)
+
+    async def call(self, fn):
+        """
+        Calls fn(model) until it succeeds or the retries run out.
+        """
+        last_error = None
+        for attempt in range(self.max_retry + 1):
+            model = self.select_model()
+            breaker = self.breaker(model)
+            try:
+                result = await self._attempt(fn, model)
+            except self.non_retryable:
+                # the request can't succeed, that says nothing about the model
+                raise
+            except Exception as e:
+                breaker.record_failure()
+                last_error = e
+                print(f"Model call to {model} failed (attempt {attempt + 1}/{self.max_retry + 1}): {e!r}")
+                if attempt < self.max_retry:
+                    await asyncio.sleep(self.backoff(attempt))
+                continue
+            finally:
+                # also ends a half-open trial that was rejected or cancelled, e.g. at the deadline
+                breaker.release()
+            breaker.record_success()
+            return result
+        raise last_error
+
+    async def _attempt(self, fn, model: str):
+        start = time.monotonic()
+        tasks = {asyncio.ensure_future(fn(model))}
+        try:
+            hedge_after = self.latency.percentile(self.hedge_percentile) if self.hedge else None
+            if hedge_after is not None and hedge_after < self.attempt_timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    print(f"Model call to {model} exceeded p{self.hedge_percentile:g}, sending hedged request")
+                    tasks.add(asyncio.ensure_future(fn(model)))
+
+            error = None
+            while tasks:
+                remaining = self.attempt_timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    break
+                done, tasks = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latency.record(time.monotonic() - start)
+                        return task.result()
+                    error = task.exception()
+            if error is not None and not tasks:
+                raise error
+            raise asyncio.TimeoutError(f"Model call to {model} timed out after {self.attempt_timeout}s")
+        finally:
+            for task in tasks:
+                task.cancel()
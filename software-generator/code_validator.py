@@ -0,0 +1,210 @@
+import ast
+import functools
+import json
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+
+FENCE_PATTERN = re.compile(r"```[ \t]*([\w+#.-]*)[^\n]*\n(.*?)(?:```|\Z)", re.S)
+LINE_NUMBER_PATTERN = re.compile(r"(?:line |:)(\d+)")
+# statements newer than the Python the service runs on, match, type aliases, except* and generic defs
+NEWER_PYTHON_PATTERN = re.compile(
+    r"^\s*(?:match\s+\S.*:|case\s+\S.*:|type\s+\w+.*=|except\s*\*|(?:async\s+)?def\s+\w+\[|class\s+\w+\[)"
+)
+# what can come right before a regex literal in javascript, anything else makes a / a division
+REGEX_PRECEDING_PATTERN = re.compile(r"(?:^|[(,=:\[!&|?{};+\-*%<>~^]|\b(?:return|typeof|case|do|else|in|of|void|yield|await))\s*$")
+
+LANGUAGE_ALIASES = {
+    "py": "python", "python3": "python", "js": "javascript", "jsx": "javascript", "mjs": "javascript",
+    "ts": "typescript", "tsx": "typescript", "c++": "cpp", "cs": "csharp", "c#": "csharp",
+    "golang": "go", "rs": "rust", "kt": "kotlin",
+}
+
+class CheckError:
+    def __init__(self, line: int, message: str):
+        self.line = max(1, line or 1)
+        self.message = message
+
+    def __str__(self):
+        return f"line {self.line}: {self.message}"
+
+CHECKERS = {}
+
+def register_checker(*languages):
+    """
+    Registers a function that takes source code and returns a CheckError or None.
+    """
+    def decorator(checker):
+        for language in languages:
+            CHECKERS[language] = checker
+        return checker
+    return decorator
+
+def normalize_language(language: str):
+    language = (language or "").lower()
+    return LANGUAGE_ALIASES.get(language, language)
+
+def extract_code_block(text: str):
+    """
+    Returns the language and code of the first fenced block in the model
+    output, or (None, text) when the output has no code block.
+    """
+    match = FENCE_PATTERN.search(text)
+    if not match:
+        return None, text
+    return normalize_language(match.group(1)), match.group(2).rstrip("\n")
+
+def to_markdown(language: str, code: str):
+    return f"```{language or ''}\n{code}\n```"
+
+@register_checker("python")
+def check_python(code: str):
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        lines = code.split("\n")
+        if e.lineno and e.lineno <= len(lines) and NEWER_PYTHON_PATTERN.match(lines[e.lineno - 1]):
+            # valid on the python the code is written for, this one just can't parse it
+            return None
+        return CheckError(e.lineno, e.msg)
+    return None
+
+@register_checker("json")
+def check_json(code: str):
+    try:
+        json.loads(code)
+    except json.JSONDecodeError as e:
+        return CheckError(e.lineno, e.msg)
+    return None
+
+BRACKETS = {")": "(", "]": "[", "}": "{"}
+BRACKET_LANGUAGES = ["javascript", "typescript", "java", "c", "cpp", "csharp", "go", "rust", "kotlin", "swift", "php"]
+# raw strings that end in a delimiter built from what opened them, escapes and quotes inside don't count
+RAW_STRING_PATTERNS = {
+    "rust": (re.compile(r'(?<!\w)[bc]?r(#*)"'), lambda match: '"' + match.group(1)),
+    "swift": (re.compile(r'(#+)"'), lambda match: '"' + match.group(1)),
+    "cpp": (re.compile(r'(?<!\w)(?:u8|[uUL])?R"([^()\\\s]{0,16})\('), lambda match: ")" + match.group(1) + '"'),
+}
+# a rust char literal, any other quote opens a lifetime like 'a
+RUST_CHAR_PATTERN = re.compile(r"'(?:\\u\{[0-9a-fA-F]*\}|\\.|[^\\'\n])'")
+
+def check_brackets(code: str, language: str = None):
+    """
+    Checks bracket balance for C-like languages, skipping strings and comments.
+    Javascript and typescript code with a regex literal is not checked, its
+    brackets don't have to balance and it can't be told apart from a division reliably.
+    """
+    raw_string = RAW_STRING_PATTERNS.get(language)
+    stack = []
+    line = 1
+    index = 0
+    length = len(code)
+    while index < length:
+        char = code[index]
+        match = raw_string[0].match(code, index) if raw_string else None
+        if match:
+            end = code.find(raw_string[1](match), match.end())
+            end = length if end == -1 else end + len(raw_string[1](match))
+            line += code.count("\n", index, end)
+            index = end
+            continue
+        if char == "\n":
+            line += 1
+        elif code.startswith("//", index):
+            end = code.find("\n", index)
+            index = length if end == -1 else end
+            continue
+        elif code.startswith("/*", index):
+            end = code.find("*/", index + 2)
+            end = length if end == -1 else end + 2
+            line += code.count("\n", index, end)
+            index = end
+            continue
+        elif char == "/" and language in ("javascript", "typescript") and REGEX_PRECEDING_PATTERN.search(code[code.rfind("\n", 0, index) + 1:index]):
+            return None
+        elif code.startswith('"""', index):
+            # multiline strings of kotlin, swift and java, quotes inside don't end them
+            end = code.find('"""', index + 3)
+            end = length if end == -1 else end + 3
+            line += code.count("\n", index, end)
+            index = end
+            continue
+        elif char == "'" and language == "rust":
+            literal = RUST_CHAR_PATTERN.match(code, index)
+            index = literal.end() if literal else index + 1
+            continue
+        elif char in "\"'`":
+            end = index + 1
+            while end < length and code[end] != char:
+                if code[end] == "\\":
+                    end += 1
+                elif code[end] == "\n" and char != "`":
+                    break
+                end += 1
+            line += code.count("\n", index, end)
+            index = end + 1
+            continue
+        elif char in "([{":
+            stack.append((char, line))
+        elif char in BRACKETS:
+            if not stack or stack[-1][0] != BRACKETS[char]:
+                return CheckError(line, f"unmatched '{char}'")
+            stack.pop()
+        index += 1
+    if stack:
+        char, opened = stack[-1]
+        return CheckError(opened, f"'{char}' is never closed")
+    return None
+
+for _language in BRACKET_LANGUAGES:
+    register_checker(_language)(functools.partial(check_brackets, language=_language))
+
+def command_checker(command: str):
+    """
+    Builds a checker that runs an external tool on the code, for example
+    "node --check {file}". A non-zero exit code counts as a failure.
+    """
+    def checker(code: str):
+        with tempfile.NamedTemporaryFile("w", suffix=".src", delete=False) as source:
+            source.write(code)
+        try:
+            result = subprocess.run(
+                shlex.split(command.format(file=source.name)),
+                capture_output=True, text=True, timeout=10,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"Checker '{command}' could not run: {e}")
+            return None
+        finally:
+            os.unlink(source.name)
+        if result.returncode == 0:
+            return None
+        output = (result.stderr or result.stdout).strip()
+        match = LINE_NUMBER_PATTERN.search(output)
+        return CheckError(int(match.group(1)) if match else 1, output.splitlines()[0] if output else "check failed")
+    return checker
+
+# CODE_CHECKERS='{"javascript": "node --check {file}"}' adds or overrides checkers per language
+for _language, _command in json.loads(os.getenv("CODE_CHECKERS", "{}")).items():
+    register_checker(normalize_language(_language))(command_checker(_command))
+
+def check_code(language: str, code: str):
+    checker = CHECKERS.get(normalize_language(language))
+    if checker is None:
+        return None
+    return checker(code)
+
+def error_region(code: str, line: int, context: int = 5):
+    total = max(1, len(code.split("\n")))
+    line = min(max(1, line), total)
+    return max(1, line - context), min(total, line + context)
+
+def numbered_lines(code: str, start: int, end: int):
+    lines = code.split("\n")
+    return "\n".join(f"{number}: {lines[number - 1]}" for number in range(start, end + 1))
+
+def apply_patch(code: str, start: int, end: int, replacement: str):
+    lines = code.split("\n")
+    return "\n".join(lines[:start - 1] + replacement.split("\n") + lines[end:])
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+
+MONITORS = []
+
+def log_event(event: str, **fields):
+    print(json.dumps({"event": event, "time": time.time(), **fields}), flush=True)
+
+class LoopMonitor:
+    """
+    Measures the lag of an event loop with a heartbeat task. A watchdog thread
+    checks the heartbeat and when it is late by more than the threshold some
+    callback is blocking the loop, so the stack of the loop thread is logged.
+    """
+    def __init__(self, service: str, name: str, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_BLOCK_THRESHOLD):
+        self.service = service
+        self.name = name
+        self.interval = interval
+        self.threshold = threshold
+        self.loop = None
+        self.thread_id = None
+        self.beat = None
+        self.reported = False
+        self.stopped = threading.Event()
+        self.heartbeat = None
+        self.lag = 0.0
+        self.lag_max = 0.0
+        self.lag_sum = 0.0
+        self.samples = 0
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        MONITORS.append(self)
+
+    def start(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.heartbeat = asyncio.run_coroutine_threadsafe(self._heartbeat(), self.loop)
+        threading.Thread(target=self._watch, name=f"loop-monitor-{self.name}", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+
+    async def _heartbeat(self):
+        self.thread_id = threading.get_ident()
+        while not self.stopped.is_set():
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - self.beat - self.interval)
+            self.lag = lag
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_sum += lag
+            self.samples += 1
+            if self.reported:
+                self.reported = False
+                self.blocked_seconds += lag
+                log_event("loop_unblocked", service=self.service, loop=self.name, blocked_for=round(lag, 3))
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            if self.beat is None or self.reported:
+                continue
+            late = time.monotonic() - self.beat - self.interval
+            if late < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.reported = True
+            self.blocked += 1
+            log_event(
+                "loop_blocked", service=self.service, loop=self.name, blocked_for=round(late, 3),
+                stack=[line.rstrip() for line in traceback.format_stack(frame)],
+            )
+
+LOOP_METRICS = (
+    ("event_loop_lag_seconds", "gauge", "Lag of the last event loop heartbeat.", lambda m: m.lag),
+    ("event_loop_lag_max_seconds", "gauge", "Largest event loop lag seen.", lambda m: m.lag_max),
+    ("event_loop_lag_seconds_total", "counter", "Summed event loop lag.", lambda m: m.lag_sum),
+    ("event_loop_heartbeats_total", "counter", "Event loop heartbeats measured.", lambda m: m.samples),
+    ("event_loop_blocked_total", "counter", "Times a callback blocked the loop longer than the threshold.", lambda m: m.blocked),
+    ("event_loop_blocked_seconds_total", "counter", "Time the loop spent blocked.", lambda m: m.blocked_seconds),
+)
+
+GAUGES = []
+
+def register_gauge(name: str, description: str, value, labels: dict = None):
+    """
+    Adds a gauge to /metrics, value is called on every scrape. Gauges of the same
+    name need labels to tell them apart.
+    """
+    GAUGES.append((name, description, value, labels or {}))
+
+def render_metrics():
+    # Prometheus text format
+    lines = []
+    for name, kind, description, value in LOOP_METRICS:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{loop="{monitor.name}"}} {value(monitor):.6g}' for monitor in MONITORS]
+    described = set()
+    for name, description, value, labels in sorted(GAUGES, key=lambda gauge: gauge[0]):
+        if name not in described:
+            described.add(name)
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+        label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value():.6g}" if label_text else f"{name} {value():.6g}")
+    return "\n".join(lines) + "\n"
+
+router = APIRouter()
+
+@router.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -1,85 +1,303 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 import os
-from openai_manager import OpenAiManager
-import logfire
 import pika
 import threading
 import asyncio
+import json
+import functools
+import random
+import time
+from dead_letter import DLQ_MAX_REDELIVERIES, DLQ_MAX_RETRIES, declare_dead_letter_queue, error_reply, requeue, retry_or_dead_letter
+from ledger import Ledger, message_key
+import profiler
+import loop_monitor
+import trace_log
+import budget
+import providers
+import job_scheduler
+import affinity
+import draining
+import blob_store
+
+LOGFIRE_TOKEN = os.getenv("LOGFIRE_WRITE_TOKEN")
+if LOGFIRE_TOKEN:
+    # logfire pulls in OpenTelemetry, only pay for the import when traces are sent
+    import logfire
+
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", "60"))
+RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY", "30"))
+GENERATOR_CONCURRENCY = int(os.getenv("GENERATOR_CONCURRENCY", "1"))
+
+def reconnect_delay(attempt: int):
+    # exponential backoff with jitter so replicas don't reconnect in lockstep
+    return random.uniform(0.5, 1.0) * min(RECONNECT_MAX_DELAY, 2 ** attempt)
 
 class RabbitManager:
-    def __init__(self, oai_manager: OpenAiManager):
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+    def __init__(self, oai_manager: "OpenAiManager"):
+        self.connection = None
+        self.channel = None
         self.thread = None
         self.oai_manager = oai_manager
+        self.connected = threading.Event()
+        self.consuming = threading.Event()
+        self._closing = False
+        self._reconnect_attempts = 0
+        # set on shutdown, no new messages are taken while the ones in flight finish
+        self.draining = threading.Event()
+        self.in_flight = 0
+        # requests are processed on their own event loop so the pika thread keeps serving heartbeats
+        self.loop = asyncio.new_event_loop()
+        self.worker = threading.Thread(target=self.loop.run_forever, name="message-loop", daemon=True)
+        self.loop_monitor = loop_monitor.LoopMonitor("software-generator", "messages")
+        self.ledger = Ledger()
+        # more messages are prefetched than worked on, the shortest estimated job goes first
+        self.jobs = job_scheduler.JobScheduler(GENERATOR_CONCURRENCY)
+        self.jobs.register_gauges("software-generator")
 
     def get_channel(self):
         return self.connection.channel()
 
     def start_in_background(self):
-        self.thread = threading.Thread(target=self.setup_queue, daemon=True)
+        self.worker.start()
+        self.loop_monitor.start(self.loop)
+        self.thread = threading.Thread(target=self._run, name="rabbitmq-consumer", daemon=True)
         self.thread.start()
 
+    def _run(self):
+        while not self._closing:
+            try:
+                self.setup_queue()
+            except Exception as e:
+                if self._closing:
+                    break
+                delay = reconnect_delay(self._reconnect_attempts)
+                self._reconnect_attempts += 1
+                print(f"RabbitMQ consumer error: {e!r}, reconnecting in {delay:.1f}s...")
+                time.sleep(delay)
+
     async def process_message(self, message):
         print("Got request...")
-        response = await self.oai_manager.get_response(message)
+        try:
+            response = await self.oai_manager.get_response(message)
+        except Exception as e:
+            print(f"Generation failed: {e!r}")
+            return f"Error generating response: {e}"
         print("Returning request...")
         return response
 
     def setup_queue(self):
-        channel = self.get_channel()
-        channel.queue_declare(queue='software-generator', durable=True)
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq', heartbeat=RABBITMQ_HEARTBEAT))
+        self.connected.set()
+        try:
+            channel = self.get_channel()
+            channel.queue_declare(queue='software-generator', durable=True)
+            declare_dead_letter_queue(channel, 'software-generator')
+
+            # the limit is shared by the consumers of the channel, affinity routing adds one for the replica queue
+            channel.basic_qos(prefetch_count=self.jobs.prefetch, global_qos=True)
+            if not self.draining.is_set():
+                affinity.consume(channel, 'software-generator', self.on_request)
+            self.channel = channel
+            self.consuming.set()
+            self._reconnect_attempts = 0
+
+            print("Waiting RPC request on 'software-generator' queue.")
+            channel.start_consuming()
+            # draining, the replies and acks of the messages in flight still go out over this connection
+            while self.draining.is_set() and not self._closing:
+                self.connection.process_data_events(time_limit=1)
+        finally:
+            self.connected.clear()
+            self.consuming.clear()
+            if self._closing and self.connection.is_open:
+                self.connection.close()
+
+    async def handle_message(self, properties, message):
+        budget.start(properties)
+        response = await self.process_message(message)
+        # large answers travel up to the api-gateway as a reference
+        self.reply(properties, blob_store.offload(response))
+
+    async def stream_project(self, properties, message):
+        budget.start(properties)
+        print("Got project request...")
+        try:
+            async for event in self.oai_manager.get_project_stream(message):
+                self.reply(properties, json.dumps(event), final=event["type"] == "manifest")
+        except Exception as e:
+            print(f"Project generation failed: {e!r}")
+            self.reply(properties, json.dumps({"type": "error", "message": str(e)}), final=True)
+        print("Finished project request...")
+
+    def cancel_consumers(self):
+        affinity.leave(self.channel, 'software-generator')
+        for consumer_tag in list(self.channel.consumer_tags):
+            self.channel.basic_cancel(consumer_tag)
+
+    def run_on_connection(self, callback):
+        """
+        Runs the callback on the consumer thread, pika connections are not thread safe.
+        Waits for a reconnect when the connection is down.
+        """
+        while not self._closing:
+            connection = self.connection
+            try:
+                connection.add_callback_threadsafe(callback)
+                return
+            except Exception:
+                self.consuming.wait(timeout=1)
 
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(queue='software-generator', on_message_callback=self.on_request)
+    def reply(self, properties, body, final=None):
+        self.ledger.add_reply(message_key(properties), body, final)
+        # the budget belongs to the task, read what it spent before handing over to the consumer thread
+        self.run_on_connection(functools.partial(self.publish_reply, properties, body, final, budget.reply_headers()))
 
-        print("Waiting RPC request on 'software-generator' queue.")
-        channel.start_consuming()
+    def publish_reply(self, properties, body, final=None, headers=None):
+        headers = dict(headers or {})
+        if final is not None:
+            # replies of a streamed request carry a final header, the last one has it set
+            headers["final"] = final
+        self.channel.basic_publish(exchange='',
+                                   routing_key=properties.reply_to,
+                                   body=body,
+                                   properties=pika.BasicProperties(
+                                       correlation_id=properties.correlation_id,
+                                       delivery_mode = pika.DeliveryMode.Persistent,
+                                       headers=headers or None,
+                                   ))
 
     def on_request(self, ch, method, properties, body):
+        hop = trace_log.Hop.from_properties("software-generator", "software-generator", properties)
+        replies = self.ledger.lookup(message_key(properties))
+        if replies is not None:
+            # answered before, but the ack never reached the broker
+            print("Replaying stored result...")
+            if not replies:
+                # the replies of a stream are not kept, end it so the caller doesn't wait for it
+                replies = [(error_reply(properties, "the stream was interrupted, send the request again").encode(), True)]
+            for reply_body, final in replies:
+                self.publish_reply(properties, reply_body, final)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        if method.redelivered:
+            # the previous attempt never settled, the connection dropped or the consumer died,
+            # it goes to the back of the queue, counted apart from the failed attempts
+            self.requeue(ch, method.delivery_tag, properties, body)
+            return
         message = str(body)
+        headers = properties.headers or {}
 
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            response = loop.run_until_complete(self.process_message(message))
-        finally:
-            loop.close()
+        if headers.get("mode") == "project":
+            work = self.stream_project(properties, message)
+        else:
+            work = self.handle_message(properties, message)
+        job = job_scheduler.Job(message, headers.get("mode"))
+        self.in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(self.jobs.run(job, trace_log.traced(hop, work)), self.loop)
+        future.add_done_callback(functools.partial(self.on_done, ch, method.delivery_tag, properties, body))
+
+    def on_done(self, ch, delivery_tag, properties, body, future):
+        def settle():
+            try:
+                if not ch.is_open:
+                    # the delivery tag belongs to the old channel, the redelivery is answered from the ledger
+                    print("Channel closed before the message was acknowledged")
+                elif future.exception() is not None:
+                    print(f"Processing failed: {future.exception()!r}")
+                    self.retry_or_dead_letter(ch, delivery_tag, properties, body, repr(future.exception()))
+                else:
+                    ch.basic_ack(delivery_tag=delivery_tag)
+            finally:
+                self.in_flight -= 1
+        self.run_on_connection(settle)
+
+    def requeue(self, ch, delivery_tag, properties, body):
+        if requeue(ch, 'software-generator', delivery_tag, properties, body):
+            print(f"Message redelivered {DLQ_MAX_REDELIVERIES + 1} times, moved to the dead-letter queue")
+            self.publish_reply(properties, error_reply(properties, "redelivered too often without finishing"))
 
-        ch.basic_publish(exchange='',
-                         routing_key=properties.reply_to,
-                         body=response,
-                         properties=pika.BasicProperties(
-                             correlation_id=properties.correlation_id,
-                             delivery_mode = pika.DeliveryMode.Persistent,
-                         ))
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    def retry_or_dead_letter(self, ch, delivery_tag, properties, body, error):
+        if retry_or_dead_letter(ch, 'software-generator', delivery_tag, properties, body, error):
+            print(f"Message failed {DLQ_MAX_RETRIES + 1} times, moved to the dead-letter queue")
+            # not written to the ledger, a replay of the dead letter has to run the message again
+            self.publish_reply(properties, error_reply(properties, error))
 
     def close(self):
-        self.connection.close()
+        self._closing = True
+        if self.channel and self.connection and self.connection.is_open:
+            try:
+                self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+            except Exception as e:
+                print(f"Error stopping consumer: {e!r}")
+        self.loop_monitor.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    oai_manager = OpenAiManager(api_key=os.getenv("OPENAI_API_KEY"))
-    await oai_manager.get_available_models()
+def create_oai_manager():
+    # importing the OpenAI client is slow, keep it off the startup path
+    from openai_manager import OpenAiManager
+    return OpenAiManager(api_key=os.getenv("OPENAI_API_KEY"))
 
+async def initialize(app: FastAPI):
+    oai_manager = await asyncio.to_thread(create_oai_manager)
     app.state.oai_manager = oai_manager
 
+    await oai_manager.get_available_models()
+    while not (oai_manager.model or oai_manager.available_models):
+        await asyncio.sleep(10)
+        await oai_manager.get_available_models()
+    # messages are only taken once there is a model to answer them with
     app.state.rabbit_manager = RabbitManager(oai_manager)
     app.state.rabbit_manager.start_in_background()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.loop_monitor = loop_monitor.LoopMonitor("software-generator", "http")
+    app.state.loop_monitor.start()
+    app.state.oai_manager = None
+    app.state.rabbit_manager = None
+    init_task = asyncio.create_task(initialize(app))
+    draining.install(app)
     yield
-    app.state.rabbit_manager.close()
+    init_task.cancel()
+    if app.state.rabbit_manager:
+        await draining.drain(app.state.rabbit_manager)
+        app.state.rabbit_manager.close()
+    app.state.loop_monitor.stop()
 
 app = FastAPI(lifespan=lifespan)
+app.include_router(profiler.router)
+app.include_router(loop_monitor.router)
+app.include_router(providers.router)
 
-logfire.configure(token=os.getenv("LOGFIRE_WRITE_TOKEN"), send_to_logfire="if-token-present", service_name="software-generator")
-logfire.instrument_fastapi(app, capture_headers=True)
+if LOGFIRE_TOKEN:
+    logfire.configure(token=LOGFIRE_TOKEN, send_to_logfire="if-token-present", service_name="software-generator")
+    logfire.instrument_fastapi(app, capture_headers=True)
 
 @app.head("/")
+@app.api_route("/live", methods=["GET", "HEAD"])
 async def health_check():
     return {"status": "ok"}
 
+@app.api_route("/ready", methods=["GET", "HEAD"])
+async def readiness_check(request: Request):
+    rabbit_manager = request.app.state.rabbit_manager
+    oai_manager = request.app.state.oai_manager
+    checks = {
+        "broker": rabbit_manager is not None and rabbit_manager.connected.is_set(),
+        "consumer": rabbit_manager is not None and rabbit_manager.consuming.is_set(),
+        "model": oai_manager is not None and bool(oai_manager.model or oai_manager.available_models),
+    }
+    if rabbit_manager is not None and rabbit_manager.draining.is_set():
+        # shutting down, take no new requests while the ones in flight finish
+        return JSONResponse({"status": "draining", "checks": checks}, status_code=503)
+    ready = all(checks.values())
+    return JSONResponse({"status": "ready" if ready else "not ready", "checks": checks}, status_code=200 if ready else 503)
+
 @app.get("/models")
 async def get_models(request: Request):
     oai_manager = request.app.state.oai_manager
+    if oai_manager is None:
+        return {"available_models": []}
     return {"available_models": oai_manager.available_models}
@@ -1,15 +1,47 @@
-from openai import AsyncOpenAI
+import os
+from openai import AsyncOpenAI, AuthenticationError, BadRequestError, PermissionDeniedError, RateLimitError
+from rate_limiter import RateLimitScheduler, estimate_tokens, parse_int
+from project_stream import ProjectStreamParser
+from code_validator import apply_patch, check_code, error_region, extract_code_block, numbered_lines, to_markdown
+from resilience import ResilientCaller
+from trace_log import llm_call
+from providers import DEFAULT_PROVIDER, registry
+from budget import BudgetExhausted, before_deadline, current_budget, iterate_before_deadline
 
 class OpenAiManager:
-    def __init__(self, api_key: str):
-        self.client = AsyncOpenAI(api_key=api_key)
+    def __init__(self, api_key: str, client: AsyncOpenAI = None):
+        # retries are handled by the ResilientCaller so attempts can be timed and hedged,
+        # the generator host passes in one client that all its generators share
+        self.client = client or AsyncOpenAI(api_key=api_key, max_retries=0, http_client=registry.http_client(DEFAULT_PROVIDER))
+        # the routes of MODEL_ROUTES that apply to this generator
+        self.service = "software-generator"
         self.available_models = []
+        self.model = os.getenv("OPENAI_MODEL")
+        self.fallback_model = os.getenv("OPENAI_FALLBACK_MODEL")
+        self.callers = {}
+        self.schedulers = {}
+        self.repair_attempts = int(os.getenv("CODE_REPAIR_ATTEMPTS", "2"))
+        self.repair_context = int(os.getenv("CODE_REPAIR_CONTEXT", "5"))
+        self.project_chunk_size = int(os.getenv("PROJECT_CHUNK_SIZE", "16384"))
         self.prompt = """
         Write the complete source code for the requested software.
 
         Only output a markdown code block with the language specified (e.g., ```python). 
         Do not include any explanations, comments, strings, or formatting outside the code block.
         """
+        self.project_prompt = """
+        Write the complete source code for the requested software project, split over as many files as needed.
+
+        Output every file as follows and nothing else, without code blocks:
+        === FILE: relative/path/to/file ===
+        <file content>
+        === END FILE ===
+        """
+        self.patch_prompt = """
+        You fix a syntax error in a region of a source file. You get the error and the numbered
+        lines of the region. Output only the corrected replacement for exactly those lines,
+        without line numbers, in a single markdown code block. Do not change anything else.
+        """
 
     async def get_available_models(self):
         try:
@@ -22,37 +54,148 @@ class OpenAiManager:
             print(f"Error fetching models: {e}")
             self.available_models = []
 
+    def get_caller(self, model: str):
+        if model not in self.callers:
+            self.callers[model] = ResilientCaller(
+                model,
+                fallback_model=self.fallback_model,
+                non_retryable=(AuthenticationError, BadRequestError, PermissionDeniedError, BudgetExhausted),
+            )
+        return self.callers[model]
+
+    def get_scheduler(self, model: str):
+        # OpenAI enforces its limits per model
+        if model not in self.schedulers:
+            self.schedulers[model] = RateLimitScheduler(
+                requests_per_minute=parse_int(os.getenv("OPENAI_RPM_LIMIT")),
+                tokens_per_minute=parse_int(os.getenv("OPENAI_TPM_LIMIT")),
+            )
+        return self.schedulers[model]
+
+    async def create_response(self, model: str, instructions: str, message: str, **kwargs):
+        budget = current_budget.get()
+        if budget is not None:
+            budget.check()
+            left = budget.remaining_tokens()
+            if left is not None:
+                # the output may only spend what the prompt leaves of the budget, 16 is the least OpenAI accepts
+                left -= estimate_tokens(instructions, message, expected_output_tokens=0)
+                if left < 16:
+                    raise BudgetExhausted("token budget exhausted")
+                kwargs["max_output_tokens"] = min(kwargs.get("max_output_tokens", left), left)
+        provider, model_name = registry.provider(model)
+        # OpenAI is called through the client of the manager, the generator host shares it
+        client = self.client if provider.name == DEFAULT_PROVIDER else provider.client
+        scheduler = self.get_scheduler(model)
+        await scheduler.acquire(estimate_tokens(instructions, message))
+        try:
+            with llm_call():
+                headers, response = await before_deadline(
+                    provider.create_response(client, model_name, instructions, message, **kwargs)
+                )
+        except RateLimitError as e:
+            scheduler.update(e.response.headers)
+            scheduler.back_off(e.response.headers)
+            raise
+        scheduler.update(headers)
+        if budget is not None:
+            # streams only report their usage at the end, charge the estimate for them
+            usage = getattr(response, "usage", None)
+            budget.charge(tokens=usage.total_tokens if usage else estimate_tokens(instructions, message))
+            if getattr(response, "status", None) == "incomplete":
+                # the output ran into its token limit, the answer is cut short
+                budget.truncated = True
+        return response
+
     async def get_response(self, message: str, model: str = None):
+        if not model:
+            model = registry.choose(self.service, estimate_tokens(message, expected_output_tokens=0))
+        if not model and self.model:
+            model = self.model
         if not model:
             if not self.available_models:
-                return {"error": "No available models found."}
+                # raised rather than returned, replies and the ledger only carry text
+                raise RuntimeError("No available models found.")
             else:
                 model = self.available_models[1] # use the first available model, which is codex-mini-latest
 
-        response = await self.client.responses.create(
-            model=model,
-            instructions=self.prompt,
-            input=message,
+        response = await self.get_caller(model).call(
+            lambda selected_model: self.create_response(selected_model, self.prompt, message)
         )
 
         print(f"Response: {response.output_text}")
 
-        return response.output_text
+        language, code = extract_code_block(response.output_text)
+        if language is None:
+            return response.output_text
+
+        error = check_code(language, code)
+        attempts = 0
+        while error and attempts < self.repair_attempts:
+            attempts += 1
+            try:
+                code = await self.patch_code(model, language, code, error)
+            except BudgetExhausted as e:
+                print(f"Stopped repairing the code: {e}")
+                break
+            error = check_code(language, code)
+
+        if error:
+            print(f"Returning code with unresolved error: {error}")
+        return to_markdown(language, code)
+
+    async def patch_code(self, model: str, language: str, code: str, error):
+        """
+        Asks the model for a replacement of the failing region only and splices it into the code.
+        """
+        start, end = error_region(code, error.line, self.repair_context)
+        print(f"Code check failed at {error}, requesting a patch for lines {start}-{end}")
+        patch_request = (
+            f"Language: {language}\n"
+            f"Error: {error}\n\n"
+            f"Lines {start}-{end}:\n{numbered_lines(code, start, end)}"
+        )
+        response = await self.get_caller(model).call(
+            lambda selected_model: self.create_response(selected_model, self.patch_prompt, patch_request)
+        )
+        _, replacement = extract_code_block(response.output_text)
+        return apply_patch(code, start, end, replacement.strip("\n"))
 
     async def get_streaming_response(self, message: str, model: str):
         if not model:
             if not self.available_models:
-                yield {"error": "No available models found."}
+                raise RuntimeError("No available models found.")
             else:
                 model = self.available_models[1]
 
-        stream = await self.client.responses.create(
-            model=model,
-            instructions=self.prompt,
-            input=message,
-            stream=True,
-        )
+        stream = await self.create_response(model, self.prompt, message, stream=True)
 
         async for event in stream:
             if event.type == "response.output_text.delta":
                 yield event.delta
+
+    async def get_project_stream(self, message: str, model: str = None):
+        """
+        Streams a multi-file project as file_start, chunk and file_end events,
+        followed by a manifest of all files.
+        """
+        if not model:
+            model = self.model or (self.available_models[1] if self.available_models else None)
+        if not model:
+            raise RuntimeError("No available models found.")
+
+        # only opening the stream is retried, a broken stream can't be resumed
+        stream = await self.get_caller(model).call(
+            lambda selected_model: self.create_response(selected_model, self.project_prompt, message, stream=True)
+        )
+        parser = ProjectStreamParser(self.project_chunk_size)
+        try:
+            async for event in iterate_before_deadline(stream):
+                if event.type == "response.output_text.delta":
+                    for file_event in parser.feed(event.delta):
+                        yield file_event
+        except BudgetExhausted as e:
+            # close the files written so far and send the manifest of what was generated
+            print(f"Project generation stopped: {e}")
+        for file_event in parser.finish():
+            yield file_event
@@ -0,0 +1,99 @@
+import posixpath
+import re
+
+FILE_START_PATTERN = re.compile(r"^=== FILE: (.+?) ===$")
+FILE_END_MARKER = "=== END FILE ==="
+
+def safe_path(path: str, index: int):
+    path = posixpath.normpath(path.strip().strip("`\"'").replace("\\", "/")).lstrip("/")
+    if not path or path == "." or path.startswith(".."):
+        return f"file{index}.txt"
+    return path
+
+class ProjectStreamParser:
+    """
+    Turns streamed model output into file events. Files are delimited by
+    "=== FILE: <path> ===" and "=== END FILE ===" lines, and file content is
+    emitted in chunks of about chunk_size characters so a complete file never
+    has to be held in memory.
+    """
+    def __init__(self, chunk_size: int = 16384):
+        self.chunk_size = chunk_size
+        self.pending = ""
+        self.path = None
+        self.first_line = False
+        self.held = None
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.files = []
+
+    def feed(self, text: str):
+        events = []
+        self.pending += text
+        while "\n" in self.pending:
+            line, self.pending = self.pending.split("\n", 1)
+            events.extend(self._line(line + "\n"))
+        return events
+
+    def finish(self):
+        events = []
+        if self.pending:
+            events.extend(self._line(self.pending))
+            self.pending = ""
+        if self.path is not None:
+            events.extend(self._close())
+        events.append({"type": "manifest", "files": self.files})
+        return events
+
+    def _line(self, line: str):
+        stripped = line.strip()
+        match = FILE_START_PATTERN.match(stripped)
+        if match:
+            events = self._close() if self.path is not None else []
+            self.path = safe_path(match.group(1), len(self.files) + 1)
+            self.first_line = True
+            return events + [{"type": "file_start", "path": self.path}]
+        if self.path is None:
+            # text outside of a file block is ignored
+            return []
+        if stripped == FILE_END_MARKER:
+            return self._close()
+        if self.first_line and stripped.startswith("```"):
+            self.first_line = False
+            return []
+        self.first_line = False
+
+        # hold back one line so a closing code fence before the end marker can be dropped
+        events = []
+        if self.held is not None:
+            events = self._append(self.held)
+        self.held = line
+        return events
+
+    def _append(self, line: str):
+        self.buffer.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.chunk_size:
+            return [self._flush()]
+        return []
+
+    def _flush(self):
+        data = "".join(self.buffer)
+        self.size += len(data)
+        self.buffer = []
+        self.buffered = 0
+        return {"type": "chunk", "path": self.path, "data": data}
+
+    def _close(self):
+        events = []
+        if self.held is not None and self.held.strip() != "```":
+            events.extend(self._append(self.held))
+        self.held = None
+        if self.buffer:
+            events.append(self._flush())
+        events.append({"type": "file_end", "path": self.path, "size": self.size})
+        self.files.append({"path": self.path, "size": self.size})
+        self.path = None
+        self.size = 0
+        return events
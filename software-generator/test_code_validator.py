@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from code_validator import check_code
+
+RUST_LIFETIMES = """struct Parser<'a> {
+    input: &'a str,
+}
+
+impl<'a> Parser<'a> {
+    fn new(input: &'a str) -> Self {
+        let open = '{';
+        let escaped = '\\'';
+        Parser { input }
+    }
+}
+"""
+
+RUST_RAW_STRING = """fn main() {
+    let pattern = r#"a "quoted" ( and } "#;
+    let bytes = br"[";
+    println!("{}", pattern);
+}
+"""
+
+KOTLIN_TRIPLE_QUOTED = '''fun main() {
+    val text = """
+        He said "hi" and left (
+    """
+    println(text)
+}
+'''
+
+SWIFT_STRINGS = '''let text = """
+    A "quoted" word ]
+    """
+let raw = #"a "raw" string ("#
+print(text, raw)
+'''
+
+def test_rust_lifetimes_are_not_char_literals():
+    assert check_code("rust", RUST_LIFETIMES) is None
+
+def test_rust_raw_strings():
+    assert check_code("rust", RUST_RAW_STRING) is None
+
+def test_kotlin_triple_quoted_strings():
+    assert check_code("kotlin", KOTLIN_TRIPLE_QUOTED) is None
+
+def test_swift_multiline_and_raw_strings():
+    assert check_code("swift", SWIFT_STRINGS) is None
+
+def test_javascript_regex_literal():
+    assert check_code("javascript", "const re = /[(]/;\nconsole.log(re);") is None
+
+def test_unbalanced_rust_is_still_reported():
+    error = check_code("rust", "impl<'a> Parser<'a> {\n    fn new() {\n}\n")
+    assert str(error) == "line 1: '{' is never closed"
+
+def test_python_match_statement():
+    assert check_code("python", "match command:\n    case \"go\":\n        pass\n") is None
@@ -0,0 +1,206 @@
+"""
+Merges the per-hop trace files written by the services (TRACE_LOG_DIR) and
+reports where the time of a request goes.
+
+    python tools/trace_analyzer.py traces/*.jsonl* --top 10
+    python tools/trace_analyzer.py traces/*.jsonl* --trace <trace id>
+"""
+import argparse
+import glob
+import json
+from collections import defaultdict
+
+def load_records(patterns):
+    records = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path) as file:
+                for line in file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get("start") is not None and record.get("end") is not None:
+                        records.append(record)
+    return records
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def union(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def duration(intervals):
+    return sum(end - start for start, end in union(intervals))
+
+def overlap(intervals, start, end):
+    return sum(max(0.0, min(end, b) - max(start, a)) for a, b in union(intervals))
+
+def label(record):
+    # the gateway and the generator host name a hop after the queue they call or serve
+    if record["hop"] == record["service"]:
+        return record["service"]
+    return f"{record['service']}:{record['hop']}"
+
+def queue_time(record):
+    return max(0.0, record["receive"] - record["publish"]) if record.get("publish") else 0.0
+
+def wait_time(record):
+    return max(0.0, record["start"] - record["receive"])
+
+def service_time(record):
+    return max(0.0, record["end"] - record["start"])
+
+class Trace:
+    def __init__(self, trace_id, records):
+        self.id = trace_id
+        self.records = records
+        ids = {record["id"] for record in records}
+        self.children = defaultdict(list)
+        self.roots = []
+        for record in records:
+            if record.get("parent") in ids:
+                self.children[record["parent"]].append(record)
+            else:
+                self.roots.append(record)
+        self.root = min(self.roots, key=lambda record: record.get("publish") or record["receive"])
+
+    @property
+    def total(self):
+        start = self.root.get("publish") or self.root["receive"]
+        return max(record["end"] for record in self.records) - start
+
+    def critical_path(self):
+        """
+        Follows the child that finished last from the root down, that chain of
+        hops decides how long the request took.
+        """
+        path = [self.root]
+        while self.children.get(path[-1]["id"]):
+            path.append(max(self.children[path[-1]["id"]], key=lambda record: record["end"]))
+        return path
+
+    def breakdown(self):
+        """
+        Splits the critical path into queueing, local waiting, model time and other
+        work of every hop, leaving out the time spent in the next hop on the path.
+        """
+        parts = []
+        path = self.critical_path()
+        for index, record in enumerate(path):
+            own = service_time(record)
+            llm = duration(record.get("llm", []))
+            if index + 1 < len(path):
+                child = path[index + 1]
+                child_start = child.get("publish") or child["receive"]
+                own -= max(0.0, min(record["end"], child["end"]) - max(record["start"], child_start))
+                llm -= overlap(record.get("llm", []), child_start, child["end"])
+            parts.append({
+                "hop": label(record),
+                "queue": queue_time(record),
+                "wait": wait_time(record),
+                "llm": max(0.0, llm),
+                "other": max(0.0, own - max(0.0, llm)),
+            })
+        return parts
+
+def group_traces(records):
+    grouped = defaultdict(list)
+    for record in records:
+        grouped[record["trace_id"]].append(record)
+    return [Trace(trace_id, items) for trace_id, items in grouped.items()]
+
+def print_hops(records):
+    by_hop = defaultdict(list)
+    for record in records:
+        by_hop[label(record)].append(record)
+    print("Per hop (p50 / p95 seconds)")
+    print(f"{'hop':<32}{'count':>7}{'queue':>18}{'wait':>18}{'service':>18}{'llm':>18}")
+    for hop, items in sorted(by_hop.items()):
+        columns = []
+        for measure in (queue_time, wait_time, service_time, lambda record: duration(record.get("llm", []))):
+            values = [measure(record) for record in items]
+            columns.append(f"{percentile(values, 50):8.3f} /{percentile(values, 95):8.3f}")
+        print(f"{hop:<32}{len(items):>7}" + "".join(f"{column:>18}" for column in columns))
+    print()
+
+def print_critical_paths(traces):
+    totals = defaultdict(float)
+    for trace in traces:
+        for part in trace.breakdown():
+            for category in ("queue", "wait", "llm", "other"):
+                totals[(part["hop"], category)] += part[category]
+    overall = sum(totals.values()) or 1.0
+    print(f"Critical path breakdown over {len(traces)} requests")
+    print(f"{'hop':<32}{'part':<8}{'mean s':>10}{'share':>9}")
+    for (hop, category), total in sorted(totals.items(), key=lambda item: -item[1]):
+        if total > 0:
+            print(f"{hop:<32}{category:<8}{total / len(traces):>10.3f}{total / overall:>9.1%}")
+    print()
+
+def describe_path(trace):
+    return " > ".join(
+        f"{part['hop']} (queue {part['queue']:.2f}s, llm {part['llm']:.2f}s, other {part['other']:.2f}s)"
+        for part in trace.breakdown()
+    )
+
+def print_outliers(traces, top):
+    print(f"Slowest {top} requests")
+    for trace in sorted(traces, key=lambda trace: -trace.total)[:top]:
+        print(f"{trace.total:8.2f}s  {trace.id}")
+        print(f"          {describe_path(trace)}")
+    print()
+
+def print_timeline(trace):
+    origin = trace.root.get("publish") or trace.root["receive"]
+    print(f"Trace {trace.id}, {trace.total:.3f}s")
+    for record in sorted(trace.records, key=lambda record: record.get("publish") or record["receive"]):
+        publish = record.get("publish")
+        print(
+            f"  {label(record):<32}"
+            f" publish {(publish - origin) if publish else 0.0:8.3f}"
+            f" receive {record['receive'] - origin:8.3f}"
+            f" start {record['start'] - origin:8.3f}"
+            f" end {record['end'] - origin:8.3f}"
+            f" llm {duration(record.get('llm', [])):7.3f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze per-hop trace files of the services.")
+    parser.add_argument("files", nargs="+", help="trace files or glob patterns, rotated files included")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest requests to list")
+    parser.add_argument("--trace", help="print the timeline of one trace id")
+    args = parser.parse_args()
+
+    records = load_records(args.files)
+    if not records:
+        print("No trace records found.")
+        return
+    traces = group_traces(records)
+    if args.trace:
+        matches = [trace for trace in traces if trace.id == args.trace]
+        if not matches:
+            print(f"Trace {args.trace} not found.")
+            return
+        print_timeline(matches[0])
+        return
+
+    print(f"{len(records)} records, {len(traces)} requests\n")
+    print_hops(records)
+    print_critical_paths(traces)
+    print_outliers(traces, args.top)
+
+if __name__ == "__main__":
+    main()